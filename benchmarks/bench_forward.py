@@ -0,0 +1,166 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Measure how many propagate buffers per second one client can send to the other clients in its age instance,
+comparing forwarding of the original received data without parsing it
+with the previous approach of parsing every message and serializing it again for forwarding.
+
+The traffic is synthetic,
+but mirrors typical game server traffic:
+mostly small game messages (avatar movement, physics, notifications),
+some of them echoed back to the sender,
+and occasional voice chat.
+
+Run with ``python -m benchmarks.bench_forward [MEMBERS]`` from the repository root.
+"""
+
+
+import asyncio
+import datetime
+import io
+import os
+import random
+import sys
+import time
+import typing
+import unittest.mock
+
+from nagus import configuration
+from nagus import game_server
+from nagus import state
+from nagus import structs
+
+
+MESSAGE_COUNT = 20000
+AGE_NODE_ID = 1
+
+
+class DiscardingWriter(object):
+	@property
+	def transport(self) -> "DiscardingWriter":
+		# Nothing is ever buffered,
+		# so the writer can stand in for its own transport.
+		return self
+	
+	def get_write_buffer_size(self) -> int:
+		return 0
+	
+	def writelines(self, data: typing.Iterable[bytes]) -> None:
+		pass
+	
+	async def drain(self) -> None:
+		pass
+	
+	def close(self) -> None:
+		pass
+
+
+def reserialize(self: game_server.NetMessage) -> bytes:
+	"""Reimplementation of the old forwarding approach:
+	always serialize the parsed message again.
+	"""
+	
+	with io.BytesIO() as stream:
+		self.write_with_class_index(stream)
+		return stream.getvalue()
+
+
+async def never_forward_raw(self: game_server.GameConnection, class_index: int, data: bytes) -> bool:
+	return False
+
+
+def make_traffic(rand: random.Random, ki_numbers: typing.Sequence[int]) -> bytes:
+	now = datetime.datetime.now(tz=datetime.timezone.utc)
+	messages = []
+	for _ in range(MESSAGE_COUNT):
+		message: game_server.NetMessage
+		if rand.random() < 0.1:
+			message = game_server.NetMessageVoice()
+			message.voice_flags = game_server.NetMessageVoice.Flags.encoded_opus
+			message.frame_count = 3
+			message.voice_data = os.urandom(rand.randrange(100, 500))
+			message.receivers = list(ki_numbers)
+		else:
+			message = game_server.NetMessageGameMessage()
+			message.delivery_time = structs.ZERO_DATETIME
+			message.compress_and_set_data(os.urandom(rand.randrange(30, 300)))
+			if rand.random() < 0.2:
+				message.flags |= game_server.NetMessageFlags.echo_back_to_sender
+		
+		message.flags |= game_server.NetMessageFlags.has_time_sent | game_server.NetMessageFlags.has_player_id
+		message.time_sent = now
+		message.ki_number = 1
+		
+		buffer = message.to_bytes_with_class_index()
+		messages.append(game_server.PROPAGATE_BUFFER_HEADER.pack(message.class_index, len(buffer)) + buffer)
+	return b"".join(messages)
+
+
+def make_member(server_state: state.ServerState, ki_number: int) -> game_server.GameConnection:
+	conn = game_server.GameConnection(asyncio.StreamReader(), typing.cast(asyncio.StreamWriter, DiscardingWriter()), server_state)
+	conn.client_state.age_node_id = AGE_NODE_ID
+	conn.client_state.ki_number = ki_number
+	conn.join_room()
+	return conn
+
+
+async def forward_all(data: bytes, member_count: int) -> float:
+	config = configuration.Configuration()
+	config.set_option(["server", "handshake_workers"], "0")
+	config.set_option(["server", "game", "max_queued_messages"], str(MESSAGE_COUNT + 1))
+	config.set_defaults()
+	server_state = state.ServerState(config, asyncio.get_running_loop(), typing.cast(state.Database, None))
+	
+	sender = make_member(server_state, 1)
+	for ki_number in range(2, member_count + 1):
+		make_member(server_state, ki_number)
+	
+	assert sender.reader is not None
+	sender.reader.feed_data(data)
+	
+	start = time.perf_counter()
+	for i in range(MESSAGE_COUNT):
+		await sender.receive_propagate_buffer()
+		if i % 100 == 99:
+			# Let the send tasks and scheduled flushes run,
+			# like they would between received TCP segments.
+			await asyncio.sleep(0)
+	await asyncio.sleep(0)
+	elapsed = time.perf_counter() - start
+	
+	return MESSAGE_COUNT / elapsed
+
+
+def main() -> None:
+	member_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	data = make_traffic(random.Random(14617), range(2, member_count + 1))
+	
+	with unittest.mock.patch.object(game_server.NetMessage, "to_bytes_with_class_index", reserialize):
+		with unittest.mock.patch.object(game_server.GameConnection, "try_forward_raw_propagate_buffer", never_forward_raw):
+			rate = asyncio.run(forward_all(data, member_count))
+	print(f" parse and reserialize: {rate:10.0f} messages/s")
+	
+	with unittest.mock.patch.object(game_server.GameConnection, "try_forward_raw_propagate_buffer", never_forward_raw):
+		rate = asyncio.run(forward_all(data, member_count))
+	print(f"  parse, forward as-is: {rate:10.0f} messages/s")
+	
+	rate = asyncio.run(forward_all(data, member_count))
+	print(f"      raw pass-through: {rate:10.0f} messages/s")
+
+
+if __name__ == "__main__":
+	main()
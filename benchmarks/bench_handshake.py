@@ -0,0 +1,123 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Simulate a connect storm and measure encryption handshake throughput,
+as well as how much the handshakes delay ping replies on an unrelated connection.
+
+Run with ``python -m benchmarks.bench_handshake [CONNECTIONS]`` from the repository root.
+"""
+
+
+import asyncio
+import os
+import random
+import statistics
+import socket
+import sys
+import threading
+import time
+import typing
+
+from nagus import handshake
+
+
+PING_INTERVAL = 0.005
+
+
+async def ping_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+	try:
+		while True:
+			writer.write(await reader.readexactly(8))
+	except asyncio.IncompleteReadError:
+		pass
+	finally:
+		writer.close()
+
+
+def ping_client(port: int, rtts: typing.List[float], stop: threading.Event) -> None:
+	# Runs in a separate thread with a blocking socket,
+	# like an external client would,
+	# so that the measured round trip times include any time that the server's event loop is blocked.
+	with socket.create_connection(("127.0.0.1", port)) as sock:
+		while not stop.is_set():
+			start = time.perf_counter()
+			sock.sendall(bytes(8))
+			received = 0
+			while received < 8:
+				received += len(sock.recv(8 - received))
+			rtts.append(time.perf_counter() - start)
+			time.sleep(PING_INTERVAL)
+
+
+async def measure_pings(port: int, during: typing.Awaitable[typing.Any]) -> typing.List[float]:
+	rtts: typing.List[float] = []
+	stop = threading.Event()
+	thread = threading.Thread(target=ping_client, args=(port, rtts, stop))
+	thread.start()
+	try:
+		await during
+	finally:
+		stop.set()
+		# Keep the event loop running while the thread finishes its last ping.
+		while thread.is_alive():
+			await asyncio.sleep(PING_INTERVAL)
+	return rtts
+
+
+async def run_storm(workers: int, connections: int) -> None:
+	executor = handshake.HandshakeExecutor(workers, max_pending=connections)
+	rand = random.Random(0)
+	n = rand.getrandbits(512) | (1 << 511) | 1
+	a = rand.getrandbits(512)
+	ys = [rand.getrandbits(510) for _ in range(connections)]
+	
+	# Warm up the worker processes so that process startup isn't counted.
+	await asyncio.gather(*[executor.dh_pow(2, a, n) for _ in range(max(1, workers))])
+	
+	server = await asyncio.start_server(ping_server, "127.0.0.1", 0)
+	port = server.sockets[0].getsockname()[1]
+	
+	idle_rtts = await measure_pings(port, asyncio.sleep(0.5))
+	
+	start = time.perf_counter()
+	storm_rtts = await measure_pings(port, asyncio.gather(*[executor.dh_pow(y, a, n) for y in ys]))
+	elapsed = time.perf_counter() - start
+	
+	# Give the ping server a moment to notice that the client disconnected.
+	await asyncio.sleep(0.1)
+	server.close()
+	await server.wait_closed()
+	executor.shutdown()
+	
+	def _describe(rtts: typing.List[float]) -> str:
+		if not rtts:
+			return "no samples"
+		return f"median {statistics.median(rtts) * 1000:7.2f} ms, max {max(rtts) * 1000:7.2f} ms ({len(rtts)} samples)"
+	
+	print(f"workers={workers}: {connections / elapsed:8.0f} handshakes/s")
+	print(f"	ping RTT idle:  {_describe(idle_rtts)}")
+	print(f"	ping RTT storm: {_describe(storm_rtts)}")
+
+
+def main() -> None:
+	connections = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	for workers in [0, os.cpu_count() or 1]:
+		asyncio.run(run_storm(workers, connections))
+
+
+if __name__ == "__main__":
+	main()
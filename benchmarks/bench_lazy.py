@@ -0,0 +1,121 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Measure how many position and avatar input messages per second can be decoded,
+and how many one client can send to the other clients in its age instance
+when they have to go through the normal message parsing path
+(e. g. because of flags that the raw pass-through doesn't handle),
+comparing lazy reading of everything after the message header
+with the previous approach of reading every message fully right away.
+
+Run with ``python -m benchmarks.bench_lazy [MEMBERS]`` from the repository root.
+"""
+
+
+import asyncio
+import datetime
+import io
+import os
+import random
+import sys
+import time
+import typing
+import unittest.mock
+
+from nagus import game_server
+from nagus import structs
+
+from .bench_forward import MESSAGE_COUNT, forward_all, never_forward_raw
+
+
+# The best of several runs is reported,
+# to reduce noise from other activity on the machine.
+REPEATS = 5
+
+
+def read_eagerly(self: game_server.NetMessage, data: bytes) -> None:
+	"""Reimplementation of the old reading approach:
+	read the entire message right away.
+	"""
+	
+	with io.BytesIO(data) as stream:
+		stream.seek(structs.CLASS_INDEX.size)
+		self.read(stream)
+	self.raw_data = data
+
+
+def make_traffic(rand: random.Random) -> bytes:
+	now = datetime.datetime.now(tz=datetime.timezone.utc)
+	messages = []
+	for _ in range(MESSAGE_COUNT):
+		message = game_server.NetMessageGameMessage()
+		message.flags |= (
+			game_server.NetMessageFlags.has_time_sent
+			| game_server.NetMessageFlags.has_player_id
+			| game_server.NetMessageFlags.use_relevance_regions
+		)
+		# Avatar input states and physics positions are sent unreliably.
+		message.flags &= ~game_server.NetMessageFlags.needs_reliable_send
+		message.time_sent = now
+		message.ki_number = 1
+		message.delivery_time = structs.ZERO_DATETIME
+		message.compress_and_set_data(os.urandom(rand.randrange(20, 120)))
+		
+		buffer = message.to_bytes_with_class_index()
+		messages.append(game_server.PROPAGATE_BUFFER_HEADER.pack(message.class_index, len(buffer)) + buffer)
+	return b"".join(messages)
+
+
+def decode_all(buffers: typing.Sequence[bytes]) -> float:
+	start = time.perf_counter()
+	for buffer in buffers:
+		(class_index,) = structs.CLASS_INDEX.unpack_from(buffer)
+		message = game_server.NetMessage.from_class_index(class_index)
+		message.read_lazy(buffer)
+	elapsed = time.perf_counter() - start
+	
+	return len(buffers) / elapsed
+
+
+def main() -> None:
+	member_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	data = make_traffic(random.Random(14617))
+	
+	scenarios: typing.List[typing.Tuple[str, typing.Callable[..., typing.Any]]] = [
+		("eager", read_eagerly),
+		("lazy", game_server.NetMessage.read_lazy),
+	]
+	
+	# Without the propagate buffer headers.
+	buffers = []
+	offset = 0
+	while offset < len(data):
+		_, length = game_server.PROPAGATE_BUFFER_HEADER.unpack_from(data, offset)
+		offset += game_server.PROPAGATE_BUFFER_HEADER.size
+		buffers.append(data[offset:offset + length])
+		offset += length
+	
+	for name, read_function in scenarios:
+		with unittest.mock.patch.object(game_server.NetMessage, "read_lazy", read_function):
+			decode_rate = max(decode_all(buffers) for _ in range(REPEATS))
+			with unittest.mock.patch.object(game_server.GameConnection, "try_forward_raw_propagate_buffer", never_forward_raw):
+				forward_rate = max(asyncio.run(forward_all(data, member_count)) for _ in range(REPEATS))
+		print(f"{name:>5}: {decode_rate:10.0f} messages/s decoded, {forward_rate:10.0f} messages/s forwarded")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,188 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Measure how quickly incoming messages are parsed,
+comparing the buffered reading in :class:`nagus.base.BaseMOULConnection`
+with the previous approach of awaiting and decrypting every field separately.
+
+The traffic is synthetic,
+but mirrors the message layouts and sizes of typical auth and game server traffic:
+logins, pings and vault node fetches for auth,
+and mostly small propagate buffers with occasional large SDL states for game.
+
+Run with ``python -m benchmarks.bench_parse`` from the repository root.
+"""
+
+
+import asyncio
+import os
+import random
+import time
+import typing
+
+from nagus import auth_server
+from nagus import base
+from nagus import crypto
+from nagus import game_server
+from nagus import state
+from nagus import structs
+
+
+# Typical TCP segment payload size.
+SEGMENT_SIZE = 1460
+MESSAGE_COUNT = 20000
+SESSION_KEY = bytes(7)
+
+
+class BenchAuthConnection(base.BaseMOULConnection):
+	CONNECTION_TYPE = base.ConnectionType.cli2auth
+	
+	@base.message_handler(0)
+	async def ping_request(self) -> None:
+		header_data = await self.read(auth_server.PING_HEADER.size)
+		ping_time, trans_id, payload_length = auth_server.PING_HEADER.unpack(header_data)
+		await self.read(payload_length)
+	
+	@base.message_handler(3)
+	async def account_login_request(self) -> None:
+		await self.read_unpack(auth_server.ACCOUNT_LOGIN_REQUEST_HEADER)
+		await self.read_string_field(64)
+		await self.read(20)
+		await self.read_string_field(64)
+		await self.read_string_field(8)
+	
+	@base.message_handler(26)
+	async def vault_node_fetch(self) -> None:
+		await self.read_unpack(auth_server.VAULT_NODE_FETCH)
+
+
+class BenchGameConnection(base.BaseMOULConnection):
+	CONNECTION_TYPE = base.ConnectionType.cli2game
+	
+	@base.message_handler(0)
+	async def ping_request(self) -> None:
+		await self.read_unpack(structs.UINT32)
+	
+	@base.message_handler(2)
+	async def receive_propagate_buffer(self) -> None:
+		buffer_type, buffer_length = await self.read_unpack(game_server.PROPAGATE_BUFFER_HEADER)
+		await self.read_view(buffer_length)
+
+
+class UnbufferedReads(base.BaseMOULConnection):
+	"""Reimplementation of the old reading approach:
+	wait for and decrypt every field separately.
+	"""
+	
+	async def read_view(self, byte_count: int) -> memoryview:
+		data = await self.reader.readexactly(byte_count)
+		if self.encryption_state_read is not None:
+			data = self.encryption_state_read.crypt(data)
+		return memoryview(data)
+	
+	async def read(self, byte_count: int) -> bytes:
+		return bytes(await self.read_view(byte_count))
+	
+	async def read_unpack(self, st: typing.Any) -> typing.Tuple[typing.Any, ...]:
+		return typing.cast(typing.Tuple[typing.Any, ...], st.unpack(await self.read_view(st.size)))
+
+
+class UnbufferedBenchAuthConnection(UnbufferedReads, BenchAuthConnection):
+	pass
+
+
+class UnbufferedBenchGameConnection(UnbufferedReads, BenchGameConnection):
+	pass
+
+
+def make_auth_traffic(rand: random.Random) -> bytes:
+	messages = []
+	for _ in range(MESSAGE_COUNT):
+		kind = rand.random()
+		if kind < 0.05:
+			messages.append(
+				structs.UINT16.pack(3)
+				+ auth_server.ACCOUNT_LOGIN_REQUEST_HEADER.pack(1, rand.getrandbits(32))
+				+ base.pack_string_field("AzureDiamond@example.com", 64)
+				+ os.urandom(20)
+				+ base.pack_string_field("", 64)
+				+ base.pack_string_field("win", 8)
+			)
+		elif kind < 0.3:
+			messages.append(structs.UINT16.pack(0) + auth_server.PING_HEADER.pack(rand.getrandbits(32), 0, 0))
+		else:
+			messages.append(structs.UINT16.pack(26) + auth_server.VAULT_NODE_FETCH.pack(1, rand.randrange(1, 100000)))
+	return b"".join(messages)
+
+
+def make_game_traffic(rand: random.Random) -> bytes:
+	messages = []
+	for _ in range(MESSAGE_COUNT):
+		kind = rand.random()
+		if kind < 0.01:
+			# Large SDL state.
+			length = rand.randrange(4096, 16384)
+		elif kind < 0.1:
+			messages.append(structs.UINT16.pack(0) + structs.UINT32.pack(rand.getrandbits(32)))
+			continue
+		else:
+			# Typical avatar/physics/notify message.
+			length = rand.randrange(30, 300)
+		messages.append(structs.UINT16.pack(2) + game_server.PROPAGATE_BUFFER_HEADER.pack(0x0000, length) + os.urandom(length))
+	return b"".join(messages)
+
+
+async def parse_all(conn_class: typing.Type[base.BaseMOULConnection], data: bytes) -> float:
+	reader = asyncio.StreamReader()
+	for i in range(0, len(data), SEGMENT_SIZE):
+		reader.feed_data(data[i:i + SEGMENT_SIZE])
+	reader.feed_eof()
+	
+	conn = conn_class(reader, typing.cast(asyncio.StreamWriter, None), typing.cast(state.ServerState, None))
+	conn.encryption_state_read = crypto.Rc4State(SESSION_KEY)
+	
+	count = 0
+	start = time.perf_counter()
+	try:
+		while True:
+			(message_type,) = await conn.read_unpack(structs.UINT16)
+			await conn.handle_message(message_type)
+			count += 1
+	except asyncio.IncompleteReadError:
+		pass
+	elapsed = time.perf_counter() - start
+	
+	assert count == MESSAGE_COUNT
+	return count / elapsed
+
+
+def main() -> None:
+	rand = random.Random(14617)
+	scenarios: typing.List[typing.Tuple[str, bytes, typing.Type[base.BaseMOULConnection], typing.Type[base.BaseMOULConnection]]] = [
+		("auth", make_auth_traffic(rand), UnbufferedBenchAuthConnection, BenchAuthConnection),
+		("game", make_game_traffic(rand), UnbufferedBenchGameConnection, BenchGameConnection),
+	]
+	
+	for scenario_name, plaintext, unbuffered_class, buffered_class in scenarios:
+		data = crypto.Rc4State(SESSION_KEY).crypt(plaintext)
+		for name, conn_class in [("unbuffered", unbuffered_class), ("buffered", buffered_class)]:
+			rate = asyncio.run(parse_all(conn_class, data))
+			print(f"{scenario_name:>4} {name:>10}: {rate:10.0f} messages/s ({len(data) / MESSAGE_COUNT:.0f} bytes/message)")
+
+
+if __name__ == "__main__":
+	main()
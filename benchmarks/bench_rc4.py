@@ -0,0 +1,64 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Compare RC4 throughput of the different implementations in :mod:`nagus.crypto`.
+
+Run with ``python -m benchmarks.bench_rc4`` from the repository root.
+"""
+
+
+import os
+import time
+import typing
+
+from nagus import crypto
+
+
+# Roughly: a ping, a small propagate buffer, a large propagate buffer, a vault node fetch reply.
+CHUNK_SIZES = [8, 64, 1024, 16384]
+TOTAL_BYTES = 1 << 20
+
+
+def bench(make_state: typing.Callable[[bytes], typing.Any], chunk_size: int) -> float:
+	state = make_state(os.urandom(7))
+	data = os.urandom(chunk_size)
+	count = max(1, TOTAL_BYTES // chunk_size)
+	
+	start = time.perf_counter()
+	for _ in range(count):
+		state.crypt(data)
+	elapsed = time.perf_counter() - start
+	
+	return count * chunk_size / elapsed
+
+
+def main() -> None:
+	implementations: typing.List[typing.Tuple[str, typing.Callable[[bytes], typing.Any]]] = [
+		("SlowRc4State", crypto.SlowRc4State),
+		("Rc4State (pure Python)", lambda key: crypto.Rc4State(key, allow_accelerated=False)),
+	]
+	if crypto.Rc4State(b"\x00").is_accelerated:
+		implementations.append(("Rc4State (accelerated)", crypto.Rc4State))
+	
+	for chunk_size in CHUNK_SIZES:
+		for name, make_state in implementations:
+			throughput = bench(make_state, chunk_size)
+			print(f"{name:>24} {chunk_size:>6} byte chunks: {throughput / (1 << 20):8.2f} MiB/s")
+
+
+if __name__ == "__main__":
+	main()
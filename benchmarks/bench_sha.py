@@ -0,0 +1,67 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Compare SHA-0 hashing speed of the different implementations in :mod:`nagus.crypto`.
+
+Run with ``python -m benchmarks.bench_sha`` from the repository root.
+"""
+
+
+import time
+import typing
+
+from nagus import crypto
+
+
+DURATION = 1.0
+
+# A SHA-0 password hash input (account name and password as UTF-16)
+# and a challenge hash input (two challenge values and a password hash).
+INPUTS = [
+	("password hash", ("AzureDiamond@example.com" + "hunter2").encode("utf-16-le")),
+	("challenge hash", crypto.CHALLENGE_HASH_DATA.pack(0xbd6683e0, 0xdeadbeef, bytes(20))),
+]
+
+
+def bench(func: typing.Callable[[bytes], bytes], data: bytes) -> float:
+	count = 0
+	start = time.perf_counter()
+	deadline = start + DURATION
+	while True:
+		for _ in range(100):
+			func(data)
+		count += 100
+		now = time.perf_counter()
+		if now >= deadline:
+			return count / (now - start)
+
+
+def main() -> None:
+	implementations: typing.List[typing.Tuple[str, typing.Callable[[bytes], bytes]]] = [
+		("slow_sha_0", crypto.slow_sha_0),
+		("_fast_sha_0_1", lambda data: crypto._fast_sha_0_1(data, sha_1=False)),
+	]
+	if crypto._accelerated_sha_0 is not None:
+		implementations.append(("sha_0 (hashlib)", crypto.sha_0))
+	
+	for input_name, data in INPUTS:
+		for name, func in implementations:
+			print(f"{name:>16} {input_name:>14} ({len(data):>2} bytes): {bench(func, data):10.0f} hashes/s")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,186 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Compare the stream-based and protocol-based transport implementations
+(see the ``server.transport`` config option)
+in terms of ping messages handled per second and memory used per idle connection.
+
+Run with ``python -m benchmarks.bench_transport [CONNECTIONS]`` from the repository root.
+"""
+
+
+import asyncio
+import logging
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+import typing
+import uuid
+
+from nagus import __main__ as nagus_main
+from nagus import auth_server
+from nagus import base
+from nagus import configuration
+from nagus import state
+from nagus import structs
+
+
+PINGS_PER_ROUND = 20
+ROUNDS = 50
+
+CONNECT_PACKET = (
+	bytes([base.ConnectionType.debug.value])
+	+ structs.UINT16.pack(base.CONNECT_HEADER_LENGTH)
+	+ base.CONNECT_HEADER_TAIL.pack(918, base.BuildType.live.value, 1, uuid.UUID(int=0).bytes_le)
+	# Non-empty Diffie-Hellman y value,
+	# to which a server without keys replies with a dummy seed and no encryption.
+	+ base.SETUP_MESSAGE_HEADER.pack(base.SetupMessageType.cli2srv_connect.value, base.SETUP_MESSAGE_HEADER.size + 1)
+	+ b"\x00"
+)
+SETUP_REPLY_LENGTH = 9
+PING_MESSAGE = structs.UINT16.pack(0) + auth_server.PING_HEADER.pack(0, 0, 0)
+
+
+class BenchConnection(base.BaseMOULConnection):
+	CONNECTION_TYPE = base.ConnectionType.debug
+	
+	def __init__(self, reader: typing.Optional[asyncio.StreamReader], writer: base.Writer, server_state: state.ServerState) -> None:
+		super().__init__(reader, writer, server_state)
+		
+		self.dh_keys = None
+	
+	async def read_connect_packet_data(self) -> None:
+		pass
+	
+	@base.message_handler(0)
+	async def ping_request(self) -> None:
+		header_data = await self.read(auth_server.PING_HEADER.size)
+		ping_time, trans_id, payload_length = auth_server.PING_HEADER.unpack(header_data)
+		payload = await self.read(payload_length)
+		await self.write_message(0, header_data + payload)
+
+
+def recv_exactly(sock: socket.socket, byte_count: int) -> None:
+	while byte_count > 0:
+		data = sock.recv(byte_count)
+		if not data:
+			raise EOFError()
+		byte_count -= len(data)
+
+
+def connect_clients(port: int, count: int) -> typing.List[socket.socket]:
+	socks = []
+	for _ in range(count):
+		sock = socket.create_connection(("127.0.0.1", port))
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		sock.sendall(CONNECT_PACKET)
+		socks.append(sock)
+	for sock in socks:
+		recv_exactly(sock, SETUP_REPLY_LENGTH)
+	return socks
+
+
+def ping_clients(socks: typing.List[socket.socket]) -> None:
+	# Send a batch of pings on every connection before reading any replies,
+	# so that the server has many connections with pending messages at once.
+	batch = PING_MESSAGE * PINGS_PER_ROUND
+	for _ in range(ROUNDS):
+		for sock in socks:
+			sock.sendall(batch)
+		for sock in socks:
+			recv_exactly(sock, len(batch))
+
+
+async def run_in_thread(func: typing.Callable[[], typing.Any]) -> typing.Any:
+	# Run the blocking clients in a separate thread (like external clients)
+	# while keeping the server's event loop running.
+	result: typing.List[typing.Any] = []
+	thread = threading.Thread(target=lambda: result.append(func()))
+	thread.start()
+	while thread.is_alive():
+		await asyncio.sleep(0.001)
+	return result[0] if result else None
+
+
+def server_memory(snapshot: tracemalloc.Snapshot) -> int:
+	# Only count allocations made by asyncio and NAGUS itself,
+	# not by the client sockets in the benchmark thread.
+	filters = [
+		tracemalloc.Filter(True, "*asyncio*"),
+		tracemalloc.Filter(True, "*nagus*"),
+	]
+	return sum(stat.size for stat in snapshot.filter_traces(filters).statistics("filename"))
+
+
+async def bench_transport(transport: configuration.Transport, connections: int) -> None:
+	config = configuration.Configuration()
+	config.set_option(["server", "handshake_workers"], "0")
+	config.set_defaults()
+	db = await state.Database.connect(":memory:")
+	server_state = state.ServerState(config, asyncio.get_running_loop(), db)
+	
+	server: asyncio.AbstractServer
+	if transport == configuration.Transport.protocol:
+		server = await asyncio.get_running_loop().create_server(lambda: nagus_main.MOULProtocol(server_state), "127.0.0.1", 0)
+	else:
+		async def _client_connected(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+			await nagus_main.client_connected(reader, writer, server_state)
+		
+		server = await asyncio.start_server(_client_connected, "127.0.0.1", 0)
+	port = server.sockets[0].getsockname()[1]
+	
+	tracemalloc.start()
+	before = server_memory(tracemalloc.take_snapshot())
+	socks = await run_in_thread(lambda: connect_clients(port, connections))
+	# Let the server finish processing the setup messages.
+	await asyncio.sleep(0.1)
+	after = server_memory(tracemalloc.take_snapshot())
+	tracemalloc.stop()
+	
+	start = time.perf_counter()
+	await run_in_thread(lambda: ping_clients(socks))
+	elapsed = time.perf_counter() - start
+	
+	for sock in socks:
+		sock.close()
+	await asyncio.sleep(0.1)
+	server.close()
+	await server.wait_closed()
+	server_state.handshake_executor.shutdown()
+	await db.close()
+	
+	messages = connections * PINGS_PER_ROUND * ROUNDS
+	print(f"{transport.value:>8}: {messages / elapsed:9.0f} messages/s, {(after - before) / connections:8.0f} bytes/connection")
+
+
+def main() -> None:
+	connections = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+	
+	# Don't log every client disconnect at the end of each run.
+	logging.getLogger("nagus").setLevel(logging.CRITICAL)
+	
+	# Make the benchmark connection class available to the real connection dispatch code.
+	nagus_main.CONNECTION_CLASSES_BY_TYPE[BenchConnection.CONNECTION_TYPE] = BenchConnection
+	
+	for transport in [configuration.Transport.streams, configuration.Transport.protocol]:
+		asyncio.run(bench_transport(transport, connections))
+
+
+if __name__ == "__main__":
+	main()
@@ -40,6 +40,7 @@ from . import console
 from . import crash_lines
 from . import game_server
 from . import gatekeeper_server
+from . import handshake
 from . import state
 
 
@@ -60,17 +61,19 @@ CONNECTION_CLASSES_BY_TYPE: typing.Dict[base.ConnectionType, typing.Type[base.Ba
 }
 
 
-async def client_connected_inner(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server_state: state.ServerState) -> None:
-	client_address = writer.get_extra_info("peername")
-	
-	sock = writer.transport.get_extra_info("socket")
+def configure_transport(transport: asyncio.BaseTransport) -> None:
+	sock = transport.get_extra_info("socket")
 	if sock is not None:
 		# Disable Nagle's algorithm
 		# (if this is a TCP-based transport, which it should always be)
 		# to try to ensure that every write call goes out as an actual TCP packet right away.
 		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 	
-	(conn_type_num,) = await reader.readexactly(1)
+	if isinstance(transport, asyncio.WriteTransport):
+		transport.set_write_buffer_limits(high=base.SEND_HIGH_WATER, low=base.SEND_LOW_WATER)
+
+
+def get_connection_class(conn_type_num: int, client_address: typing.Any) -> typing.Type[base.BaseMOULConnection]:
 	try:
 		conn_type = base.ConnectionType(conn_type_num)
 	except ValueError:
@@ -79,22 +82,34 @@ async def client_connected_inner(reader: asyncio.StreamReader, writer: asyncio.S
 	logger_client.info("Client %s requests connection type %s", client_address, conn_type)
 	
 	try:
-		conn_class = CONNECTION_CLASSES_BY_TYPE[conn_type]
+		return CONNECTION_CLASSES_BY_TYPE[conn_type]
 	except KeyError:
 		raise base.ProtocolError(f"Unsupported connection type {conn_type}")
+
+
+async def client_connected_inner(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server_state: state.ServerState) -> None:
+	client_address = writer.get_extra_info("peername")
+	configure_transport(writer.transport)
 	
+	(conn_type_num,) = await reader.readexactly(1)
+	conn_class = get_connection_class(conn_type_num, client_address)
 	conn = conn_class(reader, writer, server_state)
 	await conn.handle()
 
 
-async def client_connected(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server_state: state.ServerState) -> None:
+async def run_client_connection(writer: base.Writer, handler: typing.Awaitable[None], server_state: state.ServerState) -> None:
+	"""Run the ``handler`` for a client connection,
+	log any errors that it raises,
+	and close the connection afterwards.
+	"""
+	
 	# Avoid UnboundLocalError in case get_extra_info throws an exception somehow
 	client_address = None
 	
 	try:
 		try:
 			client_address = writer.get_extra_info("peername")
-			await client_connected_inner(reader, writer, server_state)
+			await handler
 		finally:
 			writer.close()
 			# No need to await writer.wait_closed(),
@@ -103,6 +118,8 @@ async def client_connected(reader: asyncio.StreamReader, writer: asyncio.StreamW
 		logger_client.error("Client %s disconnected: %s.%s: %s", client_address, type(exc).__module__, type(exc).__qualname__, exc)
 	except base.ProtocolError as exc:
 		logger_client.error("Error in data sent by %s: %s", client_address, exc)
+	except handshake.HandshakeQueueFullError as exc:
+		logger_client.warning("Rejected client %s: %s", client_address, exc)
 	except Exception as exc:
 		if server_state.config.logging_enable_crash_lines:
 			try:
@@ -122,15 +139,106 @@ async def client_connected(reader: asyncio.StreamReader, writer: asyncio.StreamW
 		logger_client.info("Cleanly disconnected from client %s", client_address)
 
 
+async def client_connected(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server_state: state.ServerState) -> None:
+	await run_client_connection(writer, client_connected_inner(reader, writer, server_state), server_state)
+
+
+class MOULProtocol(asyncio.Protocol):
+	"""Alternative to :func:`client_connected` based on :class:`asyncio.Protocol` instead of streams
+	(used if ``server.transport`` is set to ``protocol``).
+	
+	Received data is passed directly to the connection's receive buffer
+	(see :meth:`nagus.base.BaseMOULConnection.data_received`)
+	and outgoing data is written directly to the transport
+	(see :class:`nagus.base.ProtocolWriter`),
+	which avoids the overhead of :class:`asyncio.StreamReader` and :class:`asyncio.StreamWriter`.
+	The connection classes and their message handlers work the same way with both implementations.
+	"""
+	
+	server_state: state.ServerState
+	writer: typing.Optional[base.ProtocolWriter]
+	conn: typing.Optional[base.BaseMOULConnection]
+	# Data received before the connection type is known and the connection object is created.
+	_initial_data: bytearray
+	_initial_eof: bool
+	
+	def __init__(self, server_state: state.ServerState) -> None:
+		super().__init__()
+		
+		self.server_state = server_state
+		self.writer = None
+		self.conn = None
+		self._initial_data = bytearray()
+		self._initial_eof = False
+	
+	def connection_made(self, transport: asyncio.BaseTransport) -> None:
+		assert isinstance(transport, asyncio.Transport)
+		configure_transport(transport)
+		self.writer = base.ProtocolWriter(transport)
+	
+	async def _handle(self) -> None:
+		assert self.writer is not None
+		
+		conn_class = get_connection_class(self._initial_data[0], self.writer.get_extra_info("peername"))
+		self.conn = conn = conn_class(None, self.writer, self.server_state)
+		conn.data_received(self._initial_data[1:])
+		if self._initial_eof:
+			conn.eof_received()
+		self._initial_data = bytearray()
+		
+		await conn.handle()
+	
+	def data_received(self, data: bytes) -> None:
+		if self.conn is not None:
+			self.conn.data_received(data)
+		elif data:
+			assert self.writer is not None
+			if not self._initial_data:
+				self.server_state.create_background_task(run_client_connection(self.writer, self._handle(), self.server_state))
+			self._initial_data += data
+	
+	def eof_received(self) -> bool:
+		if self.conn is not None:
+			self.conn.eof_received()
+		else:
+			self._initial_eof = True
+		# Keep the transport open (like asyncio.StreamReaderProtocol does),
+		# so that any last messages can still be sent.
+		# It will be closed by run_client_connection once the connection has been handled.
+		return True
+	
+	def connection_lost(self, exc: typing.Optional[Exception]) -> None:
+		if self.writer is not None:
+			self.writer.connection_lost()
+		if self.conn is not None:
+			self.conn.eof_received()
+		else:
+			self._initial_eof = True
+	
+	def pause_writing(self) -> None:
+		assert self.writer is not None
+		self.writer.pause_writing()
+	
+	def resume_writing(self) -> None:
+		assert self.writer is not None
+		self.writer.resume_writing()
+
+
 async def moul_server_main(server_state: state.ServerState) -> None:
 	host = server_state.config.server_listen_address
 	port = server_state.config.server_port
 	
-	async def _client_connected(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
-		await client_connected(reader, writer, server_state)
+	server: asyncio.AbstractServer
+	if server_state.config.server_transport == configuration.Transport.protocol:
+		server = await asyncio.get_running_loop().create_server(lambda: MOULProtocol(server_state), host, port)
+	else:
+		async def _client_connected(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+			await client_connected(reader, writer, server_state)
+		
+		server = await asyncio.start_server(_client_connected, host, port)
 	
-	async with await asyncio.start_server(_client_connected, host, port) as server:
-		logger.info("NAGUS listening on address %r:%d...", host, port)
+	async with server:
+		logger.info("NAGUS listening on address %r:%d (using %s transport)...", host, port, server_state.config.server_transport.value)
 		await server.serve_forever()
 
 
@@ -153,6 +261,10 @@ async def async_main(config: configuration.Configuration) -> None:
 			
 			await asyncio.gather(*tasks)
 		finally:
+			server_state.handshake_executor.shutdown()
+			server_state.compression.shutdown()
+			server_state.pl_message_inspector.shutdown()
+			await game_server.save_all_age_instance_states(server_state)
 			count = await server_state.set_all_avatars_offline()
 			if count != 0:
 				logger.debug("Set %d avatars to offline while shutting down server", count)
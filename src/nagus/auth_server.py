@@ -51,8 +51,10 @@ logger_vault_notify = logger_vault.getChild("notify")
 logger_vault_write = logger_vault.getChild("write")
 
 
-# Random placeholder UUID that identifies the one and only "account",
-# until I implement proper authentication and support for multiple accounts.
+# Random placeholder UUID that identifies the one and only "account"
+# that everyone logs in to if authentication is disabled (server.auth.authentication = none).
+# To keep using avatars created this way after enabling authentication,
+# create an account with this UUID.
 PLACEHOLDER_ACCOUNT_UUID = uuid.UUID("192e8ae7-b263-4b44-996e-2b492a30da53")
 
 CONNECT_DATA = struct.Struct("<I16s")
@@ -181,18 +183,18 @@ class AuthConnection(base.BaseMOULConnection):
 	
 	client_state: AuthClientState
 	
-	def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server_state: state.ServerState) -> None:
+	def __init__(self, reader: typing.Optional[asyncio.StreamReader], writer: base.Writer, server_state: state.ServerState) -> None:
 		super().__init__(reader, writer, server_state)
 		
 		self.dh_keys = self.server_state.config.server_auth_keys
 		self.client_state = AuthClientState()
 	
-	async def write(self, data: bytes) -> None:
+	async def write_chunks(self, chunks: typing.Sequence[typing.Union[bytes, bytearray, memoryview]]) -> None:
 		try:
-			await super().write(data)
+			await super().write_chunks(chunks)
 		except ConnectionResetError:
 			# Remember the message to potentially re-send it if the client reconnects soon.
-			self.client_state.messages_while_disconnected.append(data)
+			self.client_state.messages_while_disconnected.append(b"".join(chunks))
 	
 	def _clean_up_now(self) -> None:
 		assert self.client_state.usable
@@ -351,6 +353,7 @@ class AuthConnection(base.BaseMOULConnection):
 			async def _get_kicked() -> None:
 				await self.kicked_off(client_reason)
 				# TODO Add a lock for "self is currently processing a message" and wait on that here to ensure that message handlers are never interrupted?
+				self.flush_send_queue()
 				self.writer.close()
 				await self.writer.wait_closed()
 				if ki_number is not None:
@@ -520,14 +523,72 @@ class AuthConnection(base.BaseMOULConnection):
 		if not hasattr(self.client_state, "server_challenge"):
 			await self.disconnect_with_reason(base.NetError.service_forbidden, "Client attempted to log in without sending a client register request first")
 		
-		# TODO Implement actual authentication
-		self.client_state.account_uuid = PLACEHOLDER_ACCOUNT_UUID
+		authentication = self.server_state.config.server_auth_authentication
+		if authentication == configuration.Authentication.none:
+			account_uuid = PLACEHOLDER_ACCOUNT_UUID
+			account_flags = AccountFlags.user
+			billing_type = AccountBillingType.paid_subscriber
+		elif authentication == configuration.Authentication.accounts:
+			account = await self.authenticate(account_name, client_challenge, challenge_hash)
+			if isinstance(account, base.NetError):
+				await self.account_login_reply(trans_id, account, structs.ZERO_UUID, AccountFlags.disabled, AccountBillingType.free, (0, 0, 0, 0))
+				return
+			
+			account_uuid = account.account_uuid
+			account_flags = AccountFlags(account.flags)
+			billing_type = AccountBillingType(account.billing_type)
+		else:
+			raise AssertionError(f"Unhandled authentication mode: {authentication!r}")
+		
+		self.client_state.account_uuid = account_uuid
 		logger_login.info("Account %r logged in (UUID %s)", account_name, self.client_state.account_uuid)
 		
 		async for avatar in self.server_state.find_avatars(self.client_state.account_uuid):
 			await self.account_player_info(trans_id, avatar.player_node_id, avatar.name, avatar.shape, avatar.explorer)
 		
-		await self.account_login_reply(trans_id, base.NetError.success, self.client_state.account_uuid, AccountFlags.user, AccountBillingType.paid_subscriber, (0, 0, 0, 0))
+		await self.account_login_reply(trans_id, base.NetError.success, self.client_state.account_uuid, account_flags, billing_type, (0, 0, 0, 0))
+	
+	async def authenticate(self, account_name: str, client_challenge: int, challenge_hash: bytes) -> typing.Union[state.AccountInfo, base.NetError]:
+		"""Check the credentials from a login request against the accounts in the database.
+		
+		Returns the account if the login is allowed,
+		otherwise an error code to send back to the client.
+		"""
+		
+		name_key = state.account_name_key(account_name)
+		peername = self.writer.get_extra_info("peername")
+		address = str(peername[0]) if peername else ""
+		
+		# Check this before looking at the database at all,
+		# so that a flood of login attempts can't keep the database busy.
+		if self.server_state.failed_logins_by_account.is_throttled(name_key) or self.server_state.failed_logins_by_address.is_throttled(address):
+			logger_login.warning("Rejecting login for account %r from %s - too many failed logins", account_name, address)
+			return base.NetError.too_many_failed_logins
+		
+		try:
+			account = await self.server_state.fetch_account(account_name)
+		except state.AccountNotFound:
+			logger_login.info("Login failed for account %r from %s - no such account", account_name, address)
+			success = False
+		else:
+			success = account.check_challenge_hash(account_name, client_challenge, self.client_state.server_challenge, challenge_hash)
+			if not success:
+				logger_login.info("Login failed for account %r from %s - wrong password", account_name, address)
+		
+		if not success:
+			self.server_state.failed_logins_by_account.record_failure(name_key)
+			self.server_state.failed_logins_by_address.record_failure(address)
+			# Intentionally don't tell the client whether the account exists.
+			return base.NetError.authentication_failed
+		
+		if AccountFlags.banned in AccountFlags(account.flags):
+			logger_login.info("Login denied for banned account %r from %s", account_name, address)
+			return base.NetError.login_denied
+		
+		# Only reset the per-account counter -
+		# otherwise an attacker could reset the per-address counter by logging in to their own account.
+		self.server_state.failed_logins_by_account.clear(name_key)
+		return account
 	
 	async def account_set_player_reply(self, trans_id: int, result: base.NetError) -> None:
 		logger_login.debug("Sending set player reply: transaction ID %d, result %r", trans_id, result)
@@ -45,6 +45,19 @@ CONNECT_HEADER_LENGTH = struct.calcsize("<BH") + CONNECT_HEADER_TAIL.size
 
 SETUP_MESSAGE_HEADER = struct.Struct("<BB")
 
+# Maximum number of bytes to take from the stream reader at once.
+# Everything that has arrived so far (up to this limit) is decrypted in one go
+# and then parsed from memory.
+RECEIVE_CHUNK_SIZE = 65536
+
+# Outgoing messages are queued and sent all at once at the end of the current event loop iteration.
+# Once the queue and the transport's buffer together reach the high water mark,
+# the queue is passed to the transport right away
+# and writing waits until the transport's buffer has drained below the low water mark
+# (the transport's limits are set to the same values by nagus.__main__.configure_transport).
+SEND_HIGH_WATER = 256 * 1024
+SEND_LOW_WATER = 64 * 1024
+
 
 SYSTEM_RANDOM = random.SystemRandom()
 
@@ -213,6 +226,187 @@ def pack_string_field(string: str, max_length: int = 0xffff) -> bytes:
 	return structs.UINT16.pack(utf_16_length) + encoded
 
 
+class ReceiveBuffer(object):
+	"""Holds data that has been received and decrypted, but not parsed yet.
+	
+	This class doesn't do any I/O by itself.
+	:class:`BaseMOULConnection` feeds it everything that arrives from the socket
+	(see :meth:`feed`)
+	and then parses messages directly from the buffered data,
+	so that the connection only has to wait when a message hasn't arrived completely yet.
+	"""
+	
+	_data: bytearray
+	_position: int
+	
+	def __init__(self) -> None:
+		super().__init__()
+		
+		self._data = bytearray()
+		self._position = 0
+	
+	def __len__(self) -> int:
+		"""Get the number of bytes that have been received, but not taken out of the buffer yet."""
+		
+		return len(self._data) - self._position
+	
+	def feed(self, data: typing.Union[bytes, bytearray, memoryview], decryption_state: typing.Optional[crypto.Rc4State]) -> None:
+		"""Decrypt ``data`` (if ``decryption_state`` is not ``None``) and append it to the buffer."""
+		
+		try:
+			if self._position:
+				# Drop the data that has already been parsed.
+				# Deleting from the start of a bytearray doesn't move the remaining data,
+				# so this is cheap.
+				del self._data[:self._position]
+				self._position = 0
+			start = len(self._data)
+			# bytearray over-allocates when growing,
+			# so appending many small chunks doesn't copy the buffered data every time.
+			self._data += data
+		except BufferError:
+			# Someone is still holding on to a view returned by take,
+			# which makes resizing the buffer impossible.
+			# Copy the unparsed data into a new buffer instead,
+			# so that the old views stay valid.
+			remaining = len(self)
+			new_data = bytearray(remaining + len(data))
+			new_data[:remaining] = memoryview(self._data)[self._position:]
+			new_data[remaining:] = data
+			self._data = new_data
+			self._position = 0
+			start = remaining
+		
+		if decryption_state is not None:
+			with memoryview(self._data) as view:
+				decryption_state.crypt_inplace(view[start:])
+	
+	def decrypt_pending(self, decryption_state: crypto.Rc4State) -> None:
+		"""Decrypt all data remaining in the buffer in place.
+		
+		This is needed if encryption is enabled while there is still unparsed data in the buffer,
+		which was fed into the buffer without decrypting it.
+		"""
+		
+		with memoryview(self._data) as view:
+			decryption_state.crypt_inplace(view[self._position:])
+	
+	def take(self, byte_count: int) -> memoryview:
+		"""Remove exactly ``byte_count`` bytes from the start of the buffer and return them.
+		
+		Raises :class:`ValueError` if not enough data is buffered ---
+		the caller is responsible for checking this beforehand.
+		"""
+		
+		if byte_count > len(self):
+			raise ValueError(f"Attempted to take {byte_count} bytes from receive buffer, but only {len(self)} bytes are available")
+		
+		start = self._position
+		self._position += byte_count
+		return memoryview(self._data)[start:self._position]
+	
+	def take_all(self) -> memoryview:
+		"""Remove all data from the buffer and return it."""
+		
+		return self.take(len(self))
+	
+	def unpack(self, st: struct.Struct) -> typing.Tuple[typing.Any, ...]:
+		"""Remove data from the start of the buffer and unpack it according to the struct ``st``.
+		
+		Like :meth:`take`,
+		this raises :class:`ValueError` if not enough data is buffered.
+		"""
+		
+		if st.size > len(self):
+			raise ValueError(f"Attempted to unpack {st.size} bytes from receive buffer, but only {len(self)} bytes are available")
+		
+		values = st.unpack_from(self._data, self._position)
+		self._position += st.size
+		return values
+
+
+class ProtocolWriter(object):
+	"""Minimal replacement for :class:`asyncio.StreamWriter`,
+	for connections that receive data directly from an :class:`asyncio.Protocol`
+	instead of through an :class:`asyncio.StreamReader`
+	(see :class:`nagus.__main__.MOULProtocol`).
+	
+	Only the parts of the :class:`asyncio.StreamWriter` API that NAGUS actually uses are implemented.
+	The protocol is responsible for forwarding flow control events
+	(:meth:`pause_writing`, :meth:`resume_writing`, :meth:`connection_lost`)
+	to this object.
+	"""
+	
+	transport: asyncio.Transport
+	_paused: bool
+	_connection_lost: bool
+	_drain_waiters: "typing.List[asyncio.Future[None]]"
+	_closed: "asyncio.Future[None]"
+	
+	def __init__(self, transport: asyncio.Transport) -> None:
+		super().__init__()
+		
+		self.transport = transport
+		self._paused = False
+		self._connection_lost = False
+		self._drain_waiters = []
+		self._closed = asyncio.get_running_loop().create_future()
+	
+	def get_extra_info(self, name: str, default: typing.Any = None) -> typing.Any:
+		return self.transport.get_extra_info(name, default)
+	
+	def writelines(self, data: typing.Iterable[typing.Union[bytes, bytearray, memoryview]]) -> None:
+		self.transport.writelines(data)
+	
+	def close(self) -> None:
+		self.transport.close()
+	
+	async def wait_closed(self) -> None:
+		await asyncio.shield(self._closed)
+	
+	async def drain(self) -> None:
+		"""Wait until the transport's write buffer has drained below its low water mark.
+		
+		Raises :class:`ConnectionResetError` if the connection has been lost,
+		like :meth:`asyncio.StreamWriter.drain` does.
+		"""
+		
+		if self._connection_lost:
+			raise ConnectionResetError("Connection lost")
+		
+		if self._paused:
+			waiter = asyncio.get_running_loop().create_future()
+			self._drain_waiters.append(waiter)
+			try:
+				await waiter
+			finally:
+				self._drain_waiters.remove(waiter)
+	
+	def _wake_drain_waiters(self, exc: typing.Optional[BaseException]) -> None:
+		for waiter in self._drain_waiters:
+			if not waiter.done():
+				if exc is None:
+					waiter.set_result(None)
+				else:
+					waiter.set_exception(exc)
+	
+	def pause_writing(self) -> None:
+		self._paused = True
+	
+	def resume_writing(self) -> None:
+		self._paused = False
+		self._wake_drain_waiters(None)
+	
+	def connection_lost(self) -> None:
+		self._connection_lost = True
+		self._wake_drain_waiters(ConnectionResetError("Connection lost"))
+		if not self._closed.done():
+			self._closed.set_result(None)
+
+
+Writer = typing.Union[asyncio.StreamWriter, ProtocolWriter]
+
+
 ConnT = typing.TypeVar("ConnT", bound="BaseMOULConnection")
 MessageHandler = typing.Callable[[ConnT], typing.Awaitable[None]]
 MessageHandlerT = typing.TypeVar("MessageHandlerT", bound=MessageHandler[typing.Any])
@@ -260,8 +454,9 @@ class BaseMOULConnection(object):
 	MESSAGE_HANDLERS: "typing.ClassVar[typing.Dict[int, MessageHandler[BaseMOULConnection]]]"
 	CONNECTION_TYPE: ConnectionType # to be set in each subclass
 	
-	reader: asyncio.StreamReader
-	writer: asyncio.StreamWriter
+	# None if the data is fed in by an asyncio.Protocol (see data_received).
+	reader: typing.Optional[asyncio.StreamReader]
+	writer: Writer
 	server_state: state.ServerState
 	dh_keys: typing.Optional[configuration.DHKeys]
 	
@@ -271,6 +466,12 @@ class BaseMOULConnection(object):
 	product_id: uuid.UUID
 	encryption_state_read: typing.Optional[crypto.Rc4State]
 	encryption_state_write: typing.Optional[crypto.Rc4State]
+	_receive_buffer: ReceiveBuffer
+	_receive_waiter: "typing.Optional[asyncio.Future[None]]"
+	_receive_eof: bool
+	_send_queue: typing.List[typing.Union[bytes, bytearray]]
+	_send_queue_size: int
+	_send_flush_handle: typing.Optional[asyncio.Handle]
 	
 	@classmethod
 	def __init_subclass__(cls) -> None:
@@ -301,7 +502,7 @@ class BaseMOULConnection(object):
 				
 				cls.MESSAGE_HANDLERS[message_type] = typing.cast(MessageHandler[BaseMOULConnection], attr)
 	
-	def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server_state: state.ServerState) -> None:
+	def __init__(self, reader: typing.Optional[asyncio.StreamReader], writer: Writer, server_state: state.ServerState) -> None:
 		super().__init__()
 		
 		self.reader = reader
@@ -310,6 +511,12 @@ class BaseMOULConnection(object):
 		
 		self.encryption_state_read = None
 		self.encryption_state_write = None
+		self._receive_buffer = ReceiveBuffer()
+		self._receive_waiter = None
+		self._receive_eof = False
+		self._send_queue = []
+		self._send_queue_size = 0
+		self._send_flush_handle = None
 	
 	def get_own_ipv4_address(self) -> ipaddress.IPv4Address:
 		sockname = self.writer.get_extra_info("sockname")
@@ -325,6 +532,75 @@ class BaseMOULConnection(object):
 		# TODO Do we care about supporting more than just IPv4 here?
 		return str(self.get_own_ipv4_address())
 	
+	async def _receive_more(self, byte_count: int) -> None:
+		"""Wait until at least ``byte_count`` bytes are available in the receive buffer.
+		
+		Raises :class:`~asyncio.IncompleteReadError` if the connection is closed before enough data arrives.
+		"""
+		
+		while len(self._receive_buffer) < byte_count:
+			if self.reader is None:
+				# The data is fed into the receive buffer by data_received,
+				# so there's nothing to do except wait for it.
+				if self._receive_eof:
+					raise asyncio.IncompleteReadError(bytes(self._receive_buffer.take_all()), byte_count)
+				
+				assert isinstance(self.writer, ProtocolWriter)
+				self._receive_waiter = asyncio.get_running_loop().create_future()
+				if not self.writer.transport.is_reading():
+					self.writer.transport.resume_reading()
+				try:
+					await self._receive_waiter
+				finally:
+					self._receive_waiter = None
+				continue
+			
+			missing = byte_count - len(self._receive_buffer)
+			if missing > RECEIVE_CHUNK_SIZE:
+				# Large message (e. g. a big SDL state) -
+				# wait for all of it at once,
+				# instead of growing the buffer in many small steps.
+				data = await self.reader.readexactly(missing)
+			else:
+				# Take everything that has arrived so far,
+				# so that any following messages can be parsed without waiting again.
+				data = await self.reader.read(RECEIVE_CHUNK_SIZE)
+				if not data:
+					raise asyncio.IncompleteReadError(bytes(self._receive_buffer.take_all()), byte_count)
+			
+			self._receive_buffer.feed(data, self.encryption_state_read)
+	
+	def _wake_receive_waiter(self) -> None:
+		if self._receive_waiter is not None and not self._receive_waiter.done():
+			self._receive_waiter.set_result(None)
+	
+	def data_received(self, data: typing.Union[bytes, bytearray, memoryview]) -> None:
+		"""Add newly received data to the receive buffer.
+		
+		This is only used if the connection has no :attr:`reader` ---
+		see :class:`nagus.__main__.MOULProtocol`.
+		"""
+		
+		self._receive_buffer.feed(data, self.encryption_state_read)
+		
+		if self._receive_waiter is not None:
+			self._wake_receive_waiter()
+		elif len(self._receive_buffer) >= RECEIVE_CHUNK_SIZE:
+			# Nobody is waiting for the data right now,
+			# so stop receiving more until it's actually needed.
+			assert isinstance(self.writer, ProtocolWriter)
+			self.writer.transport.pause_reading()
+	
+	def eof_received(self) -> None:
+		"""Signal that the client won't send any more data.
+		
+		Like :meth:`data_received`,
+		this is only used if the connection has no :attr:`reader`.
+		"""
+		
+		self._receive_eof = True
+		self._wake_receive_waiter()
+	
 	async def read(self, byte_count: int) -> bytes:
 		"""Read ``byte_count`` bytes from the socket and raise :class:`~asyncio.IncompleteReadError` if too few bytes are read (i. e. the connection was disconnected prematurely).
 		
@@ -332,26 +608,105 @@ class BaseMOULConnection(object):
 		the data is automatically decrypted after reading.
 		"""
 		
-		data = await self.reader.readexactly(byte_count)
-		if self.encryption_state_read is not None:
-			data = self.encryption_state_read.crypt(data)
-		return data
+		return bytes(await self.read_view(byte_count))
 	
-	async def write(self, data: bytes) -> None:
-		"""Write ``data`` to the socket.
+	async def read_view(self, byte_count: int) -> memoryview:
+		"""Like :meth:`read`,
+		but return a :class:`memoryview` into the receive buffer
+		instead of copying the data into a new :class:`bytes` object.
+		
+		Data is received and decrypted in large chunks,
+		so this only has to wait for the socket if the requested data hasn't been received yet.
+		"""
+		
+		if len(self._receive_buffer) < byte_count:
+			await self._receive_more(byte_count)
+		return self._receive_buffer.take(byte_count)
+	
+	def flush_send_queue(self) -> None:
+		"""Immediately pass all queued outgoing data to the writer in a single write call.
+		
+		This is normally called automatically at the end of the event loop iteration in which the data was queued
+		(see :meth:`write_chunks`).
+		"""
+		
+		if self._send_flush_handle is not None:
+			self._send_flush_handle.cancel()
+			self._send_flush_handle = None
+		
+		if self._send_queue:
+			queue = self._send_queue
+			self._send_queue = []
+			self._send_queue_size = 0
+			self.writer.writelines(queue)
+	
+	async def write_chunks(self, chunks: typing.Sequence[typing.Union[bytes, bytearray, memoryview]]) -> None:
+		"""Write all ``chunks`` to the socket at once.
 		
 		If encryption has been set up for this connection,
-		the data is automatically encrypted before writing.
+		the chunks are encrypted directly into a single output buffer before writing,
+		so the caller doesn't need to concatenate them into a single :class:`bytes` object first.
+		
+		The data isn't written to the socket right away,
+		but added to a per-connection queue,
+		which is flushed in a single write call at the end of the current event loop iteration
+		(or earlier, if the queue and the transport's buffer together grow past :data:`SEND_HIGH_WATER`).
+		This way,
+		many messages sent back-to-back
+		(e. g. the SDL states sent when linking into an age)
+		don't each cause a separate system call.
+		The order of messages is always preserved
+		and the chunks passed in a single call are never split up.
 		
 		The exact implementation might change in the future ---
 		it seems that Uru expects certain data to arrive as a single packet,
 		even though TCP doesn't guarantee that packet boundaries are preserved in transmission.
 		"""
 		
-		if self.encryption_state_write is not None:
-			data = self.encryption_state_write.crypt(data)
-		self.writer.write(data)
+		# drain only looks at the transport's buffer,
+		# so pass the queue on to the transport first
+		# if the data that's still queued would take it past the high water mark.
+		if self._send_queue and self._send_queue_size + self.writer.transport.get_write_buffer_size() >= SEND_HIGH_WATER:
+			self.flush_send_queue()
+		
+		# Wait here if the transport's buffer is full
+		# and raise ConnectionResetError if the connection has already been lost,
+		# before anything is added to the queue.
 		await self.writer.drain()
+		
+		if self.encryption_state_write is not None:
+			out = bytearray(sum(len(chunk) for chunk in chunks))
+			out_view = memoryview(out)
+			offset = 0
+			for chunk in chunks:
+				self.encryption_state_write.crypt_into(chunk, out_view[offset:offset + len(chunk)])
+				offset += len(chunk)
+			# The writer may hold on to the buffer if it can't send everything immediately,
+			# so the output buffer must never be reused.
+			self._send_queue.append(out)
+			self._send_queue_size += len(out)
+		else:
+			for chunk in chunks:
+				# The caller may modify or reuse mutable buffers after this method returns,
+				# so they have to be copied before they're queued.
+				self._send_queue.append(chunk if isinstance(chunk, bytes) else bytes(chunk))
+				self._send_queue_size += len(chunk)
+		
+		if self._send_queue_size >= SEND_HIGH_WATER:
+			self.flush_send_queue()
+		elif self._send_flush_handle is None:
+			self._send_flush_handle = asyncio.get_running_loop().call_soon(self.flush_send_queue)
+	
+	async def write(self, data: bytes) -> None:
+		"""Write ``data`` to the socket.
+		
+		If encryption has been set up for this connection,
+		the data is automatically encrypted before writing.
+		
+		This is a shortcut for :meth:`write_chunks` with a single chunk.
+		"""
+		
+		await self.write_chunks([data])
 	
 	async def read_unpack(self, st: struct.Struct) -> typing.Tuple[typing.Any, ...]:
 		"""Read and unpack data from the socket according to the struct ``st``.
@@ -360,16 +715,25 @@ class BaseMOULConnection(object):
 		so variable-sized structs cannot be used with this method.
 		"""
 		
-		return st.unpack(await self.read(st.size))
+		if len(self._receive_buffer) < st.size:
+			await self._receive_more(st.size)
+		return self._receive_buffer.unpack(st)
 	
 	async def read_string_field(self, max_length: int = 0xffff) -> str:
 		(length,) = await self.read_unpack(structs.UINT16)
 		if length >= max_length:
 			raise ProtocolError(f"Client sent string of length {length} in string field with maximum length {max_length}")
-		return (await self.read(2 * length)).decode("utf-16-le")
+		return str(await self.read_view(2 * length), "utf-16-le")
 	
-	async def write_message(self, message_type: int, data: bytes) -> None:
-		await self.write(structs.UINT16.pack(message_type) + data)
+	async def write_message(self, message_type: int, *chunks: typing.Union[bytes, bytearray, memoryview]) -> None:
+		"""Write a message with the given type and data to the socket.
+		
+		The message data may be passed as multiple chunks,
+		which are written as if they were concatenated
+		(see :meth:`write_chunks`).
+		"""
+		
+		await self.write_chunks([structs.UINT16.pack(message_type), *chunks])
 	
 	async def read_connect_packet_header(self) -> None:
 		"""Read and unpack the remaining connect packet header and store the unpacked information.
@@ -430,17 +794,26 @@ class BaseMOULConnection(object):
 				dh_y = int.from_bytes(data, "little")
 				logger_crypt.debug("Received y from client: %#x", dh_y)
 				
-				seed = random.randrange(2**56)
-				seed_data = seed.to_bytes(7, "little")
-				await self.write(SETUP_MESSAGE_HEADER.pack(SetupMessageType.srv2cli_encrypt.value, 9) + seed_data)
-				if logger_crypt.isEnabledFor(logging.DEBUG):
-					logger_crypt.debug("Sent generated seed to client: %s", seed_data.hex())
+				# Reserve a place in the handshake queue before sending the seed,
+				# so that a connection that's rejected because the queue is full
+				# doesn't receive a seed first.
+				with self.server_state.handshake_executor.reserve():
+					seed = random.randrange(2**56)
+					seed_data = seed.to_bytes(7, "little")
+					await self.write(SETUP_MESSAGE_HEADER.pack(SetupMessageType.srv2cli_encrypt.value, 9) + seed_data)
+					if logger_crypt.isEnabledFor(logging.DEBUG):
+						logger_crypt.debug("Sent generated seed to client: %s", seed_data.hex())
+					
+					shared_secret = await self.server_state.handshake_executor.dh_pow_reserved(dh_y, self.dh_keys.a, self.dh_keys.n)
 				
-				session_key_data = (seed ^ (pow(dh_y, self.dh_keys.a, self.dh_keys.n) & (2**56 - 1))).to_bytes(7, "little")
+				session_key_data = (seed ^ (shared_secret & (2**56 - 1))).to_bytes(7, "little")
 				if logger_crypt.isEnabledFor(logging.DEBUG):
 					logger_crypt.debug("Agreed on RC4 session key: %s", session_key_data.hex())
 				self.encryption_state_read = crypto.Rc4State(session_key_data)
 				self.encryption_state_write = crypto.Rc4State(session_key_data)
+				# The client shouldn't send anything else before it receives the seed,
+				# but if it did, that data has already been buffered without decrypting it.
+				self._receive_buffer.decrypt_pending(self.encryption_state_read)
 		else:
 			# H'uru internal client sent an empty y value to explicitly request no encryption.
 			if self.server_state.config.server_encryption == configuration.Encryption.force:
@@ -463,16 +836,16 @@ class BaseMOULConnection(object):
 		so we have to abort the connection.
 		"""
 		
-		try:
-			# For debugging,
-			# try to read a bit of data after it without waiting too long.
-			data = await asyncio.wait_for(self.reader.read(64), 0.1)
-		except asyncio.TimeoutError as exc:
-			raise ProtocolError(f"Client sent unsupported message type {message_type} and no data quickly following it")
-		else:
-			if self.encryption_state_read is not None:
-				data = self.encryption_state_read.crypt(data)
-			raise ProtocolError(f"Client sent unsupported message type {message_type} - next few bytes: {data!r}")
+		if not self._receive_buffer:
+			try:
+				# For debugging,
+				# try to read a bit of data after it without waiting too long.
+				await asyncio.wait_for(self._receive_more(1), 0.1)
+			except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+				raise ProtocolError(f"Client sent unsupported message type {message_type} and no data quickly following it")
+		
+		data = bytes(self._receive_buffer.take_all()[:64])
+		raise ProtocolError(f"Client sent unsupported message type {message_type} - next few bytes: {data!r}")
 	
 	async def handle_message(self, message_type: int) -> None:
 		"""Dispatch a message to the appropriate handler based on its type."""
@@ -500,4 +873,8 @@ class BaseMOULConnection(object):
 				(message_type,) = await self.read_unpack(structs.UINT16)
 				await self.handle_message(message_type)
 		finally:
+			# Make sure that any last messages
+			# (e. g. the reason why the client is being kicked)
+			# are sent before the connection is closed.
+			self.flush_send_queue()
 			await self.handle_disconnect()
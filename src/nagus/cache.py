@@ -0,0 +1,83 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Generic in-memory caches that don't depend on any other part of NAGUS."""
+
+
+import collections
+import typing
+
+
+_K = typing.TypeVar("_K")
+_V = typing.TypeVar("_V")
+
+
+class LruCache(typing.Generic[_K, _V]):
+	"""Simple dictionary-like cache whose entries add up to at most ``max_size``.
+	
+	By default,
+	every entry counts as 1,
+	so ``max_size`` is the maximum number of entries.
+	If ``size_of`` is given,
+	it's called for every value to determine how much it counts instead,
+	e. g. to limit the cache by the total length of its values in bytes.
+	
+	When the cache is full,
+	adding another entry discards the least recently used ones.
+	"""
+	
+	max_size: int
+	size_of: typing.Optional[typing.Callable[[_V], int]]
+	total_size: int
+	_entries: "collections.OrderedDict[_K, typing.Tuple[_V, int]]"
+	
+	def __init__(self, max_size: int, size_of: typing.Optional[typing.Callable[[_V], int]] = None) -> None:
+		super().__init__()
+		
+		self.max_size = max_size
+		self.size_of = size_of
+		self.total_size = 0
+		self._entries = collections.OrderedDict()
+	
+	def __len__(self) -> int:
+		return len(self._entries)
+	
+	def get(self, key: _K) -> typing.Optional[_V]:
+		try:
+			value, _ = self._entries[key]
+		except KeyError:
+			return None
+		self._entries.move_to_end(key)
+		return value
+	
+	def put(self, key: _K, value: _V) -> None:
+		self.discard(key)
+		size = 1 if self.size_of is None else self.size_of(value)
+		self._entries[key] = (value, size)
+		self.total_size += size
+		while self.total_size > self.max_size:
+			_, (_, evicted_size) = self._entries.popitem(last=False)
+			self.total_size -= evicted_size
+	
+	def discard(self, key: _K) -> None:
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			self.total_size -= entry[1]
+	
+	def clear(self) -> None:
+		self._entries.clear()
+		self.total_size = 0
@@ -0,0 +1,140 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Compresses and decompresses the zlib data in stream messages (e. g. SDL blobs) outside of the event loop.
+
+Most stream messages are small enough that compressing them takes no noticeable time.
+Large SDL blobs however can take several milliseconds to compress,
+and sending the initial state of an age instance to a client may involve hundreds of them.
+Doing this on the event loop would block all other connections in the meantime.
+zlib releases the GIL while it's working,
+so running large jobs in a thread pool is enough to keep the event loop responsive.
+"""
+
+
+import asyncio
+import concurrent.futures
+import hashlib
+import typing
+import zlib
+
+from . import cache
+
+
+# Payloads smaller than this are cheap to compress even at the highest level.
+SMALL_PAYLOAD_SIZE = 4 * 1024
+# Payloads at least this large are compressed at the fastest level,
+# unless the recipient isn't receiving data fast enough.
+LARGE_PAYLOAD_SIZE = 64 * 1024
+# Send queue pressure (between 0 and 1) from which on bandwidth is considered more important than CPU time.
+HIGH_PRESSURE = 0.5
+
+
+def compression_level(size: int, pressure: float = 0.0) -> int:
+	"""Choose a zlib compression level for a payload of ``size`` bytes.
+	
+	:param pressure: How full the recipient's send queue is,
+		from 0 (empty) to 1 (full).
+		A client that isn't receiving its data fast enough
+		benefits more from smaller messages than from a faster server.
+	"""
+	
+	if size < SMALL_PAYLOAD_SIZE or pressure >= HIGH_PRESSURE:
+		return 9
+	elif size < LARGE_PAYLOAD_SIZE:
+		return 6
+	else:
+		return 1
+
+
+class CompressionService(object):
+	"""Thread pool and cache for zlib compression of stream message data.
+	
+	Jobs with at least ``offload_threshold`` bytes of input run in a pool of ``workers`` threads.
+	Smaller jobs run directly on the event loop,
+	because handing them to a thread would cost more than it saves.
+	If ``workers`` is 0,
+	all jobs run directly on the event loop.
+	
+	Up to ``cache_size`` bytes of compressed output are cached,
+	keyed by a hash of the input and the compression level,
+	so that identical blobs (e. g. the same default SDL state for many objects or age instances)
+	are only compressed once.
+	The least recently used outputs are discarded first.
+	"""
+	
+	workers: int
+	offload_threshold: int
+	
+	offloaded: int
+	cache_hits: int
+	cache_misses: int
+	
+	_executor: typing.Optional[concurrent.futures.ThreadPoolExecutor]
+	_cache: "cache.LruCache[typing.Tuple[int, bytes], bytes]"
+	
+	def __init__(self, workers: int, offload_threshold: int, cache_size: int) -> None:
+		super().__init__()
+		
+		self.workers = workers
+		self.offload_threshold = offload_threshold
+		
+		self.offloaded = 0
+		self.cache_hits = 0
+		self.cache_misses = 0
+		
+		if workers > 0:
+			self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="nagus-compression")
+		else:
+			self._executor = None
+		self._cache = cache.LruCache(cache_size, len)
+	
+	def describe(self) -> str:
+		return f"{self.workers} worker threads, {len(self._cache)} cached ({self._cache.total_size} bytes), {self.cache_hits} cache hits, {self.cache_misses} cache misses, {self.offloaded} jobs offloaded"
+	
+	async def _run(self, func: typing.Callable[..., bytes], data: bytes, *args: typing.Any) -> bytes:
+		if self._executor is None or len(data) < self.offload_threshold:
+			return func(data, *args)
+		
+		self.offloaded += 1
+		return await asyncio.get_running_loop().run_in_executor(self._executor, func, data, *args)
+	
+	async def compress(self, data: bytes, pressure: float = 0.0) -> bytes:
+		"""Compress ``data`` with zlib,
+		at a level chosen based on its size and ``pressure``
+		(see :func:`compression_level`).
+		"""
+		
+		level = compression_level(len(data), pressure)
+		key = (level, hashlib.blake2b(data, digest_size=16).digest())
+		compressed = self._cache.get(key)
+		if compressed is not None:
+			self.cache_hits += 1
+			return compressed
+		
+		self.cache_misses += 1
+		compressed = await self._run(zlib.compress, data, level)
+		self._cache.put(key, compressed)
+		return compressed
+	
+	async def decompress(self, data: bytes) -> bytes:
+		return await self._run(zlib.decompress, data)
+	
+	def shutdown(self) -> None:
+		if self._executor is not None:
+			self._executor.shutdown(wait=False)
+			self._executor = None
@@ -67,6 +67,13 @@ def parse_int(s: str) -> int:
 		raise ConfigError(f"Invalid integer value: {exc!s}")
 
 
+def parse_float(s: str) -> float:
+	try:
+		return float(s)
+	except ValueError as exc:
+		raise ConfigError(f"Invalid number: {exc!s}")
+
+
 def parse_ipv4_address(s: str) -> ipaddress.IPv4Address:
 	try:
 		return ipaddress.IPv4Address(s)
@@ -97,12 +104,22 @@ class Encryption(enum.Enum):
 	none = "none"
 
 
+class Transport(enum.Enum):
+	streams = "streams"
+	protocol = "protocol"
+
+
 class SendServerCaps(enum.Enum):
 	always = "always"
 	compatible = "compatible"
 	never = "never"
 
 
+class Authentication(enum.Enum):
+	accounts = "accounts"
+	none = "none"
+
+
 class ParsePlMessages(enum.Enum):
 	necessary = "necessary"
 	known = "known"
@@ -240,6 +257,9 @@ class Configuration(object):
 	server_port: int
 	server_encryption: typing.Optional[Encryption]
 	server_address_for_client: typing.Optional[ipaddress.IPv4Address]
+	server_handshake_workers: int
+	server_handshake_max_pending: int
+	server_transport: Transport
 	
 	server_status_enable: bool
 	server_status_listen_address: str
@@ -260,12 +280,27 @@ class Configuration(object):
 	server_auth_send_server_address: bool
 	server_auth_address_for_client: typing.Optional[ipaddress.IPv4Address]
 	server_auth_disconnected_client_timeout: int
+	server_auth_authentication: Authentication
+	server_auth_account_cache_size: int
+	server_auth_max_failed_logins_per_account: int
+	server_auth_max_failed_logins_per_address: int
+	server_auth_failed_login_window: int
 	
 	server_game_key_g: int
 	server_game_key_n: typing.Optional[int]
 	server_game_key_a: typing.Optional[int]
 	server_game_address_for_client: typing.Optional[ipaddress.IPv4Address]
 	server_game_parse_pl_messages: ParsePlMessages
+	server_game_max_queued_messages: int
+	server_game_unreliable_send_deadline: float
+	server_game_lock_lease_time: int
+	server_game_sdl_save_interval: int
+	server_game_max_volatile_sdl_size: int
+	server_game_compression_workers: int
+	server_game_compression_offload_threshold: int
+	server_game_compression_cache_size: int
+	server_game_pl_message_sample_rate: float
+	server_game_pl_message_sample_queue_size: int
 	
 	# The following variables aren't set directly from configuration options,
 	# but are derived from multiple options after some simple checks.
@@ -324,6 +359,19 @@ class Configuration(object):
 				raise ConfigError(f"Invalid value for option: {exc}")
 		elif option == ("server", "address_for_client"):
 			self.server_address_for_client = parse_ipv4_address(value) if value else None
+		elif option == ("server", "handshake_workers"):
+			self.server_handshake_workers = parse_int(value)
+			if self.server_handshake_workers < 0:
+				raise ConfigError(f"Worker count must not be negative: {self.server_handshake_workers}")
+		elif option == ("server", "handshake_max_pending"):
+			self.server_handshake_max_pending = parse_int(value)
+			if self.server_handshake_max_pending < 1:
+				raise ConfigError(f"Maximum pending handshake count must be at least 1: {self.server_handshake_max_pending}")
+		elif option == ("server", "transport"):
+			try:
+				self.server_transport = Transport(value)
+			except ValueError as exc:
+				raise ConfigError(f"Invalid value for option: {exc}")
 		elif option == ("server", "status", "enable"):
 			self.server_status_enable = parse_bool(value)
 		elif option == ("server", "status", "listen_address"):
@@ -363,6 +411,27 @@ class Configuration(object):
 			self.server_auth_disconnected_client_timeout = parse_int(value)
 			if self.server_auth_disconnected_client_timeout < 0:
 				raise ConfigError(f"Timeout must not be negative: {self.server_auth_disconnected_client_timeout}")
+		elif option == ("server", "auth", "authentication"):
+			try:
+				self.server_auth_authentication = Authentication(value)
+			except ValueError as exc:
+				raise ConfigError(f"Invalid value for option: {exc}")
+		elif option == ("server", "auth", "account_cache_size"):
+			self.server_auth_account_cache_size = parse_int(value)
+			if self.server_auth_account_cache_size < 0:
+				raise ConfigError(f"Cache size must not be negative: {self.server_auth_account_cache_size}")
+		elif option == ("server", "auth", "max_failed_logins_per_account"):
+			self.server_auth_max_failed_logins_per_account = parse_int(value)
+			if self.server_auth_max_failed_logins_per_account < 0:
+				raise ConfigError(f"Failed login limit must not be negative: {self.server_auth_max_failed_logins_per_account}")
+		elif option == ("server", "auth", "max_failed_logins_per_address"):
+			self.server_auth_max_failed_logins_per_address = parse_int(value)
+			if self.server_auth_max_failed_logins_per_address < 0:
+				raise ConfigError(f"Failed login limit must not be negative: {self.server_auth_max_failed_logins_per_address}")
+		elif option == ("server", "auth", "failed_login_window"):
+			self.server_auth_failed_login_window = parse_int(value)
+			if self.server_auth_failed_login_window < 0:
+				raise ConfigError(f"Time window must not be negative: {self.server_auth_failed_login_window}")
 		elif option == ("server", "game", "key_g"):
 			self.server_game_key_g = parse_int(value)
 		elif option == ("server", "game", "key_n"):
@@ -376,6 +445,46 @@ class Configuration(object):
 				self.server_game_parse_pl_messages = ParsePlMessages(value)
 			except ValueError as exc:
 				raise ConfigError(f"Invalid value for option: {exc}")
+		elif option == ("server", "game", "max_queued_messages"):
+			self.server_game_max_queued_messages = parse_int(value)
+			if self.server_game_max_queued_messages < 1:
+				raise ConfigError(f"Maximum queued message count must be at least 1: {self.server_game_max_queued_messages}")
+		elif option == ("server", "game", "unreliable_send_deadline"):
+			self.server_game_unreliable_send_deadline = parse_float(value)
+			if self.server_game_unreliable_send_deadline < 0:
+				raise ConfigError(f"Unreliable send deadline must not be negative: {self.server_game_unreliable_send_deadline}")
+		elif option == ("server", "game", "lock_lease_time"):
+			self.server_game_lock_lease_time = parse_int(value)
+			if self.server_game_lock_lease_time < 0:
+				raise ConfigError(f"Lease time must not be negative: {self.server_game_lock_lease_time}")
+		elif option == ("server", "game", "sdl_save_interval"):
+			self.server_game_sdl_save_interval = parse_int(value)
+			if self.server_game_sdl_save_interval < 0:
+				raise ConfigError(f"SDL save interval must not be negative: {self.server_game_sdl_save_interval}")
+		elif option == ("server", "game", "max_volatile_sdl_size"):
+			self.server_game_max_volatile_sdl_size = parse_int(value)
+			if self.server_game_max_volatile_sdl_size < 0:
+				raise ConfigError(f"Maximum non-persistent SDL state size must not be negative: {self.server_game_max_volatile_sdl_size}")
+		elif option == ("server", "game", "compression_workers"):
+			self.server_game_compression_workers = parse_int(value)
+			if self.server_game_compression_workers < 0:
+				raise ConfigError(f"Worker count must not be negative: {self.server_game_compression_workers}")
+		elif option == ("server", "game", "compression_offload_threshold"):
+			self.server_game_compression_offload_threshold = parse_int(value)
+			if self.server_game_compression_offload_threshold < 0:
+				raise ConfigError(f"Compression offload threshold must not be negative: {self.server_game_compression_offload_threshold}")
+		elif option == ("server", "game", "compression_cache_size"):
+			self.server_game_compression_cache_size = parse_int(value)
+			if self.server_game_compression_cache_size < 0:
+				raise ConfigError(f"Compression cache size must not be negative: {self.server_game_compression_cache_size}")
+		elif option == ("server", "game", "pl_message_sample_rate"):
+			self.server_game_pl_message_sample_rate = parse_float(value)
+			if not 0 <= self.server_game_pl_message_sample_rate <= 1:
+				raise ConfigError(f"Sample rate must be between 0 and 1: {self.server_game_pl_message_sample_rate}")
+		elif option == ("server", "game", "pl_message_sample_queue_size"):
+			self.server_game_pl_message_sample_queue_size = parse_int(value)
+			if self.server_game_pl_message_sample_queue_size <= 0:
+				raise ConfigError(f"Sample queue size must be positive: {self.server_game_pl_message_sample_queue_size}")
 		else:
 			# Logging might not be set up here yet, so use stderr instead.
 			print("Warning: Ignoring unknown config option " + repr(".".join(option)), file=sys.stderr)
@@ -440,6 +549,7 @@ class Configuration(object):
 					"nagus.auth_server.vault.notify": {"level": "INFO"},
 					"nagus.base": {"level": "INFO"},
 					"nagus.console": {"level": "INFO"},
+					"nagus.game_server.forward": {"level": "INFO"},
 					"nagus.game_server.join": {"level": "INFO"},
 					"nagus.game_server.net_message": {"level": "INFO"},
 					"nagus.game_server.paging": {"level": "INFO"},
@@ -467,6 +577,12 @@ class Configuration(object):
 			self.server_port = structs.DEFAULT_SERVER_PORT
 		if not hasattr(self, "server_address_for_client"):
 			self.server_address_for_client = None
+		if not hasattr(self, "server_handshake_workers"):
+			self.server_handshake_workers = 0
+		if not hasattr(self, "server_handshake_max_pending"):
+			self.server_handshake_max_pending = 1000
+		if not hasattr(self, "server_transport"):
+			self.server_transport = Transport.streams
 		if not hasattr(self, "server_status_enable"):
 			self.server_status_enable = True
 		if not hasattr(self, "server_status_listen_address"):
@@ -504,6 +620,16 @@ class Configuration(object):
 				self.server_gatekeeper_auth_server_address = str(self.server_auth_address_for_client)
 		if not hasattr(self, "server_auth_disconnected_client_timeout"):
 			self.server_auth_disconnected_client_timeout = 30 if self.server_auth_send_server_address else 0
+		if not hasattr(self, "server_auth_authentication"):
+			self.server_auth_authentication = Authentication.none
+		if not hasattr(self, "server_auth_account_cache_size"):
+			self.server_auth_account_cache_size = 1000
+		if not hasattr(self, "server_auth_max_failed_logins_per_account"):
+			self.server_auth_max_failed_logins_per_account = 5
+		if not hasattr(self, "server_auth_max_failed_logins_per_address"):
+			self.server_auth_max_failed_logins_per_address = 20
+		if not hasattr(self, "server_auth_failed_login_window"):
+			self.server_auth_failed_login_window = 300
 		if not hasattr(self, "server_game_key_g"):
 			self.server_game_key_g = structs.DEFAULT_GAME_DH_G
 		if not hasattr(self, "server_game_key_n"):
@@ -514,6 +640,26 @@ class Configuration(object):
 			self.server_game_address_for_client = self.server_address_for_client
 		if not hasattr(self, "server_game_parse_pl_messages"):
 			self.server_game_parse_pl_messages = ParsePlMessages.necessary
+		if not hasattr(self, "server_game_max_queued_messages"):
+			self.server_game_max_queued_messages = 10000
+		if not hasattr(self, "server_game_unreliable_send_deadline"):
+			self.server_game_unreliable_send_deadline = 2.0
+		if not hasattr(self, "server_game_lock_lease_time"):
+			self.server_game_lock_lease_time = 120
+		if not hasattr(self, "server_game_sdl_save_interval"):
+			self.server_game_sdl_save_interval = 30
+		if not hasattr(self, "server_game_max_volatile_sdl_size"):
+			self.server_game_max_volatile_sdl_size = 1024 * 1024
+		if not hasattr(self, "server_game_compression_workers"):
+			self.server_game_compression_workers = 2
+		if not hasattr(self, "server_game_compression_offload_threshold"):
+			self.server_game_compression_offload_threshold = 16 * 1024
+		if not hasattr(self, "server_game_compression_cache_size"):
+			self.server_game_compression_cache_size = 16 * 1024 * 1024
+		if not hasattr(self, "server_game_pl_message_sample_rate"):
+			self.server_game_pl_message_sample_rate = 0.0
+		if not hasattr(self, "server_game_pl_message_sample_queue_size"):
+			self.server_game_pl_message_sample_queue_size = 1000
 		
 		if not hasattr(self, "server_encryption"):
 			have_keys = (
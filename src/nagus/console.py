@@ -30,6 +30,8 @@ from . import __version__
 from . import auth_server
 from . import base
 from . import client_config_gen
+from . import configuration
+from . import game_server
 from . import state
 
 
@@ -41,8 +43,12 @@ HELP_TEXT = """Available commands:
 	help, ? - Display this help text
 	version - Display the server's version number
 	client_config export [PATH] - Generate configuration files for clients to connect to this server (server.ini for H'uru and source patch for CWE/OpenUru)
+	account create NAME PASSWORD [UUID] - Create a new account (optionally with a specific account UUID)
+	account password NAME PASSWORD - Change an account's password
 	kick token|address|account|avatar WHO - Forcibly disconnect a client from the server
 	list - List all clients connected to the server
+	ages - List all age instances that clients are currently in (and SDL compression and send queue statistics)
+	plmessages - Show statistics about the plMessages inspected in the background (option server.game.pl_message_sample_rate)
 	loglevel CATEGORY [LEVEL_NAME] - Display or change the log level for a category of log messages (or category "root" for all)
 	status [STATUS_MESSAGE] [MORE_LINES ...] - Display or change the status message (option server.status.message)
 """
@@ -103,6 +109,42 @@ async def run_command(server_state: state.ServerState, command: str, args: typin
 			print(f"Successfully exported client configuration as server.ini and cwe_server_config.patch in {dest_dir}")
 		else:
 			raise UserError(f"Unknown subcommand: {args[0]!r} (expected export)")
+	elif command == "account":
+		if not args:
+			raise UserError("Missing subcommand (expected create or password)")
+		
+		if args[0] == "create":
+			if len(args) not in {3, 4}:
+				raise UserError(f"Expected 3 or 4 arguments, not {len(args)}")
+			
+			try:
+				account_uuid = uuid.UUID(args[3]) if len(args) == 4 else None
+			except ValueError as exc:
+				raise UserError(exc)
+			
+			try:
+				account_uuid = await server_state.create_account(args[1], args[2], auth_server.AccountFlags.user, auth_server.AccountBillingType.paid_subscriber, account_uuid)
+			except ValueError as exc:
+				raise UserError(exc)
+			except state.AccountAlreadyExists:
+				raise UserError(f"An account named {args[1]!r} (or a different one with the same UUID) already exists")
+			
+			print(f"Created account {args[1]!r} with UUID {account_uuid}")
+			if len(args[2]) > 15:
+				print("Note: Clients only send the first 15 characters of the password, so the rest is ignored")
+			if server_state.config.server_auth_authentication != configuration.Authentication.accounts:
+				print("Note: Accounts are currently not checked when logging in - set server.auth.authentication to accounts to enable this")
+		elif args[0] == "password":
+			_check_arg_count(3)
+			
+			try:
+				await server_state.set_account_password(args[1], args[2])
+			except state.AccountNotFound:
+				raise UserError(f"There is no account named {args[1]!r}")
+			
+			print(f"Changed password for account {args[1]!r}")
+		else:
+			raise UserError(f"Unknown subcommand: {args[0]!r} (expected create or password)")
 	elif command == "kick":
 		_check_arg_count(2)
 		
@@ -184,6 +226,37 @@ async def run_command(server_state: state.ServerState, command: str, args: typin
 			if hasattr(conn.client_state, "cleanup_handle"):
 				desc += " (recently disconnected)"
 			print(desc)
+	elif command == "ages":
+		_check_arg_count(0)
+		
+		print(f"SDL compression: {server_state.compression.describe()}")
+		if not server_state.age_instance_rooms:
+			print("There are no age instances with clients in them")
+			return
+		
+		print(f"There are {len(server_state.age_instance_rooms)} age instances with clients in them:")
+		for age_node_id, room in server_state.age_instance_rooms.items():
+			print(f"{age_node_id}: {len(room.members)} clients (avatars {', '.join(str(ki_number) for ki_number in room.members)})")
+			print(f"\tLocks: {room.locks.describe()}")
+			print(f"\tSDL states: {len(room.sdl_states.object_states)} cached, {room.sdl_states.dirty_count} unsaved")
+			print(f"\tNon-persistent SDL states: {len(room.volatile_sdl_states)} ({room.volatile_sdl_states.size} bytes, {room.volatile_sdl_states.evicted} discarded because of the memory limit)")
+			print(f"\tLoaded clones: {len(room.clones)}")
+			send_queues = [member.send_queue for member in room.members.values()]
+			print(f"\tSend queues: {sum(len(queue) for queue in send_queues)} messages waiting, {sum(queue.coalesced for queue in send_queues)} replaced by newer state updates")
+			for priority, statistics in zip(game_server.SendPriority, room.send_statistics()):
+				print(f"\t\t{priority.name}: {statistics.describe()}")
+	elif command == "plmessages":
+		_check_arg_count(0)
+		
+		inspector = server_state.pl_message_inspector
+		print(f"Background plMessage inspection: {inspector.describe()}")
+		if not inspector.counts:
+			print("No plMessages have been inspected yet")
+			return
+		
+		print(f"Inspected {sum(inspector.counts.values())} plMessages:")
+		for description, count in inspector.counts.most_common():
+			print(f"{count:>8} {description}")
 	elif command == "loglevel":
 		if len(args) not in {1, 2}:
 			raise UserError(f"Expected 1 or 2 arguments, not {len(args)}")
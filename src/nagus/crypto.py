@@ -23,11 +23,16 @@ so we have to implement them by hand ourselves.
 
 
 import array
+import functools
 import hashlib
+import importlib
+import re
 import struct
 import typing
 
 
+EMAIL_ACCOUNT_NAME_REGEX = re.compile(r".+@(?P<domain>.+)\.(?P<tld>.+)")
+
 SHA_0_1_CHUNK = struct.Struct(">16I")
 SHA_0_1_MESSAGE_LENGTH = struct.Struct(">Q")
 SHA_0_1_HASH = struct.Struct(">5I")
@@ -128,7 +133,12 @@ def _slow_sha_0_1(data: bytes, *, sha_1: bool) -> bytes:
 
 
 def slow_sha_0(data: bytes) -> bytes:
-	"""Slow pure Python implementation of SHA-0."""
+	"""Slow pure Python implementation of SHA-0.
+	
+	You should use :func:`sha_0` instead,
+	which is faster.
+	This implementation is only kept as a reference for testing.
+	"""
 	
 	return _slow_sha_0_1(data, sha_1=False)
 
@@ -143,6 +153,148 @@ def slow_sha_1(data: bytes) -> bytes:
 	return _slow_sha_0_1(data, sha_1=True)
 
 
+@functools.lru_cache(maxsize=None)
+def _sha_0_1_padding(length: int) -> bytes:
+	"""Get the padding that needs to be appended to a message of ``length`` bytes before hashing it with SHA-0 or SHA-1.
+	
+	This is cached,
+	because almost all data that we hash has one of only a few different lengths
+	(passwords are short, and challenge hash data always has the same length).
+	"""
+	
+	# A 1 bit,
+	# then zero bytes so that the data will be a multiple of 64 bytes long once we add the 8-byte message length,
+	# then the original message length in bits.
+	pad_count = (SHA_0_1_CHUNK.size - (length + 1 + SHA_0_1_MESSAGE_LENGTH.size)) % SHA_0_1_CHUNK.size
+	return b"\x80" + bytes(pad_count) + SHA_0_1_MESSAGE_LENGTH.pack(length * 8)
+
+
+# Round functions and constants for each group of 20 steps,
+# as expressions in terms of the (role-renamed) working variables b, c, d.
+_SHA_0_1_ROUNDS = [
+	("({d} ^ ({b} & ({c} ^ {d})))", 0x5a827999),
+	("({b} ^ {c} ^ {d})", 0x6ed9eba1),
+	("({b} & {c} | {d} & ({b} | {c}))", 0x8f1bbcdc),
+	("({b} ^ {c} ^ {d})", 0xca62c1d6),
+]
+
+
+def _generate_sha_0_1(*, sha_1: bool) -> typing.Callable[[bytes], bytes]:
+	"""Generate a fully unrolled pure Python implementation of SHA-0 or SHA-1.
+	
+	The generated function produces the same results as :func:`_slow_sha_0_1`,
+	but is significantly faster:
+	
+	* The message schedule and all 80 steps of the compression loop are unrolled,
+	  so there is no loop or list indexing overhead.
+	* Instead of shuffling the five working variables around after every step,
+	  the variables simply change roles from one step to the next.
+	* Some redundant masking is avoided ---
+	  the bits above bit 31 that are produced by a left rotation
+	  don't affect the lower 32 bits of the sum that they're added to,
+	  so they can be masked away together with the sum.
+	"""
+	
+	lines = [
+		"def sha(data):",
+		"	h0, h1, h2, h3, h4 = 0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0",
+		"	data = bytes(data) + padding(len(data))",
+		"	for offset in range(0, len(data), 64):",
+		"		" + ", ".join(f"w{i}" for i in range(16)) + " = unpack_chunk(data, offset)",
+	]
+	
+	for i in range(16, 80):
+		if sha_1:
+			lines.append(f"		x = w{i-3} ^ w{i-8} ^ w{i-14} ^ w{i-16}")
+			lines.append(f"		w{i} = (x << 1 | x >> 31) & 0xffffffff")
+		else:
+			lines.append(f"		w{i} = w{i-3} ^ w{i-8} ^ w{i-14} ^ w{i-16}")
+	
+	lines.append("		a, b, c, d, e = h0, h1, h2, h3, h4")
+	a, b, c, d, e = "abcde"
+	for i in range(80):
+		function, k = _SHA_0_1_ROUNDS[i // 20]
+		f = function.format(b=b, c=c, d=d)
+		lines.append(f"		{e} = (({a} << 5 | {a} >> 27) + {f} + {e} + 0x{k:08x} + w{i}) & 0xffffffff")
+		lines.append(f"		{b} = ({b} << 30 | {b} >> 2) & 0xffffffff")
+		a, b, c, d, e = e, a, b, c, d
+	
+	# 80 is a multiple of 5, so after the last step,
+	# all variables have their original roles again.
+	assert (a, b, c, d, e) == tuple("abcde")
+	
+	lines += [
+		"		h0 = (h0 + a) & 0xffffffff",
+		"		h1 = (h1 + b) & 0xffffffff",
+		"		h2 = (h2 + c) & 0xffffffff",
+		"		h3 = (h3 + d) & 0xffffffff",
+		"		h4 = (h4 + e) & 0xffffffff",
+		"	return pack_hash(h0, h1, h2, h3, h4)",
+	]
+	
+	namespace: typing.Dict[str, typing.Any] = {
+		"padding": _sha_0_1_padding,
+		"unpack_chunk": SHA_0_1_CHUNK.unpack_from,
+		"pack_hash": SHA_0_1_HASH.pack,
+	}
+	exec(compile("\n".join(lines), f"<generated {'SHA-1' if sha_1 else 'SHA-0'}>", "exec"), namespace)
+	return typing.cast(typing.Callable[[bytes], bytes], namespace["sha"])
+
+
+_fast_sha_0 = _generate_sha_0_1(sha_1=False)
+_fast_sha_1 = _generate_sha_0_1(sha_1=True)
+
+
+def _fast_sha_0_1(data: bytes, *, sha_1: bool) -> bytes:
+	"""Faster pure Python implementation of SHA-0 and SHA-1.
+	
+	See :func:`_generate_sha_0_1` for details.
+	"""
+	
+	return _fast_sha_1(data) if sha_1 else _fast_sha_0(data)
+
+
+def _find_accelerated_sha_0() -> typing.Optional[typing.Callable[[bytes], bytes]]:
+	"""Check if :mod:`hashlib` supports SHA-0.
+	
+	This is only the case with old OpenSSL versions
+	(SHA-0 was removed in OpenSSL 1.1.0),
+	but if it's available,
+	it's much faster than anything we can do in Python.
+	"""
+	
+	for name in ["sha", "sha0"]:
+		try:
+			hashlib.new(name)
+		except ValueError:
+			continue
+		
+		def _hashlib_sha_0(data: bytes, *, _name: str = name) -> bytes:
+			return hashlib.new(_name, data).digest()
+		
+		# Make sure that this is really SHA-0 and not some alias for SHA-1.
+		if _hashlib_sha_0(b"abc") == bytes.fromhex("0164b8a914cd2a5e74c4f7ff082c4d97f1edf880"):
+			return _hashlib_sha_0
+	
+	return None
+
+
+_accelerated_sha_0 = _find_accelerated_sha_0()
+
+
+def sha_0(data: bytes) -> bytes:
+	"""Calculate the SHA-0 hash of ``data``.
+	
+	Uses :mod:`hashlib` if it supports SHA-0,
+	otherwise falls back to a pure Python implementation.
+	"""
+	
+	if _accelerated_sha_0 is not None:
+		return _accelerated_sha_0(data)
+	else:
+		return _fast_sha_0(data)
+
+
 def byte_swap_hash(hash: bytes) -> bytes:
 	"""Byte-swap a SHA hash value as if it were an array of 4-byte integers."""
 	
@@ -167,6 +319,25 @@ def truncate_credentials(account_name: str, password: str) -> typing.Tuple[str,
 	return truncate_utf_16_string(account_name, 64), truncate_utf_16_string(password, 16)
 
 
+def account_name_is_email(account_name: str) -> bool:
+	"""Check whether the client treats the given account name as an email address for password hashing purposes.
+	
+	For email addresses,
+	the client sends a challenge hash derived from the password hash.
+	For all other account names
+	(including @gametap email addresses),
+	the client sends the password hash directly.
+	"""
+	
+	match = EMAIL_ACCOUNT_NAME_REGEX.fullmatch(account_name)
+	if match is None:
+		return False
+	
+	# The second-level domain is the last dot-separated part before the TLD.
+	second_level_domain = match.group("domain").rpartition(".")[2]
+	return second_level_domain != "gametap"
+
+
 def password_hash_sha_1(password: str, *, encoding: str = "utf-8", errors: str = "strict") -> bytes:
 	"""Implements the SHA-1-based version of MOULa's password hashing function."""
 	
@@ -187,16 +358,33 @@ def password_hash_sha_0(account_name: str, password: str) -> bytes:
 		account_name = account_name[:-1] + "\x00"
 	if password:
 		password = password[:-1] + "\x00"
-	return slow_sha_0((password + account_name).encode("utf-16-le"))
+	return sha_0((password + account_name).encode("utf-16-le"))
 
 
 def challenge_hash(client_challenge: int, server_challenge: int, password_hash: bytes) -> bytes:
 	"""Calculate the challenge hash from client and server challenge values and a password hash."""
 	
-	return slow_sha_0(CHALLENGE_HASH_DATA.pack(client_challenge, server_challenge, password_hash))
+	return sha_0(CHALLENGE_HASH_DATA.pack(client_challenge, server_challenge, password_hash))
 
 
-class Rc4State(object):
+def _rc4_key_schedule(key: bytes) -> bytearray:
+	state = bytearray(range(256))
+	
+	j = 0
+	for i in range(256):
+		j = (j + state[i] + key[i % len(key)]) & 0xff
+		state[i], state[j] = state[j], state[i]
+	
+	return state
+
+
+class SlowRc4State(object):
+	"""Simple byte-by-byte pure Python implementation of RC4.
+	
+	This is kept around as a reference implementation for testing and benchmarking.
+	You should use :class:`Rc4State` instead.
+	"""
+	
 	state: bytearray
 	i: int
 	j: int
@@ -204,13 +392,7 @@ class Rc4State(object):
 	def __init__(self, key: bytes) -> None:
 		super().__init__()
 		
-		self.state = bytearray(range(256))
-		
-		j = 0
-		for i in range(256):
-			j = (j + self.state[i] + key[i % len(key)]) & 0xff
-			self.state[i], self.state[j] = self.state[j], self.state[i]
-		
+		self.state = _rc4_key_schedule(key)
 		self.i = 0
 		self.j = 0
 	
@@ -223,8 +405,117 @@ class Rc4State(object):
 			self.state[self.i], self.state[self.j] = self.state[self.j], self.state[self.i]
 			res[b] ^= self.state[(self.state[self.i] + self.state[self.j]) & 0xff]
 		
-		# Yes, this is a pointless copy,
-		# but some APIs are very particular about the type of byte buffers
-		# and don't accept bytearray in place of bytes
-		# (e. g. uuid.UUID's bytes/bytes_le kwargs).
 		return bytes(res)
+
+
+# Imported via importlib,
+# so that type checking works the same way whether or not PyCryptodome is installed.
+_accelerated_arc4: typing.Any
+try:
+	_accelerated_arc4 = importlib.import_module("Crypto.Cipher.ARC4")
+except ImportError:
+	_accelerated_arc4 = None
+
+
+class Rc4State(object):
+	"""RC4 encryption state for one direction of a connection.
+	
+	If PyCryptodome is installed,
+	the actual encryption is done by its native ARC4 implementation.
+	Otherwise,
+	a pure Python implementation is used,
+	which generates the keystream for an entire buffer at once
+	and then XORs it with the data as one big integer
+	(which is still slow, but a lot faster than :class:`SlowRc4State`).
+	Both implementations produce exactly the same output,
+	but the :attr:`state`, :attr:`i`, and :attr:`j` attributes are only kept up to date by the pure Python implementation.
+	"""
+	
+	state: bytearray
+	i: int
+	j: int
+	
+	_accelerated: typing.Any
+	
+	def __init__(self, key: bytes, *, allow_accelerated: bool = True) -> None:
+		super().__init__()
+		
+		if allow_accelerated and _accelerated_arc4 is not None:
+			self._accelerated = _accelerated_arc4.new(key)
+		else:
+			self._accelerated = None
+		
+		self.state = _rc4_key_schedule(key)
+		self.i = 0
+		self.j = 0
+	
+	@property
+	def is_accelerated(self) -> bool:
+		return self._accelerated is not None
+	
+	def keystream(self, length: int) -> bytearray:
+		"""Generate the next ``length`` bytes of keystream.
+		
+		This advances the state just like encrypting/decrypting ``length`` bytes would.
+		"""
+		
+		if self._accelerated is not None:
+			return bytearray(self._accelerated.encrypt(bytes(length)))
+		
+		# Everything is copied into local variables,
+		# because attribute lookups are a significant part of the cost of this loop.
+		state = self.state
+		i = self.i
+		j = self.j
+		stream = bytearray(length)
+		
+		for b in range(length):
+			i = (i + 1) & 0xff
+			x = state[i]
+			j = (j + x) & 0xff
+			y = state[j]
+			state[i] = y
+			state[j] = x
+			stream[b] = state[(x + y) & 0xff]
+		
+		self.i = i
+		self.j = j
+		return stream
+	
+	def crypt_into(self, data: "typing.Union[bytes, bytearray, memoryview]", out: "typing.Union[bytearray, memoryview]") -> None:
+		"""Encrypt/decrypt ``data`` and store the result in ``out``.
+		
+		``out`` must be a writable buffer with the same length as ``data``.
+		It may also be the same buffer as ``data``,
+		in which case the data is encrypted/decrypted in place
+		(see also :meth:`crypt_inplace`).
+		"""
+		
+		length = len(data)
+		if len(out) != length:
+			raise ValueError(f"Output buffer length ({len(out)}) doesn't match input data length ({length})")
+		elif not length:
+			return
+		elif self._accelerated is not None:
+			# PyCryptodome's ARC4 cipher doesn't support the output parameter,
+			# unlike its block cipher modes.
+			out[:] = self._accelerated.encrypt(data)
+			return
+		
+		stream = self.keystream(length)
+		out[:] = (int.from_bytes(data, "little") ^ int.from_bytes(stream, "little")).to_bytes(length, "little")
+	
+	def crypt_inplace(self, buffer: "typing.Union[bytearray, memoryview]") -> None:
+		"""Encrypt/decrypt the data in the writable ``buffer`` in place."""
+		
+		self.crypt_into(buffer, buffer)
+	
+	def crypt(self, data: "typing.Union[bytes, bytearray, memoryview]") -> bytes:
+		if not data:
+			return b""
+		elif self._accelerated is not None:
+			return self._accelerated.encrypt(data)
+		
+		length = len(data)
+		stream = self.keystream(length)
+		return (int.from_bytes(data, "little") ^ int.from_bytes(stream, "little")).to_bytes(length, "little")
@@ -26,11 +26,13 @@ import io
 import ipaddress
 import logging
 import struct
+import time
 import typing
 import uuid
 import zlib
 
 from . import base
+from . import compression
 from . import configuration
 from . import pl_messages
 from . import sdl
@@ -39,6 +41,7 @@ from . import structs
 
 
 logger = logging.getLogger(__name__)
+logger_forward = logger.getChild("forward")
 logger_join = logger.getChild("join")
 logger_net_message = logger.getChild("net_message")
 logger_net_message_unhandled = logger_net_message.getChild("unhandled")
@@ -372,6 +375,42 @@ class NetMessageFlags(structs.IntFlag):
 		| needs_reliable_send
 		| route_to_all_players
 	)
+	
+	# Bit mask of all flags that control which optional header fields are present.
+	# These can't be changed in an already serialized message
+	# without moving all data after the header.
+	header_fields = (
+		has_time_sent
+		| has_context
+		| has_transaction_id
+		| has_player_id
+		| has_account_uuid
+		| has_version
+	)
+	
+	# Bit mask of all flags that a plain game message or voice message may have
+	# for it to be forwarded without being parsed
+	# (see GameConnection.try_forward_raw_propagate_buffer).
+	# Messages with any other flags go through the full parsing and checking.
+	raw_forwardable = (
+		has_time_sent
+		| has_game_message_receivers
+		| echo_back_to_sender
+		| has_player_id
+		| use_relevance_regions
+		| needs_reliable_send
+	)
+
+
+# Plain int versions of some flags for checking raw message data,
+# where creating NetMessageFlags objects would be a noticeable part of the work.
+RAW_FORWARDABLE_FLAGS = int(NetMessageFlags.raw_forwardable)
+ECHO_BACK_TO_SENDER_FLAG = int(NetMessageFlags.echo_back_to_sender)
+HAS_TIME_SENT_FLAG = int(NetMessageFlags.has_time_sent)
+USE_RELEVANCE_REGIONS_FLAG = int(NetMessageFlags.use_relevance_regions)
+NOT_FOR_VOICE_FLAGS = int(NetMessageFlags.has_game_message_receivers | NetMessageFlags.use_relevance_regions)
+HEADER_FIELDS_FLAGS = int(NetMessageFlags.header_fields)
+NEEDS_RELIABLE_SEND_FLAG = int(NetMessageFlags.needs_reliable_send)
 
 
 class CompressionType(enum.Enum):
@@ -381,8 +420,285 @@ class CompressionType(enum.Enum):
 	dont = 3
 
 
+class SendPriority(enum.IntEnum):
+	"""Priority classes for messages waiting to be sent to a client
+	(see :class:`MemberSendQueue`),
+	from most to least important.
+	"""
+	
+	# Messages that the sender wants to be delivered reliably,
+	# and messages that are never dropped for other reasons.
+	control = 0
+	sdl = 1
+	game = 2
+	voice = 3
+
+
+# Plain int version of SendPriority.control for MemberSendQueue,
+# where accessing the enum member is a noticeable part of the work.
+CONTROL_PRIORITY = int(SendPriority.control)
+
+
+class NetMessageHeaderField(typing.NamedTuple):
+	"""Description of an optional field in the common plNetMessage header."""
+	
+	# The flag that controls whether the field is present.
+	flag: int
+	# Name of the NetMessage attribute that holds the field's value (None if not present).
+	name: str
+	# struct format of the serialized field (without byte order).
+	format: str
+	# Convert the values unpacked according to format to the attribute value and back.
+	decode: typing.Callable[[typing.Tuple[typing.Any, ...]], typing.Any]
+	encode: typing.Callable[[typing.Any], typing.Tuple[typing.Any, ...]]
+
+
+# All optional fields of the common plNetMessage header,
+# in the order in which they appear after the flags.
+NET_MESSAGE_HEADER_FIELDS = [
+	NetMessageHeaderField(NetMessageFlags.has_version, "protocol_version", "BB", tuple, tuple),
+	NetMessageHeaderField(NetMessageFlags.has_time_sent, "time_sent", "II", lambda values: structs.unified_time_from_parts(*values), structs.unified_time_to_parts),
+	NetMessageHeaderField(NetMessageFlags.has_context, "context", "I", lambda values: values[0], lambda value: (value,)),
+	NetMessageHeaderField(NetMessageFlags.has_transaction_id, "trans_id", "I", lambda values: values[0], lambda value: (value,)),
+	NetMessageHeaderField(NetMessageFlags.has_player_id, "ki_number", "I", lambda values: values[0], lambda value: (value,)),
+	NetMessageHeaderField(NetMessageFlags.has_account_uuid, "account_uuid", "16s", lambda values: uuid.UUID(bytes_le=values[0]), lambda value: (value.bytes_le,)),
+]
+
+
+class NetMessageHeaderLayout(object):
+	"""Serialized layout of the optional plNetMessage header fields
+	for one combination of header field flags,
+	compiled from :data:`NET_MESSAGE_HEADER_FIELDS` into a single struct.
+	
+	Use :func:`net_message_header_layout` to get the layout for a message's flags.
+	"""
+	
+	# Present fields, with the number of values that each one unpacks to.
+	fields: typing.List[typing.Tuple[NetMessageHeaderField, int]]
+	# Names of the fields that aren't present.
+	absent_names: typing.List[str]
+	struct: struct.Struct
+	# Size of the entire header, including the flags (but not the class index).
+	size: int
+	# Offset of the time sent field from the start of the header,
+	# or None if it's not present.
+	time_sent_offset: typing.Optional[int]
+	
+	def __init__(self, flags: int) -> None:
+		super().__init__()
+		
+		self.fields = []
+		self.absent_names = []
+		self.time_sent_offset = None
+		
+		format = "<"
+		for field in NET_MESSAGE_HEADER_FIELDS:
+			if flags & field.flag:
+				if field.flag == NetMessageFlags.has_time_sent:
+					self.time_sent_offset = structs.UINT32.size + struct.calcsize(format)
+				field_struct = struct.Struct("<" + field.format)
+				self.fields.append((field, len(field_struct.unpack(bytes(field_struct.size)))))
+				format += field.format
+			else:
+				self.absent_names.append(field.name)
+		
+		self.struct = struct.Struct(format)
+		self.size = structs.UINT32.size + self.struct.size
+	
+	def unpack_into(self, message: "NetMessage", data: bytes) -> None:
+		"""Unpack the header fields (without the flags) from ``data`` and set them on ``message``."""
+		
+		values = self.struct.unpack(data)
+		i = 0
+		for field, count in self.fields:
+			setattr(message, field.name, field.decode(values[i:i + count]))
+			i += count
+		for name in self.absent_names:
+			setattr(message, name, None)
+	
+	def pack(self, message: "NetMessage") -> bytes:
+		"""Pack the header fields (without the flags) of ``message``."""
+		
+		values: typing.List[typing.Any] = []
+		for field, _ in self.fields:
+			value = getattr(message, field.name)
+			assert value is not None
+			values.extend(field.encode(value))
+		for name in self.absent_names:
+			assert getattr(message, name) is None
+		return self.struct.pack(*values)
+
+
+_net_message_header_layouts: typing.Dict[int, NetMessageHeaderLayout] = {}
+
+
+def net_message_header_layout(flags: int) -> NetMessageHeaderLayout:
+	"""Get the header layout for a message with the given flags.
+	
+	Layouts are compiled the first time that they're needed
+	and reused for all following messages with the same header fields.
+	"""
+	
+	key = int(flags) & HEADER_FIELDS_FLAGS
+	try:
+		return _net_message_header_layouts[key]
+	except KeyError:
+		layout = _net_message_header_layouts[key] = NetMessageHeaderLayout(key)
+		return layout
+
+
+def net_message_header_size(flags: int) -> int:
+	"""Calculate the size of a serialized plNetMessage header with the given flags,
+	not including the class index.
+	"""
+	
+	return net_message_header_layout(flags).size
+
+
+def patch_net_message_header(data: bytes, *, flags: typing.Optional[NetMessageFlags] = None, time_sent: typing.Optional[datetime.datetime] = None) -> bytes:
+	"""Replace the flags and/or time sent in a serialized plNetMessage (including the class index)
+	without parsing and serializing the rest of the message again.
+	
+	Only flags that don't affect the header layout can be changed,
+	and the time sent can only be replaced if the message already has one.
+	
+	:raise ValueError: If the change would require inserting or removing data.
+	"""
+	
+	patched = bytearray(data)
+	offset = structs.CLASS_INDEX.size
+	(old_flags,) = structs.UINT32.unpack_from(patched, offset)
+	
+	if flags is not None:
+		if (flags ^ old_flags) & NetMessageFlags.header_fields:
+			raise ValueError(f"Cannot change header layout flags of a serialized plNetMessage: {NetMessageFlags(old_flags)!r} -> {flags!r}")
+		structs.UINT32.pack_into(patched, offset, flags)
+	
+	if time_sent is not None:
+		time_sent_offset = net_message_header_layout(old_flags).time_sent_offset
+		if time_sent_offset is None:
+			raise ValueError("Cannot set time sent of a serialized plNetMessage that doesn't have one")
+		offset = structs.CLASS_INDEX.size + time_sent_offset
+		patched[offset:offset + structs.UNIFIED_TIME.size] = structs.pack_unified_time(time_sent)
+	
+	return bytes(patched)
+
+
+# Identifies messages that only describe the current state of an object,
+# so that a newer message with the same key makes all older ones obsolete
+# (see NetMessage.coalesce_key and MemberSendQueue).
+# Consists of the class index of the wrapped plMessage
+# and the UOID of the object whose state the message describes.
+CoalesceKey = typing.Tuple[int, structs.Uoid]
+
+# Classes of plMessages that only describe the current state of their sender,
+# so that a client that has fallen behind only needs the newest one from each sender.
+COALESCABLE_PL_MESSAGE_CLASS_INDICES = frozenset([
+	pl_messages.AvatarInputStateMessage.CLASS_INDEX,
+])
+
+
+def pl_message_coalesce_key(data: bytes, offset: int = 0) -> typing.Optional[CoalesceKey]:
+	"""Get the coalesce key for an uncompressed serialized plMessage that starts at ``offset`` in ``data``.
+	
+	:return: The class index and sender of the plMessage,
+		or ``None`` if it's not one of :data:`COALESCABLE_PL_MESSAGE_CLASS_INDICES`
+		or can't be parsed.
+	"""
+	
+	try:
+		(class_index,) = structs.CLASS_INDEX.unpack_from(data, offset)
+		if class_index not in COALESCABLE_PL_MESSAGE_CLASS_INDICES:
+			return None
+		
+		with io.BytesIO(data) as stream:
+			stream.seek(offset + structs.CLASS_INDEX.size)
+			sender = structs.Uoid.key_from_stream(stream)
+	except (EOFError, ValueError, struct.error):
+		return None
+	
+	if sender is None:
+		return None
+	
+	return class_index, sender
+
+
+def game_message_coalesce_key(data: bytes, offset: int) -> typing.Optional[CoalesceKey]:
+	"""Get the coalesce key for a serialized game message
+	whose stream header starts at ``offset`` in ``data``
+	(see :func:`pl_message_coalesce_key`).
+	
+	Compressed plMessages are never coalesced,
+	because the state updates worth coalescing are always small enough to be sent uncompressed.
+	"""
+	
+	try:
+		_, compression_type, _ = NET_MESSAGE_STREAMED_OBJECT_HEADER.unpack_from(data, offset)
+	except struct.error:
+		return None
+	
+	if compression_type != CompressionType.none.value:
+		return None
+	
+	return pl_message_coalesce_key(data, offset + NET_MESSAGE_STREAMED_OBJECT_HEADER.size)
+
+
+def skip_game_message_fields(data: bytes, offset: int) -> int:
+	"""Find the end of the fields of a serialized plain game message
+	that start at ``offset`` in ``data``
+	(right after the common header),
+	checking their structure without parsing them.
+	
+	:return: The offset right after the game message fields.
+	:raise EOFError: If the data ends before the fields do.
+	:raise ValueError: If the fields are malformed.
+	"""
+	
+	try:
+		_, compression_type, stream_length = NET_MESSAGE_STREAMED_OBJECT_HEADER.unpack_from(data, offset)
+		offset += NET_MESSAGE_STREAMED_OBJECT_HEADER.size + stream_length
+		delivery_time_present = data[offset]
+	except (IndexError, struct.error):
+		raise EOFError("Game message data ends in the middle of its fields")
+	
+	if CompressionType(compression_type) == CompressionType.failed:
+		raise ValueError("plNetMsgStreamedObject has its compression type set to failed, this should never happen!")
+	
+	offset += 1
+	if delivery_time_present:
+		offset += structs.UNIFIED_TIME.size
+	if offset > len(data):
+		raise EOFError("Game message data ends in the middle of its delivery time")
+	
+	return offset
+
+
+# All concrete NetMessage subclasses, registered automatically by NetMessage.__init_subclass__.
+NET_MESSAGE_CLASSES_BY_INDEX: "typing.Dict[int, typing.Type[NetMessage]]" = {}
+
+
+def send_priority_for(class_index: int, flags: int) -> SendPriority:
+	"""Get the priority class for sending a message with the given class index and flags to a client.
+	
+	Messages that the sender wants to be delivered reliably always have the highest priority,
+	so that they're never dropped
+	and stay in the same order relative to each other.
+	"""
+	
+	if flags & NEEDS_RELIABLE_SEND_FLAG:
+		return SendPriority.control
+	
+	clazz = NET_MESSAGE_CLASSES_BY_INDEX.get(class_index)
+	if clazz is None:
+		return SendPriority.control
+	else:
+		return clazz.SEND_PRIORITY
+
+
 class NetMessage(structs.FieldBasedRepr):
 	CLASS_INDEX: typing.ClassVar[typing.Optional[int]] = 0x025e
+	# Priority class for unreliable messages of this class (see send_priority_for).
+	SEND_PRIORITY: typing.ClassVar[SendPriority] = SendPriority.control
 	
 	class_index: int
 	flags: NetMessageFlags
@@ -392,6 +708,29 @@ class NetMessage(structs.FieldBasedRepr):
 	trans_id: typing.Optional[int]
 	ki_number: typing.Optional[int]
 	account_uuid: typing.Optional[uuid.UUID]
+	# The message exactly as it was received from a client (including the class index),
+	# so that it can be forwarded to other clients without serializing it again.
+	# Must be reset to None (or patched accordingly) when changing any fields of the message.
+	raw_data: typing.Optional[bytes]
+	# For lazily read messages (see read_lazy):
+	# the data that the rest of the message will be read from by read_rest,
+	# and where the rest of the message starts in it.
+	_unread_data: typing.Optional[bytes]
+	_unread_offset: int
+	# Set while reading the rest of a lazily read message,
+	# so that the header isn't read again.
+	_reading_rest: bool
+	
+	def __init_subclass__(cls, *, abstract: bool = False, **kwargs: typing.Any) -> None:
+		super().__init_subclass__(**kwargs)
+		
+		# Abstract base classes are never sent as-is,
+		# so they can't be created from their class index.
+		if cls.CLASS_INDEX is not None and not abstract:
+			if cls.CLASS_INDEX in NET_MESSAGE_CLASSES_BY_INDEX:
+				raise ValueError(f"Attempted to create NetMessage subclass {cls.__qualname__} with class index 0x{cls.CLASS_INDEX:>04x} which is already used by existing subclass {NET_MESSAGE_CLASSES_BY_INDEX[cls.CLASS_INDEX].__qualname__}")
+			
+			NET_MESSAGE_CLASSES_BY_INDEX[cls.CLASS_INDEX] = cls
 	
 	def __init__(self) -> None:
 		super().__init__()
@@ -406,6 +745,10 @@ class NetMessage(structs.FieldBasedRepr):
 		self.trans_id = None
 		self.ki_number = None
 		self.account_uuid = None
+		self.raw_data = None
+		self._unread_data = None
+		self._unread_offset = 0
+		self._reading_rest = False
 	
 	def repr_fields(self) -> "collections.OrderedDict[str, str]":
 		fields = super().repr_fields()
@@ -437,50 +780,12 @@ class NetMessage(structs.FieldBasedRepr):
 	
 	@classmethod
 	def from_class_index(cls, class_index: int) -> "NetMessage":
-		if class_index == NetMessagePagingRoom.CLASS_INDEX:
-			return NetMessagePagingRoom()
-		elif class_index == NetMessageGameStateRequest.CLASS_INDEX:
-			return NetMessageGameStateRequest()
-		elif class_index == NetMessageTestAndSet.CLASS_INDEX:
-			return NetMessageTestAndSet()
-		elif class_index == NetMessageSDLState.CLASS_INDEX:
-			return NetMessageSDLState()
-		elif class_index == NetMessageSDLStateBroadcast.CLASS_INDEX:
-			return NetMessageSDLStateBroadcast()
-		elif class_index == NetMessageGetSharedState.CLASS_INDEX:
-			# Unused.
-			return NetMessageGetSharedState()
-		elif class_index == NetMessageObjectStateRequest.CLASS_INDEX:
-			# Unused.
-			return NetMessageObjectStateRequest()
-		elif class_index == NetMessageGameMessage.CLASS_INDEX:
-			return NetMessageGameMessage()
-		elif class_index == NetMessageGameMessageDirected.CLASS_INDEX:
-			return NetMessageGameMessageDirected()
-		elif class_index == NetMessageLoadClone.CLASS_INDEX:
-			return NetMessageLoadClone()
-		elif class_index == NetMessageVoice.CLASS_INDEX:
-			return NetMessageVoice()
-		elif class_index == NetMessageMembersListRequest.CLASS_INDEX:
-			return NetMessageMembersListRequest()
-		elif class_index == NetMessageGroupOwner.CLASS_INDEX:
-			# Should never be sent by clients.
-			return NetMessageGroupOwner()
-		elif class_index == NetMessageMembersList.CLASS_INDEX:
-			# Should never be sent by clients.
-			return NetMessageMembersList()
-		elif class_index == NetMessageMemberUpdate.CLASS_INDEX:
-			# Should never be sent by clients.
-			return NetMessageMemberUpdate()
-		elif class_index == NetMessageInitialAgeStateSent.CLASS_INDEX:
-			# Should never be sent by clients.
-			return NetMessageInitialAgeStateSent()
-		elif class_index == NetMessageRelevanceRegions.CLASS_INDEX:
-			return NetMessageRelevanceRegions()
-		elif class_index == NetMessagePlayerPage.CLASS_INDEX:
-			return NetMessagePlayerPage()
-		else:
+		try:
+			clazz = NET_MESSAGE_CLASSES_BY_INDEX[class_index]
+		except KeyError:
 			raise pl_messages.UnknownClassIndexError(f"Unsupported plNetMessage class index: 0x{class_index:>04x}")
+		else:
+			return clazz()
 	
 	@property
 	def class_description(self) -> str:
@@ -494,39 +799,81 @@ class NetMessage(structs.FieldBasedRepr):
 		return desc
 	
 	def read(self, stream: typing.BinaryIO) -> None:
+		if self._reading_rest:
+			# The header was already read by read_lazy
+			# and the stream is positioned right after it.
+			return
+		
 		(flags,) = structs.stream_unpack(stream, structs.UINT32)
 		self.flags = NetMessageFlags(flags)
+		layout = net_message_header_layout(flags)
+		layout.unpack_into(self, structs.read_exact(stream, layout.struct.size))
+	
+	def read_lazy(self, data: bytes) -> None:
+		"""Read only the common header from ``data``
+		(a complete serialized message, including the class index)
+		and leave the rest of the message for later.
+		
+		The rest must be checked using :meth:`check_rest`
+		before the message is handled or forwarded.
+		Code that needs any fields that aren't part of the header
+		must first read them explicitly using :meth:`read_rest`.
+		Most messages are only forwarded to other clients as they are
+		(see :attr:`raw_data`),
+		so their contents often never need to be parsed at all.
+		
+		Fields that aren't part of the header must not be assigned
+		before the rest of the message has been read,
+		because reading it would overwrite them.
+		"""
 		
-		if NetMessageFlags.has_version in self.flags:
-			major, minor = structs.stream_unpack(stream, NET_MESSAGE_VERSION)
-			self.protocol_version = (major, minor)
-		else:
-			self.protocol_version = None
+		with io.BytesIO(data) as stream:
+			stream.seek(structs.CLASS_INDEX.size)
+			NetMessage.read(self, stream)
+			self._unread_offset = stream.tell()
+		self._unread_data = data
+		self.raw_data = data
+	
+	def read_rest(self) -> None:
+		"""Read all fields of a lazily read message that haven't been read yet
+		(see :meth:`read_lazy`).
+		Does nothing if the message has already been read fully.
 		
-		if NetMessageFlags.has_time_sent in self.flags:
-			self.time_sent = structs.read_unified_time(stream)
-		else:
-			self.time_sent = None
+		:raise base.ProtocolError: If the message has trailing data.
+		"""
 		
-		if NetMessageFlags.has_context in self.flags:
-			(self.context,) = structs.stream_unpack(stream, structs.UINT32)
-		else:
-			self.context = None
+		data = self._unread_data
+		if data is None:
+			return
 		
-		if NetMessageFlags.has_transaction_id in self.flags:
-			(self.trans_id,) = structs.stream_unpack(stream, structs.UINT32)
-		else:
-			self.trans_id = None
+		self._unread_data = None
+		self._reading_rest = True
+		try:
+			with io.BytesIO(data) as stream:
+				stream.seek(self._unread_offset)
+				self.read(stream)
+				extra_data = stream.read()
+		finally:
+			self._reading_rest = False
 		
-		if NetMessageFlags.has_player_id in self.flags:
-			(self.ki_number,) = structs.stream_unpack(stream, structs.UINT32)
-		else:
-			self.ki_number = None
+		if extra_data:
+			raise base.ProtocolError(f"plNetMessage {self.class_description} wasn't fully parsed - trailing data: {extra_data!r}")
+	
+	def check_rest(self) -> None:
+		"""Check that the rest of a lazily read message
+		(see :meth:`read_lazy`)
+		is well-formed and has no trailing data,
+		so that malformed messages are rejected before they're handled or forwarded.
 		
-		if NetMessageFlags.has_account_uuid in self.flags:
-			self.account_uuid = uuid.UUID(bytes_le=structs.read_exact(stream, 16))
-		else:
-			self.account_uuid = None
+		By default,
+		this simply reads the rest of the message.
+		Subclasses whose handlers often don't need the rest of the message
+		override this with a cheaper check of its structure.
+		
+		:raise base.ProtocolError: If the message has trailing data.
+		"""
+		
+		self.read_rest()
 	
 	@classmethod
 	def from_stream_with_class_index(cls, stream: typing.BinaryIO) -> "NetMessage":
@@ -537,46 +884,46 @@ class NetMessage(structs.FieldBasedRepr):
 	
 	def write(self, stream: typing.BinaryIO) -> None:
 		stream.write(structs.UINT32.pack(self.flags))
+		stream.write(net_message_header_layout(self.flags).pack(self))
+	
+	def write_with_class_index(self, stream: typing.BinaryIO) -> None:
+		self.read_rest()
+		stream.write(structs.CLASS_INDEX.pack(self.class_index))
+		self.write(stream)
+	
+	def to_bytes_with_class_index(self) -> bytes:
+		"""Serialize this message (including the class index).
 		
-		if NetMessageFlags.has_version in self.flags:
-			assert self.protocol_version is not None
-			stream.write(NET_MESSAGE_VERSION.pack(*self.protocol_version))
-		else:
-			assert self.protocol_version is None
-		
-		if NetMessageFlags.has_time_sent in self.flags:
-			assert self.time_sent is not None
-			structs.write_unified_time(stream, self.time_sent)
-		else:
-			assert self.time_sent is None
-		
-		if NetMessageFlags.has_context in self.flags:
-			assert self.context is not None
-			stream.write(structs.UINT32.pack(self.context))
-		else:
-			assert self.context is None
+		For messages received from a client,
+		the original data (:attr:`raw_data`) is returned as-is.
+		"""
 		
-		if NetMessageFlags.has_transaction_id in self.flags:
-			assert self.trans_id is not None
-			stream.write(structs.UINT32.pack(self.trans_id))
-		else:
-			assert self.trans_id is None
+		if self.raw_data is not None:
+			return self.raw_data
 		
-		if NetMessageFlags.has_player_id in self.flags:
-			assert self.ki_number is not None
-			stream.write(structs.UINT32.pack(self.ki_number))
-		else:
-			assert self.ki_number is None
+		with io.BytesIO() as stream:
+			self.write_with_class_index(stream)
+			return stream.getvalue()
+	
+	def coalesce_key(self) -> typing.Optional[CoalesceKey]:
+		"""Get a key identifying the object whose current state this message describes,
+		so that a client that has fallen behind with receiving messages
+		only needs to be sent the newest message with the same key
+		(see :class:`MemberSendQueue`).
+		
+		:return: The coalesce key,
+			or ``None`` if the message must be sent even if a newer one with the same key follows.
+			This is always the case for messages that the sender wants to be delivered reliably
+			(:attr:`~NetMessageFlags.needs_reliable_send`),
+			and for all messages that aren't pure state updates.
+		"""
 		
-		if NetMessageFlags.has_account_uuid in self.flags:
-			assert self.account_uuid is not None
-			stream.write(self.account_uuid.bytes_le)
-		else:
-			assert self.account_uuid is None
+		return None
 	
-	def write_with_class_index(self, stream: typing.BinaryIO) -> None:
-		stream.write(structs.CLASS_INDEX.pack(self.class_index))
-		self.write(stream)
+	def send_priority(self) -> SendPriority:
+		"""Get the priority class for sending this message to a client (see :func:`send_priority_for`)."""
+		
+		return send_priority_for(self.class_index, self.flags)
 	
 	async def handle(self, connection: "GameConnection") -> None:
 		logger_net_message_unhandled.error("Don't know how to handle plNetMessage of class %s - ignoring", self.class_description)
@@ -602,7 +949,7 @@ class UnknownNetMessage(NetMessage):
 		stream.write(self.data)
 
 
-class NetMessageRoomsList(NetMessage):
+class NetMessageRoomsList(NetMessage, abstract=True):
 	CLASS_INDEX = 0x0263
 	
 	rooms: typing.List[typing.Tuple[structs.Location, bytes]]
@@ -675,6 +1022,11 @@ class NetMessagePagingRoom(NetMessageRoomsList):
 		unexpected_flags = self.page_flags & ~NetMessagePagingRoom.Flags.all_expected
 		if unexpected_flags:
 			logger_paging.warning("Avatar %s sent paging message with unexpected flags: %r", self.ki_number, unexpected_flags)
+		
+		if NetMessagePagingRoom.Flags.paging_out in self.page_flags and connection.room is not None:
+			released = connection.room.locks.release_all(connection.client_state.ki_number, {location for location, _ in self.rooms})
+			if released:
+				logger_test_and_set.debug("Released %d locks held by avatar %d in paged out rooms", released, connection.client_state.ki_number)
 
 
 class NetMessageGameStateRequest(NetMessageRoomsList):
@@ -688,41 +1040,34 @@ class NetMessageGameStateRequest(NetMessageRoomsList):
 		
 		count = 0
 		
-		# TODO Send currently loaded clones
-		
-		# Send saved SDL state for the age instance (AgeSDLHook).
-		try:
-			age_sdl_node_id = await connection.find_age_sdl_node()
-		except state.VaultNodeNotFound:
-			# No age SDL saved for this instance -
-			# assuming that this age has no AgeSDLHook.
-			pass
+		if connection.room is None:
+			logger_sdl.warning("Avatar %d requested initial game state without being in an age instance room", self.ki_number)
 		else:
+			# Send currently loaded clones (e. g. other avatars) first,
+			# so that the states for the clones can be applied.
+			# These aren't counted as initial states.
+			messages = connection.room.clones.initial_messages(connection.client_state.ki_number)
+			logger_sdl.debug("Sending %d currently loaded clones", len(messages))
+			
+			# Send saved SDL states for the age instance (AgeSDLHook)
+			# and for objects within the age instance.
+			# These are cached already serialized,
+			# so they can be sent all at once.
 			# TODO Support global SDL and such
-			age_sdl_node_data = await connection.server_state.fetch_vault_node(age_sdl_node_id)
+			# TODO It's probably not enough to send the AgeSDLHook SDL blob from the vault as-is!
+			state_messages = await connection.room.sdl_states.initial_state_messages(connection)
 			
-			if age_sdl_node_data.string64_1 != connection.client_state.age_file_name:
-				raise base.ProtocolError(f"SDL node {age_sdl_node_id} has SDL name {age_sdl_node_data.string64_1!r}, which doesn't match the age file name {connection.client_state.age_file_name!r}")
+			# Send non-persistent object states from the other clients in the age instance.
+			pressure = len(connection.send_queue) / connection.send_queue.max_size
+			# The client already knows its own states.
+			for uoid, blob, is_avatar_state in connection.room.volatile_sdl_states.initial_states(connection.client_state.ki_number):
+				logger_sdl.debug("Sending initial non-persistent state for object %s", uoid)
+				state_messages.append(serialize_propagate_buffer(await make_initial_state_message(connection.server_state.compression, uoid, blob, persistent=False, is_avatar_state=is_avatar_state, pressure=pressure)))
 			
-			if age_sdl_node_data.blob_1:
-				count += 1
-				# TODO It's probably not enough to send the SDL blob from the vault as-is!
-				age_sdl_blob = age_sdl_node_data.blob_1
-				await connection.send_initial_age_sdl(age_sdl_blob)
-		
-		# Find and send saved SDL states for objects within the age instance.
-		async for uoid, _, sdl_blob in connection.server_state.find_object_sdl_states(connection.client_state.age_node_id):
-			logger_sdl.debug("Sending initial state for object %s", uoid)
-			object_state_message = NetMessageSDLState()
-			object_state_message.uoid = uoid
-			object_state_message.compress_and_set_data(sdl_blob)
-			object_state_message.is_initial_state = True
-			object_state_message.persist_on_server = True
-			object_state_message.is_avatar_state = False
-			await connection.send_propagate_buffer(object_state_message)
-			count += 1
-		
-		# TODO Send non-persistent object states from the running game server
+			messages += state_messages
+			if messages:
+				await connection.write_chunks(messages)
+			count += len(state_messages)
 		
 		logger_sdl.debug("Sent/queued %d initial state messages", count)
 		initial_age_state_sent = NetMessageInitialAgeStateSent()
@@ -730,7 +1075,7 @@ class NetMessageGameStateRequest(NetMessageRoomsList):
 		await connection.send_propagate_buffer(initial_age_state_sent)
 
 
-class NetMessageObject(NetMessage):
+class NetMessageObject(NetMessage, abstract=True):
 	CLASS_INDEX = 0x0268
 	
 	uoid: structs.Uoid
@@ -751,7 +1096,7 @@ class NetMessageObject(NetMessage):
 		self.uoid.write(stream)
 
 
-class NetMessageStream(NetMessage):
+class NetMessageStream(NetMessage, abstract=True):
 	CLASS_INDEX = 0x026c
 	
 	uncompressed_length: int
@@ -767,20 +1112,33 @@ class NetMessageStream(NetMessage):
 		fields["stream_data"] = repr(self.stream_data)
 		return fields
 	
+	def _check_decompressed_data(self, data: bytes) -> bytes:
+		if self.uncompressed_length != len(data):
+			raise ValueError(f"plNetMsgStreamedObject uncompressed length {self.uncompressed_length} doesn't match actual length of data after decompression: {len(data)}")
+		return data
+	
 	def decompress_data(self) -> bytes:
 		if self.compression_type == CompressionType.zlib:
 			if len(self.stream_data) < 2:
 				raise ValueError(f"Stream message zlib compression requires at least 2 bytes of data, but got {len(self.stream_data)}")
-			data = self.stream_data[:2] + zlib.decompress(self.stream_data[2:])
-			if self.uncompressed_length != len(data):
-				raise ValueError(f"plNetMsgStreamedObject uncompressed length {self.uncompressed_length} doesn't match actual length of data after decompression: {len(data)}")
-			return data
+			return self._check_decompressed_data(self.stream_data[:2] + zlib.decompress(self.stream_data[2:]))
 		else:
 			if self.uncompressed_length != 0:
 				raise ValueError(f"plNetMsgStreamedObject uncompressed length {self.uncompressed_length} should be 0 for non-compressed data")
 			return self.stream_data
 	
-	def compress_and_set_data(self, data: bytes, compression_type: typing.Optional[CompressionType] = None) -> None:
+	async def decompress_data_async(self, service: compression.CompressionService) -> bytes:
+		"""Like :meth:`decompress_data`,
+		but large data is decompressed outside of the event loop
+		(see :class:`~compression.CompressionService`).
+		"""
+		
+		if self.compression_type == CompressionType.zlib and len(self.stream_data) >= 2:
+			return self._check_decompressed_data(self.stream_data[:2] + await service.decompress(self.stream_data[2:]))
+		else:
+			return self.decompress_data()
+	
+	def _choose_compression_type(self, data: bytes, compression_type: typing.Optional[CompressionType]) -> bool:
 		if compression_type is not None:
 			self.compression_type = compression_type
 		elif len(data) > COMPRESSION_THRESHOLD:
@@ -792,10 +1150,26 @@ class NetMessageStream(NetMessage):
 			self.uncompressed_length = len(data)
 			if self.uncompressed_length < 2:
 				raise ValueError(f"Stream message zlib compression requires at least 2 bytes of data, but got {self.uncompressed_length}")
-			self.stream_data = data[:2] + zlib.compress(data[2:])
+			return True
 		else:
 			self.uncompressed_length = 0
 			self.stream_data = data
+			return False
+	
+	def compress_and_set_data(self, data: bytes, compression_type: typing.Optional[CompressionType] = None) -> None:
+		if self._choose_compression_type(data, compression_type):
+			self.stream_data = data[:2] + zlib.compress(data[2:])
+	
+	async def compress_and_set_data_async(self, data: bytes, service: compression.CompressionService, compression_type: typing.Optional[CompressionType] = None, *, pressure: float = 0.0) -> None:
+		"""Like :meth:`compress_and_set_data`,
+		but large data is compressed outside of the event loop,
+		at a level chosen based on the data size and the recipient's send queue ``pressure``,
+		and identical data is only compressed once
+		(see :class:`~compression.CompressionService`).
+		"""
+		
+		if self._choose_compression_type(data, compression_type):
+			self.stream_data = data[:2] + await service.compress(data[2:], pressure)
 	
 	def read(self, stream: typing.BinaryIO) -> None:
 		super().read(stream)
@@ -814,12 +1188,12 @@ class NetMessageStream(NetMessage):
 		stream.write(self.stream_data)
 
 
-class NetMessageStreamedObject(NetMessageStream, NetMessageObject):
+class NetMessageStreamedObject(NetMessageStream, NetMessageObject, abstract=True):
 	# Multiple inheritance, yo!
 	CLASS_INDEX = 0x027b
 
 
-class NetMessageSharedState(NetMessageStreamedObject):
+class NetMessageSharedState(NetMessageStreamedObject, abstract=True):
 	CLASS_INDEX = 0x027c
 	
 	lock_request: bool
@@ -849,19 +1223,24 @@ class NetMessageTestAndSet(NetMessageSharedState):
 	
 	async def handle(self, connection: "GameConnection") -> None:
 		data = self.decompress_data()
+		ki_number = connection.client_state.ki_number
+		
+		if connection.room is None:
+			logger_test_and_set.warning("Avatar %s sent a TestAndSet message for %s before joining an age instance - ignoring", self.ki_number, self.uoid)
+			return
+		
+		locks = connection.room.locks
 		
 		if self.lock_request:
 			if data != type(self).TRIGGER_DATA:
 				logger_test_and_set.warning("Unexpected stream data for TestAndSet trigger request! Ignoring the stream data and locking as usual.")
 			
-			try:
-				lock_owner = connection.client_state.locks[self.uoid]
-			except KeyError:
-				logger_test_and_set.debug("Avatar %d locking %s", connection.client_state.ki_number, self.uoid)
-				connection.client_state.locks[self.uoid] = connection.client_state.ki_number
+			lock_owner = locks.acquire(self.uoid, ki_number)
+			if lock_owner is None:
+				logger_test_and_set.debug("Avatar %d locking %s", ki_number, self.uoid)
 				reply_code = pl_messages.ServerReplyMessage.Type.affirm
 			else:
-				logger_test_and_set.debug("Avatar %d was denied lock of %s - already locked by %d", connection.client_state.ki_number, self.uoid, lock_owner)
+				logger_test_and_set.debug("Avatar %d was denied lock of %s - already locked by %d", ki_number, self.uoid, lock_owner)
 				reply_code = pl_messages.ServerReplyMessage.Type.deny
 			
 			server_reply_message = pl_messages.ServerReplyMessage()
@@ -880,58 +1259,48 @@ class NetMessageTestAndSet(NetMessageSharedState):
 			if data != type(self).UNTRIGGER_DATA:
 				logger_test_and_set.warning("Unexpected stream data for TestAndSet un-trigger request! Ignoring the stream data and unlocking as usual.")
 			
-			try:
-				lock_owner = connection.client_state.locks[self.uoid]
-			except KeyError:
-				logger_test_and_set.warning("Avatar %d tried to unlock %s even though it's not locked - ignoring", connection.client_state.ki_number, self.uoid)
+			lock_owner = locks.release(self.uoid, ki_number)
+			if lock_owner is None:
+				logger_test_and_set.warning("Avatar %d tried to unlock %s even though it's not locked - ignoring", ki_number, self.uoid)
+			elif lock_owner == ki_number:
+				logger_test_and_set.debug("Avatar %d unlocking %s", ki_number, self.uoid)
 			else:
-				if lock_owner == connection.client_state.ki_number:
-					logger_test_and_set.debug("Avatar %d unlocking %s", connection.client_state.ki_number, self.uoid)
-					del connection.client_state.locks[self.uoid]
-				else:
-					logger_test_and_set.warning("Avatar %d tried to unlock %s even though it's locked by %d - ignoring", connection.client_state.ki_number, self.uoid, lock_owner)
+				logger_test_and_set.warning("Avatar %d tried to unlock %s even though it's locked by %d - ignoring", ki_number, self.uoid, lock_owner)
 
 
-def _apply_parsed_change_to_blob(current_blob: bytes, change_header: sdl.SDLStreamHeader, change_record: sdl.GuessedSDLRecord) -> bytes:
-	"""Parse the SDL blob ``current_blob``,
-	apply the changed values from the already parsed SDL record ``change_record`` onto it,
-	and return the SDL blob with the change applied.
-	"""
+def _parse_saved_sdl_blob(blob: bytes) -> typing.Tuple[sdl.SDLStreamHeader, sdl.GuessedSDLRecord]:
+	"""Parse a saved SDL blob so that changes can be applied to it."""
 	
-	with io.BytesIO(current_blob) as stream:
-		current_header, current_record = sdl.guess_parse_sdl_blob(stream)
-		
-		if current_header.uoid is not None:
-			logger_sdl_change.info("Currently saved SDL blob header contains UOID: %s", current_header.uoid)
-		
-		if change_header != current_header:
-			raise ValueError(f"Mismatched state descriptors when applying change - current SDL blob has header {current_header}, but the change SDL blob has header {change_header})")
-		
-		if logger_sdl_change.isEnabledFor(logging.DEBUG):
-			logger_sdl_change.debug("Parsed currently saved SDL blob:")
-			for line in current_record.as_multiline_str():
-				logger_sdl_change.debug("%s", line.replace("\t", "    "))
+	with io.BytesIO(blob) as stream:
+		header, record = sdl.guess_parse_sdl_blob(stream)
 	
-	changed_record = current_record.with_change(change_record)
+	if header.uoid is not None:
+		logger_sdl_change.info("Currently saved SDL blob header contains UOID: %s", header.uoid)
 	
 	if logger_sdl_change.isEnabledFor(logging.DEBUG):
-		logger_sdl_change.debug("Changed state:")
-		for line in changed_record.as_multiline_str():
+		logger_sdl_change.debug("Parsed currently saved SDL blob:")
+		for line in record.as_multiline_str():
 			logger_sdl_change.debug("%s", line.replace("\t", "    "))
 	
-	with io.BytesIO() as stream:
-		current_header.write(stream)
-		changed_record.write(stream)
-		changed_blob = stream.getvalue()
+	return header, record
+
+
+def _write_sdl_blob_checked(header: sdl.SDLStreamHeader, record: sdl.GuessedSDLRecord) -> bytes:
+	"""Write an SDL state (usually one with changes applied) back to a blob
+	and check that the blob can be re-parsed successfully.
+	"""
 	
-	# Check that the changed blob can be re-parsed successfully.
+	with io.BytesIO() as stream:
+		header.write(stream)
+		record.write(stream)
+		blob = stream.getvalue()
 	
-	with io.BytesIO(changed_blob) as stream:
+	with io.BytesIO(blob) as stream:
 		roundtripped_header, roundtripped_record = sdl.guess_parse_sdl_blob(stream)
-		if roundtripped_header != current_header:
-			raise ValueError(f"Re-parsed changed SDL blob header ({roundtripped_header}) doesn't match original header ({current_header})")
+		if roundtripped_header != header:
+			raise ValueError(f"Re-parsed changed SDL blob header ({roundtripped_header}) doesn't match original header ({header})")
 		
-		if roundtripped_record != changed_record:
+		if roundtripped_record != record:
 			if logger_sdl_change.isEnabledFor(logging.DEBUG):
 				logger_sdl_change.debug("Re-parsed changed blob:")
 				for line in roundtripped_record.as_multiline_str():
@@ -939,11 +1308,12 @@ def _apply_parsed_change_to_blob(current_blob: bytes, change_header: sdl.SDLStre
 			
 			raise ValueError("Re-parsed changed SDL blob body doesn't match original body")
 	
-	return changed_blob
+	return blob
 
 
 class NetMessageSDLState(NetMessageStreamedObject):
 	CLASS_INDEX = 0x02cd
+	SEND_PRIORITY = SendPriority.sdl
 	
 	is_initial_state: bool
 	persist_on_server: bool
@@ -1000,7 +1370,7 @@ class NetMessageSDLState(NetMessageStreamedObject):
 		if NetMessageFlags.echo_back_to_sender in self.flags:
 			await connection.send_propagate_buffer(self)
 		
-		blob_data = self.decompress_data()
+		blob_data = await self.decompress_data_async(connection.server_state.compression)
 		with io.BytesIO(blob_data) as stream:
 			try:
 				header, record = sdl.guess_parse_sdl_blob(stream)
@@ -1029,6 +1399,10 @@ class NetMessageSDLState(NetMessageStreamedObject):
 				logger_sdl.debug("Original change blob data: %r", blob_data)
 				logger_sdl.debug("Parsed and rewritten change blob data: %r", roundtripped_data)
 		
+		if connection.room is None:
+			logger_sdl.warning("Client sent an SDL change for %s before joining an age instance - not saving it", self.uoid)
+			return
+		
 		if self.uoid.name == AGE_SDL_HOOK_NAME:
 			# Special treatment for AgeSDLHook:
 			# save in the appropriate vault node
@@ -1041,68 +1415,26 @@ class NetMessageSDLState(NetMessageStreamedObject):
 			if self.uoid != connection.client_state.age_sdl_hook_uoid:
 				logger_sdl.warning("Received an AgeSDLHook change with UOID %s, which doesn't match the expected UOID %s for this age's AgeSDLHook", self.uoid, connection.client_state.age_sdl_hook_uoid)
 			
-			try:
-				age_sdl_node_id = await connection.find_age_sdl_node()
-			except state.VaultNodeNotFound:
-				logger_sdl.info("Age instance SDL vault node not found - creating one...")
-				age_sdl_node_id = await connection.server_state.create_vault_node(state.VaultNodeData(
-					creator_account_uuid=connection.client_state.account_uuid,
-					creator_id=connection.client_state.ki_number,
-					node_type=state.VaultNodeType.sdl,
-					int32_1=0,
-					string64_1=connection.client_state.age_file_name,
-				))
-				await connection.server_state.add_vault_node_ref(state.VaultNodeRef(connection.client_state.age_info_node_id, age_sdl_node_id))
-			
-			age_sdl_node_data = await connection.server_state.fetch_vault_node(age_sdl_node_id)
-			age_sdl_blob = age_sdl_node_data.blob_1
-			
-			if age_sdl_blob:
-				try:
-					changed_blob = _apply_parsed_change_to_blob(age_sdl_blob, header, record)
-				except ValueError:
-					logger_sdl.error("Failed to apply change to SDL blob from age instance SDL vault node", exc_info=True)
-					return
-			else:
-				logger_sdl.info("Age instance SDL vault node is empty - will initialize it with the blob sent by the client")
-				changed_blob = blob_data
-			
-			await connection.server_state.update_vault_node(age_sdl_node_id, state.VaultNodeData(blob_1=changed_blob), uuid.uuid4())
+			await connection.room.sdl_states.apply_age_sdl_change(connection, header, record, blob_data)
 		elif do_persist:
 			# Handle all other persistent object states.
-			# These currently go directly to the database.
-			# TODO Cache parsed object SDL states in memory for easier updating?
-			
-			try:
-				existing_blob = await connection.server_state.fetch_object_sdl_state(connection.client_state.age_node_id, self.uoid, header.descriptor_name)
-			except state.ObjectStateNotFound:
-				logger_sdl.debug("No existing SDL blob found for object %s - will initialize it with the blob sent by the client", self.uoid)
-				if NetMessageFlags.new_sdl_state not in self.flags:
-					logger_sdl.info("Client sent a non-new SDL change for object %s, but no SDL blob has been saved yet for that object - will use this SDL blob as the initial state", self.uoid)
-				
-				changed_blob = blob_data
-			else:
-				if NetMessageFlags.new_sdl_state in self.flags:
-					logger_sdl.info("Client sent a new SDL state for object %s, but there's already a saved SDL blob for that object - will treat the new blob as a change and apply it to the saved one", self.uoid)
-				
-				try:
-					changed_blob = _apply_parsed_change_to_blob(existing_blob, header, record)
-				except ValueError:
-					logger_sdl.error("Failed to apply change to existing saved SDL blob for object %s", self.uoid, exc_info=True)
-					return
-			
-			await connection.server_state.save_object_sdl_state(connection.client_state.age_node_id, self.uoid, header.descriptor_name, changed_blob)
+			await connection.room.sdl_states.apply_object_change(self.uoid, header, record, blob_data, NetMessageFlags.new_sdl_state in self.flags)
 		else:
-			pass # TODO Save in memory for sending to other clients later
+			# Keep non-persistent states in memory for sending to clients that join later.
+			connection.room.volatile_sdl_states.apply_change(connection.client_state.ki_number, self.uoid, header, record, blob_data, self.is_avatar_state)
 
 
 class NetMessageSDLStateBroadcast(NetMessageSDLState):
 	CLASS_INDEX = 0x0329
 	
+	# Not coalesced (see NetMessage.coalesce_key),
+	# because SDL changes usually only contain the changed variables,
+	# so a newer change doesn't make an older one obsolete.
+	
 	async def handle(self, connection: "GameConnection") -> None:
 		await super().handle(connection)
 		
-		# TODO Forward to other clients
+		connection.forward_propagate_buffer(self)
 
 
 class NetMessageGetSharedState(NetMessageObject):
@@ -1137,6 +1469,7 @@ class NetMessageObjectStateRequest(NetMessageObject):
 
 class NetMessageGameMessage(NetMessageStream):
 	CLASS_INDEX = 0x026b
+	SEND_PRIORITY = SendPriority.game
 	
 	delivery_time: datetime.datetime
 	
@@ -1162,7 +1495,43 @@ class NetMessageGameMessage(NetMessageStream):
 			stream.write(b"\x01")
 			structs.write_unified_time(stream, self.delivery_time)
 	
-	def inspect_wrapped_message(self, connection: "GameConnection") -> None:
+	def check_rest(self) -> None:
+		# Plain game messages are usually forwarded as they are,
+		# so only check where their fields end instead of reading them.
+		data = self._unread_data
+		if data is None:
+			return
+		
+		end = skip_game_message_fields(data, self._unread_offset)
+		if end != len(data):
+			raise base.ProtocolError(f"plNetMessage {self.class_description} wasn't fully parsed - trailing data: {data[end:]!r}")
+	
+	def coalesce_key(self) -> typing.Optional[CoalesceKey]:
+		if NetMessageFlags.needs_reliable_send in self.flags:
+			return None
+		
+		if self.raw_data is not None:
+			# Don't read the rest of a lazily read message just for this.
+			(flags,) = structs.UINT32.unpack_from(self.raw_data, structs.CLASS_INDEX.size)
+			return game_message_coalesce_key(self.raw_data, structs.CLASS_INDEX.size + net_message_header_size(flags))
+		
+		self.read_rest()
+		if self.compression_type == CompressionType.none:
+			return pl_message_coalesce_key(self.stream_data)
+		else:
+			return None
+	
+	def inspect_wrapped_message(self, connection: typing.Optional["GameConnection"]) -> typing.Optional[pl_messages.Message]:
+		"""Parse the wrapped plMessage and log any inconsistencies.
+		
+		:param connection: The connection that the message was received from,
+			or ``None`` if the message is inspected separately from its connection
+			(see :func:`inspect_sampled_game_message`).
+		:return: The parsed plMessage,
+			or ``None`` if it couldn't be parsed.
+		"""
+		
+		self.read_rest()
 		try:
 			message_data = self.decompress_data()
 			with io.BytesIO(message_data) as message_stream:
@@ -1182,6 +1551,7 @@ class NetMessageGameMessage(NetMessageStream):
 				extra_data = message_stream.read()
 		except (EOFError, ValueError, pl_messages.UnknownClassIndexError) as exc:
 			logger_pl_message.error("Failed to parse plMessage. Ignoring and forwarding anyway...", exc_info=exc)
+			return None
 		else:
 			logger_pl_message.debug("Parsed plMessage: %r", message)
 			
@@ -1193,7 +1563,7 @@ class NetMessageGameMessage(NetMessageStream):
 						if message.is_player != self.is_player:
 							logger_pl_message.warning("plLoadAvatarMsg %s is_player (%r) doesn't match containing network load clone message's is_player (%r)", message.class_description, message.is_player, self.is_player)
 						
-						if message.spawn_point is not None:
+						if message.spawn_point is not None and connection is not None:
 							connection.client_state.try_find_age_sequence_prefix(message.spawn_point.location)
 					elif self.is_player:
 						logger_pl_message.warning("plLoadCloneMsg %s isn't an avatar message, but containing network load clone message's is_player is set", message.class_description)
@@ -1240,6 +1610,17 @@ class NetMessageGameMessage(NetMessageStream):
 			
 			if extra_data:
 				logger_pl_message.warning("plMessage %s wasn't fully parsed - trailing data: %r", message.class_description, extra_data)
+			
+			return message
+	
+	def forward(self, connection: "GameConnection") -> None:
+		"""Forward this message to the appropriate other clients.
+		
+		Plain game messages are sent to everyone else in the same age instance.
+		Subclasses with explicit receivers override this.
+		"""
+		
+		connection.forward_propagate_buffer(self)
 	
 	async def handle(self, connection: "GameConnection") -> None:
 		# If full plMessage parsing is enabled,
@@ -1251,7 +1632,7 @@ class NetMessageGameMessage(NetMessageStream):
 			self.inspect_wrapped_message(connection)
 		
 		# TODO Set kNetNonLocal flag on the wrapped plMessage before forwarding?
-		# TODO Forward to other clients
+		self.forward(connection)
 		
 		if NetMessageFlags.echo_back_to_sender in self.flags:
 			await connection.send_propagate_buffer(self)
@@ -1284,13 +1665,19 @@ class NetMessageGameMessageDirected(NetMessageGameMessage):
 		for receiver in self.receivers:
 			stream.write(structs.UINT32.pack(receiver))
 	
-	async def handle(self, connection: "GameConnection") -> None:
-		logger_pl_message.warning("Directed game messages not supported yet - treating it like a broadcast message for now")
-		await super().handle(connection)
+	def check_rest(self) -> None:
+		# The receivers are always needed for forwarding.
+		self.read_rest()
+	
+	def forward(self, connection: "GameConnection") -> None:
+		connection.forward_propagate_buffer(self, self.receivers, inter_age=NetMessageFlags.inter_age_routing in self.flags)
 
 
 class NetMessageLoadClone(NetMessageGameMessage):
 	CLASS_INDEX = 0x03b3
+	# Clients that miss a clone being loaded or unloaded
+	# would be out of sync until they leave the age.
+	SEND_PRIORITY = SendPriority.control
 	
 	uoid: structs.Uoid
 	is_player: bool
@@ -1318,6 +1705,15 @@ class NetMessageLoadClone(NetMessageGameMessage):
 		self.uoid.write(stream)
 		stream.write(NET_MESSAGE_LOAD_CLONE_BOOLS.pack(self.is_player, self.is_loading, self.is_initial_state))
 	
+	def check_rest(self) -> None:
+		# The clone UOID is always needed for handling the message.
+		self.read_rest()
+	
+	def coalesce_key(self) -> typing.Optional[CoalesceKey]:
+		# Loading and unloading clones changes which objects exist,
+		# so these messages can never replace each other.
+		return None
+	
 	def inspect_player_load_avatar_message(self, connection: "GameConnection") -> None:
 		try:
 			message_data = self.decompress_data()
@@ -1361,6 +1757,15 @@ class NetMessageLoadClone(NetMessageGameMessage):
 			self.inspect_player_load_avatar_message(connection)
 		
 		await super().handle(connection)
+		
+		# Remember loaded clones for clients that join the age instance later.
+		if connection.room is not None:
+			if self.is_loading:
+				self.is_initial_state = True
+				self.raw_data = None
+				connection.room.clones.load(connection.client_state.ki_number, self.uoid, serialize_propagate_buffer(self))
+			else:
+				connection.room.clones.unload(self.uoid)
 
 
 class NetMessageVoice(NetMessage):
@@ -1370,6 +1775,7 @@ class NetMessageVoice(NetMessage):
 		encoded_opus = 1 << 2
 	
 	CLASS_INDEX = 0x0279
+	SEND_PRIORITY = SendPriority.voice
 	
 	voice_flags: "NetMessageVoice.Flags"
 	frame_count: int
@@ -1409,7 +1815,7 @@ class NetMessageVoice(NetMessage):
 	async def handle(self, connection: "GameConnection") -> None:
 		logger_voice.debug("Avatar %d voice-chatting to %r: flags %r, %d frames, %d bytes", self.ki_number, self.receivers, self.voice_flags, self.frame_count, len(self.voice_data))
 		
-		# TODO Forward to other clients
+		connection.forward_propagate_buffer(self, self.receivers)
 		
 		if NetMessageFlags.echo_back_to_sender in self.flags:
 			await connection.send_propagate_buffer(self)
@@ -1430,7 +1836,7 @@ class NetMessageMembersListRequest(NetMessage):
 		await connection.send_propagate_buffer(members_list)
 
 
-class NetMessageServerToClient(NetMessage):
+class NetMessageServerToClient(NetMessage, abstract=True):
 	CLASS_INDEX = 0x02b2
 	
 	def __init__(self) -> None:
@@ -1576,14 +1982,17 @@ class NetMessageRelevanceRegions(NetMessage):
 			logger_paging.debug("Avatar %d updated its relevance regions: %s", self.ki_number, "".join(region_reprs))
 		
 		if not self.regions_i_care_about & 1:
-			logger_paging.warning("Avatar %d doesn't care about region 0")
+			logger_paging.warning("Avatar %d doesn't care about region 0", self.ki_number)
 		
 		if self.regions_im_in == 0:
-			logger_paging.warning("Avatar %d says that it's not in any relevance region")
+			logger_paging.warning("Avatar %d says that it's not in any relevance region", self.ki_number)
 		
 		diff = self.regions_im_in & ~self.regions_i_care_about
 		if diff != 0:
-			logger_paging.warning("Avatar %d is in regions that it doesn't care about: %s", bin(diff))
+			logger_paging.warning("Avatar %d is in regions that it doesn't care about: %s", self.ki_number, bin(diff))
+		
+		connection.client_state.regions_i_care_about = self.regions_i_care_about
+		connection.client_state.regions_im_in = self.regions_im_in
 
 
 class NetMessagePlayerPage(NetMessage):
@@ -1612,35 +2021,1113 @@ class NetMessagePlayerPage(NetMessage):
 	
 	async def handle(self, connection: "GameConnection") -> None:
 		logger_paging.debug("Avatar %d %s its avatar object: %s", self.ki_number, "unloaded" if self.unload else "loaded", self.uoid)
+		
+		if self.unload and connection.room is not None:
+			released = connection.room.locks.release_all(connection.client_state.ki_number)
+			if released:
+				logger_test_and_set.debug("Released %d locks held by avatar %d, which unloaded its avatar", released, connection.client_state.ki_number)
 
 
-class GameClientState(object):
-	# TODO A lot of this needs to be moved into some kind of shared state when implementing actual multiplayer.
-	mcp_id: int
-	age_node_id: int
-	age_info_node_id: int
-	age_instance_uuid: uuid.UUID
-	age_file_name: str
-	age_sequence_prefix: int
-	account_uuid: uuid.UUID
-	ki_number: int
-	age_sdl_hook_uoid: structs.Uoid
-	locks: typing.Dict[structs.Uoid, int]
+class LockManager(object):
+	"""The TestAndSet locks for all objects in an age instance.
 	
-	def __init__(self) -> None:
+	Locks are leases:
+	if the owner doesn't release a lock within ``lease_time`` seconds,
+	the lock is given to the next client that asks for it.
+	This way,
+	a client that crashed or forgot to release a lock can't block an object forever.
+	A ``lease_time`` of 0 means that locks never expire.
+	
+	Some statistics about lock usage are collected for diagnostics.
+	"""
+	
+	lease_time: float
+	
+	acquired: int
+	denied: int
+	expired: int
+	released: int
+	total_hold_time: float
+	max_hold_time: float
+	
+	# Lock owner's KI number and time when the lock was acquired (according to time.monotonic).
+	_locks: typing.Dict[structs.Uoid, typing.Tuple[int, float]]
+	_locks_by_owner: typing.Dict[int, typing.Set[structs.Uoid]]
+	
+	def __init__(self, lease_time: float) -> None:
 		super().__init__()
 		
-		# Other attributes are intentionally left unset at first.
-		# They will be set in the join_age_request handler shortly after the client has connected.
-		self.locks = {}
+		self.lease_time = lease_time
+		
+		self.acquired = 0
+		self.denied = 0
+		self.expired = 0
+		self.released = 0
+		self.total_hold_time = 0.0
+		self.max_hold_time = 0.0
+		
+		self._locks = {}
+		self._locks_by_owner = {}
 	
-	def try_find_age_sequence_prefix(self, location: structs.Location) -> bool:
-		"""Try to derive the client's age sequence prefix from the given location.
+	def __len__(self) -> int:
+		return len(self._locks)
+	
+	def _remove(self, uoid: structs.Uoid, owner: int, acquired_time: float, now: float) -> None:
+		del self._locks[uoid]
+		owned = self._locks_by_owner[owner]
+		owned.discard(uoid)
+		if not owned:
+			del self._locks_by_owner[owner]
 		
-		The client never directly sends the age sequence prefix,
-		but the server needs to know it so it can send the AgeSDLHook in reply to the GameStateRequest.
-		Normally the server would look up the sequence prefix in the corresponding .age file,
-		but I don't want to implement that yet
+		hold_time = now - acquired_time
+		self.total_hold_time += hold_time
+		self.max_hold_time = max(self.max_hold_time, hold_time)
+	
+	def acquire(self, uoid: structs.Uoid, owner: int) -> typing.Optional[int]:
+		"""Try to lock the given object for the given avatar.
+		
+		If the avatar already holds the lock,
+		it's renewed.
+		
+		:return: ``None`` if the lock was acquired,
+			or the KI number of the current owner if the object is already locked by someone else.
+		"""
+		
+		now = time.monotonic()
+		
+		try:
+			current_owner, acquired_time = self._locks[uoid]
+		except KeyError:
+			pass
+		else:
+			if current_owner == owner:
+				self._locks[uoid] = (owner, now)
+				return None
+			elif self.lease_time > 0 and now - acquired_time >= self.lease_time:
+				logger_test_and_set.info("Lock of %s by avatar %d expired after %.1f seconds - giving it to avatar %d", uoid, current_owner, now - acquired_time, owner)
+				self._remove(uoid, current_owner, acquired_time, now)
+				self.expired += 1
+			else:
+				self.denied += 1
+				return current_owner
+		
+		self._locks[uoid] = (owner, now)
+		self._locks_by_owner.setdefault(owner, set()).add(uoid)
+		self.acquired += 1
+		return None
+	
+	def release(self, uoid: structs.Uoid, owner: int) -> typing.Optional[int]:
+		"""Release the given avatar's lock of the given object.
+		
+		Nothing happens if the object isn't locked by that avatar.
+		
+		:return: The KI number of the avatar that had locked the object before this call,
+			or ``None`` if the object wasn't locked.
+		"""
+		
+		try:
+			current_owner, acquired_time = self._locks[uoid]
+		except KeyError:
+			return None
+		
+		if current_owner == owner:
+			self._remove(uoid, owner, acquired_time, time.monotonic())
+			self.released += 1
+		
+		return current_owner
+	
+	def release_all(self, owner: int, locations: typing.Optional[typing.Container[structs.Location]] = None) -> int:
+		"""Release all locks held by the given avatar,
+		or if ``locations`` is given,
+		only the locks for objects in those locations.
+		
+		:return: The number of locks that were released.
+		"""
+		
+		owned = self._locks_by_owner.get(owner)
+		if not owned:
+			return 0
+		
+		now = time.monotonic()
+		to_release = [uoid for uoid in owned if locations is None or uoid.location in locations]
+		for uoid in to_release:
+			_, acquired_time = self._locks[uoid]
+			self._remove(uoid, owner, acquired_time, now)
+		
+		self.released += len(to_release)
+		return len(to_release)
+	
+	def describe(self) -> str:
+		"""Summarize the current locks and statistics in a human-readable format."""
+		
+		desc = f"{len(self._locks)} locks held by {len(self._locks_by_owner)} avatars, {self.acquired} acquired, {self.denied} denied, {self.expired} expired"
+		finished = self.released + self.expired
+		if finished:
+			desc += f", hold time average {self.total_hold_time / finished:.1f} s, max {self.max_hold_time:.1f} s"
+		return desc
+
+
+class CachedSDLState(object):
+	"""A parsed persistent SDL state kept in memory by :class:`SDLStateCache`.
+	
+	Changes are applied to the parsed record in memory.
+	The record is only written back to a blob when the blob is actually needed
+	(see :meth:`to_blob`).
+	"""
+	
+	header: sdl.SDLStreamHeader
+	record: sdl.GuessedSDLRecord
+	# Whether the state has changes that haven't been saved in the database yet.
+	dirty: bool
+	
+	# The last state that was successfully written to a blob, and that blob.
+	_good_record: sdl.GuessedSDLRecord
+	_good_blob: bytes
+	
+	def __init__(self, header: sdl.SDLStreamHeader, record: sdl.GuessedSDLRecord, blob: bytes, dirty: bool) -> None:
+		super().__init__()
+		
+		self.header = header
+		self.record = record
+		self.dirty = dirty
+		self._good_record = record
+		self._good_blob = blob
+	
+	def apply_change(self, change_header: sdl.SDLStreamHeader, change_record: sdl.GuessedSDLRecord) -> None:
+		if change_header != self.header:
+			raise ValueError(f"Mismatched state descriptors when applying change - current SDL blob has header {self.header}, but the change SDL blob has header {change_header})")
+		
+		self.record = self.record.with_change(change_record)
+		self.dirty = True
+		
+		if logger_sdl_change.isEnabledFor(logging.DEBUG):
+			logger_sdl_change.debug("Changed state:")
+			for line in self.record.as_multiline_str():
+				logger_sdl_change.debug("%s", line.replace("\t", "    "))
+	
+	def to_blob(self) -> bytes:
+		"""Get the current state as an SDL blob.
+		
+		If the changed state can't be written back to a blob correctly,
+		all changes since the last successful call are discarded.
+		"""
+		
+		if self.record is not self._good_record:
+			try:
+				self._good_blob = _write_sdl_blob_checked(self.header, self.record)
+			except ValueError:
+				logger_sdl_change.error("Failed to write changed SDL state %r back to a blob - discarding the changes", self.header.descriptor_name, exc_info=True)
+				self.record = self._good_record
+			else:
+				self._good_record = self.record
+		
+		return self._good_blob
+
+
+class SDLStateCache(object):
+	"""The persistent SDL states for an age instance,
+	parsed and cached in memory.
+	
+	SDL changes from clients are applied to the cached states
+	instead of loading, changing and saving the blob in the database every time.
+	Changed states are saved to the database later in a single batch
+	(see :meth:`save`).
+	"""
+	
+	server_state: state.ServerState
+	age_node_id: int
+	object_states: typing.Dict[typing.Tuple[structs.Uoid, bytes], CachedSDLState]
+	# The AgeSDLHook state is saved in a vault node instead of the object states table.
+	# Both are None if the AgeSDLHook state hasn't been loaded yet.
+	age_sdl_node_id: typing.Optional[int]
+	age_sdl_state: typing.Optional[CachedSDLState]
+	# Initial state messages for all persistent states in the age instance,
+	# already serialized and compressed (see :meth:`initial_state_messages`).
+	# None if they haven't been requested yet.
+	_initial_state_messages: typing.Optional[typing.Dict[typing.Tuple[structs.Uoid, bytes], bytes]]
+	# Cached states that have changed since their initial state message was serialized.
+	_stale_initial_state_messages: typing.Set[typing.Tuple[structs.Uoid, bytes]]
+	_age_sdl_initial_state_message: typing.Optional[bytes]
+	
+	def __init__(self, server_state: state.ServerState, age_node_id: int) -> None:
+		super().__init__()
+		
+		self.server_state = server_state
+		self.age_node_id = age_node_id
+		self.object_states = {}
+		self.age_sdl_node_id = None
+		self.age_sdl_state = None
+		self._initial_state_messages = None
+		self._stale_initial_state_messages = set()
+		self._age_sdl_initial_state_message = None
+	
+	@property
+	def dirty_count(self) -> int:
+		count = sum(1 for cached in self.object_states.values() if cached.dirty)
+		if self.age_sdl_state is not None and self.age_sdl_state.dirty:
+			count += 1
+		return count
+	
+	async def apply_object_change(self, uoid: structs.Uoid, header: sdl.SDLStreamHeader, record: sdl.GuessedSDLRecord, blob: bytes, is_new: bool) -> None:
+		"""Apply a parsed SDL change from a client to the state of an object
+		(loading the state from the database if it's not cached yet).
+		"""
+		
+		key = (uoid, header.descriptor_name)
+		cached = self.object_states.get(key)
+		if cached is None:
+			try:
+				existing_blob = await self.server_state.fetch_object_sdl_state(self.age_node_id, uoid, header.descriptor_name)
+			except state.ObjectStateNotFound:
+				existing_blob = None
+			
+			# Another change for the same object might have been applied while waiting for the database.
+			cached = self.object_states.get(key)
+			if cached is None:
+				if existing_blob is None:
+					logger_sdl.debug("No existing SDL blob found for object %s - will initialize it with the blob sent by the client", uoid)
+					if not is_new:
+						logger_sdl.info("Client sent a non-new SDL change for object %s, but no SDL blob has been saved yet for that object - will use this SDL blob as the initial state", uoid)
+					
+					self.object_states[key] = CachedSDLState(header, record, blob, True)
+					self._stale_initial_state_messages.add(key)
+					await self._save_if_not_deferred()
+					return
+				
+				try:
+					existing_header, existing_record = _parse_saved_sdl_blob(existing_blob)
+				except ValueError:
+					logger_sdl.error("Failed to parse existing saved SDL blob for object %s", uoid, exc_info=True)
+					return
+				
+				cached = CachedSDLState(existing_header, existing_record, existing_blob, False)
+				self.object_states[key] = cached
+		
+		if is_new:
+			logger_sdl.info("Client sent a new SDL state for object %s, but there's already a saved SDL blob for that object - will treat the new blob as a change and apply it to the saved one", uoid)
+		
+		try:
+			cached.apply_change(header, record)
+		except ValueError:
+			logger_sdl.error("Failed to apply change to existing saved SDL blob for object %s", uoid, exc_info=True)
+			return
+		
+		self._stale_initial_state_messages.add(key)
+		await self._save_if_not_deferred()
+	
+	async def load_age_sdl_state(self, connection: "GameConnection") -> typing.Optional[CachedSDLState]:
+		"""Get the age instance's AgeSDLHook state,
+		loading it from the age instance's SDL vault node if it's not cached yet.
+		
+		:return: The AgeSDLHook state,
+			or ``None`` if there's no saved AgeSDLHook state for this age instance.
+		"""
+		
+		cached = self.age_sdl_state
+		if cached is not None:
+			return cached
+		
+		try:
+			age_sdl_node_id = await connection.find_age_sdl_node()
+		except state.VaultNodeNotFound:
+			return None
+		
+		age_sdl_node_data = await self.server_state.fetch_vault_node(age_sdl_node_id)
+		
+		if age_sdl_node_data.string64_1 != connection.client_state.age_file_name:
+			raise base.ProtocolError(f"SDL node {age_sdl_node_id} has SDL name {age_sdl_node_data.string64_1!r}, which doesn't match the age file name {connection.client_state.age_file_name!r}")
+		
+		# The state might have been loaded or created while waiting for the database.
+		if self.age_sdl_state is not None:
+			return self.age_sdl_state
+		
+		self.age_sdl_node_id = age_sdl_node_id
+		if not age_sdl_node_data.blob_1:
+			return None
+		
+		try:
+			header, record = _parse_saved_sdl_blob(age_sdl_node_data.blob_1)
+		except ValueError:
+			logger_sdl.error("Failed to parse SDL blob from age instance SDL vault node", exc_info=True)
+			return None
+		
+		self.age_sdl_state = CachedSDLState(header, record, age_sdl_node_data.blob_1, False)
+		return self.age_sdl_state
+	
+	async def apply_age_sdl_change(self, connection: "GameConnection", header: sdl.SDLStreamHeader, record: sdl.GuessedSDLRecord, blob: bytes) -> None:
+		"""Apply a parsed SDL change from a client to the age instance's AgeSDLHook state,
+		creating the age instance's SDL vault node if necessary.
+		"""
+		
+		try:
+			cached = await self.load_age_sdl_state(connection)
+		except base.ProtocolError:
+			logger_sdl.error("Failed to load age instance SDL vault node", exc_info=True)
+			return
+		
+		if cached is None:
+			if self.age_sdl_node_id is None:
+				logger_sdl.info("Age instance SDL vault node not found - creating one...")
+				age_sdl_node_id = await self.server_state.create_vault_node(state.VaultNodeData(
+					creator_account_uuid=connection.client_state.account_uuid,
+					creator_id=connection.client_state.ki_number,
+					node_type=state.VaultNodeType.sdl,
+					int32_1=0,
+					string64_1=connection.client_state.age_file_name,
+				))
+				await self.server_state.add_vault_node_ref(state.VaultNodeRef(connection.client_state.age_info_node_id, age_sdl_node_id))
+				self.age_sdl_node_id = age_sdl_node_id
+			
+			# Another change might have been applied while the node was being created.
+			if self.age_sdl_state is None:
+				logger_sdl.info("Age instance SDL vault node is empty - will initialize it with the blob sent by the client")
+				self.age_sdl_state = CachedSDLState(header, record, blob, True)
+				self._age_sdl_initial_state_message = None
+				await self._save_if_not_deferred()
+				return
+			
+			cached = self.age_sdl_state
+		
+		try:
+			cached.apply_change(header, record)
+		except ValueError:
+			logger_sdl.error("Failed to apply change to SDL blob from age instance SDL vault node", exc_info=True)
+			return
+		
+		self._age_sdl_initial_state_message = None
+		await self._save_if_not_deferred()
+	
+	async def initial_state_messages(self, connection: "GameConnection") -> typing.List[bytes]:
+		"""Get initial state messages for the AgeSDLHook and all persistent object states in the age instance,
+		serialized as complete propagate buffer messages
+		(see :func:`serialize_propagate_buffer`).
+		
+		The messages are cached
+		and only serialized again for states that have changed since the last call,
+		so that clients linking into a popular age instance
+		don't require loading, compressing and serializing every state again.
+		"""
+		
+		messages = []
+		
+		# If there's no saved AgeSDLHook state for this instance,
+		# assume that this age has no AgeSDLHook.
+		age_sdl_state = await self.load_age_sdl_state(connection)
+		if age_sdl_state is not None:
+			message = self._age_sdl_initial_state_message
+			if message is None:
+				logger_sdl.debug("Serializing initial state for AgeSDLHook %s", connection.client_state.age_sdl_hook_uoid)
+				record = age_sdl_state.record
+				message = serialize_propagate_buffer(await make_initial_state_message(self.server_state.compression, connection.client_state.age_sdl_hook_uoid, age_sdl_state.to_blob()))
+				# Don't cache the message if the state has changed again while it was being compressed.
+				if age_sdl_state.record is record:
+					self._age_sdl_initial_state_message = message
+			messages.append(message)
+		
+		if self._initial_state_messages is None:
+			initial_state_messages = {}
+			async for uoid, state_desc_name, sdl_blob in self.server_state.find_object_sdl_states(self.age_node_id):
+				# Cached states are handled below.
+				if (uoid, state_desc_name) not in self.object_states:
+					initial_state_messages[uoid, state_desc_name] = serialize_propagate_buffer(await make_initial_state_message(self.server_state.compression, uoid, sdl_blob))
+			
+			# States that are cached in memory may have changes that haven't been saved yet
+			# or may not have been saved to the database at all yet,
+			# so these are always serialized from the cache.
+			self._stale_initial_state_messages.update(self.object_states)
+			self._initial_state_messages = initial_state_messages
+			logger_sdl.debug("Serialized initial states for %d objects from database for age instance %d", len(initial_state_messages), self.age_node_id)
+		
+		# Compressing may not finish right away,
+		# so take the stale states out first.
+		# States that change again in the meantime are marked as stale again
+		# and will be serialized again next time.
+		stale = self._stale_initial_state_messages
+		self._stale_initial_state_messages = set()
+		for key in stale:
+			uoid, _ = key
+			self._initial_state_messages[key] = serialize_propagate_buffer(await make_initial_state_message(self.server_state.compression, uoid, self.object_states[key].to_blob()))
+		if stale:
+			logger_sdl.debug("Serialized initial states for %d changed objects for age instance %d", len(stale), self.age_node_id)
+		
+		messages.extend(self._initial_state_messages.values())
+		return messages
+	
+	async def _save_if_not_deferred(self) -> None:
+		if self.server_state.config.server_game_sdl_save_interval == 0:
+			await self.save()
+	
+	async def save(self) -> None:
+		"""Save all changed SDL states to the database."""
+		
+		object_states = []
+		for (uoid, descriptor_name), cached in self.object_states.items():
+			if cached.dirty:
+				cached.dirty = False
+				object_states.append((uoid, descriptor_name, cached.to_blob()))
+		
+		age_sdl_blob = None
+		if self.age_sdl_state is not None and self.age_sdl_state.dirty:
+			self.age_sdl_state.dirty = False
+			age_sdl_blob = self.age_sdl_state.to_blob()
+		
+		try:
+			if object_states:
+				logger_sdl.debug("Saving %d changed object SDL states for age instance %d", len(object_states), self.age_node_id)
+				await self.server_state.save_object_sdl_states(self.age_node_id, object_states)
+			
+			if age_sdl_blob is not None:
+				assert self.age_sdl_node_id is not None
+				logger_sdl.debug("Saving changed AgeSDLHook state for age instance %d", self.age_node_id)
+				await self.server_state.update_vault_node(self.age_sdl_node_id, state.VaultNodeData(blob_1=age_sdl_blob), uuid.uuid4())
+		except BaseException:
+			# Try again on the next save.
+			for uoid, descriptor_name, _ in object_states:
+				self.object_states[uoid, descriptor_name].dirty = True
+			if age_sdl_blob is not None and self.age_sdl_state is not None:
+				self.age_sdl_state.dirty = True
+			raise
+
+
+class VolatileSDLState(CachedSDLState):
+	"""A non-persistent SDL state kept in memory by :class:`VolatileSDLStore`."""
+	
+	# KI number of the avatar that the state belongs to.
+	owner: int
+	is_avatar_state: bool
+	# Approximate memory used by the state:
+	# the size of the blob that the state was last written to,
+	# or of the largest change received since then if that's larger.
+	size: int
+	
+	def __init__(self, header: sdl.SDLStreamHeader, record: sdl.GuessedSDLRecord, blob: bytes, owner: int, is_avatar_state: bool) -> None:
+		super().__init__(header, record, blob, False)
+		
+		self.owner = owner
+		self.is_avatar_state = is_avatar_state
+		self.size = len(blob)
+
+
+class VolatileSDLStore(object):
+	"""The latest non-persistent SDL states (including avatar and clone states) in an age instance,
+	so that they can be sent to clients that join later.
+	
+	Without this,
+	new clients would only see these states once the other clients happen to send them again.
+	
+	The states are never saved to the database.
+	Each state belongs to an avatar
+	(the cloning avatar for clone states,
+	otherwise the avatar that sent the state)
+	and is discarded when that avatar leaves the age instance.
+	If the states use more than ``max_size`` bytes,
+	the least recently changed ones are discarded.
+	"""
+	
+	max_size: int
+	size: int
+	evicted: int
+	# Ordered from least to most recently changed.
+	states: "collections.OrderedDict[typing.Tuple[structs.Uoid, bytes], VolatileSDLState]"
+	# Keys of the states that belong to each avatar,
+	# so that an avatar's states can be discarded without looking at all other states.
+	_keys_by_owner: typing.Dict[int, typing.Set[typing.Tuple[structs.Uoid, bytes]]]
+	
+	def __init__(self, max_size: int) -> None:
+		super().__init__()
+		
+		self.max_size = max_size
+		self.size = 0
+		self.evicted = 0
+		self.states = collections.OrderedDict()
+		self._keys_by_owner = {}
+	
+	def __len__(self) -> int:
+		return len(self.states)
+	
+	def _forget_owner(self, key: typing.Tuple[structs.Uoid, bytes], owner: int) -> None:
+		keys = self._keys_by_owner[owner]
+		keys.discard(key)
+		if not keys:
+			del self._keys_by_owner[owner]
+	
+	def apply_change(self, sender: int, uoid: structs.Uoid, header: sdl.SDLStreamHeader, record: sdl.GuessedSDLRecord, blob: bytes, is_avatar_state: bool) -> None:
+		"""Apply a parsed non-persistent SDL change from the avatar ``sender``
+		to the stored state for the object,
+		or store it as a new state if there's no stored state yet.
+		"""
+		
+		if uoid.clone_ids is not None:
+			_, owner = uoid.clone_ids
+		else:
+			owner = sender
+		
+		key = (uoid, header.descriptor_name)
+		volatile_state = self.states.pop(key, None)
+		if volatile_state is not None:
+			self.size -= volatile_state.size
+			self._forget_owner(key, volatile_state.owner)
+			try:
+				volatile_state.apply_change(header, record)
+			except ValueError:
+				logger_sdl.warning("Failed to apply change to non-persistent SDL state for object %s - replacing the state", uoid, exc_info=True)
+				volatile_state = None
+			else:
+				volatile_state.owner = owner
+				volatile_state.is_avatar_state = is_avatar_state
+				volatile_state.size = max(volatile_state.size, len(blob))
+		
+		if volatile_state is None:
+			volatile_state = VolatileSDLState(header, record, blob, owner, is_avatar_state)
+		
+		self.states[key] = volatile_state
+		self.size += volatile_state.size
+		self._keys_by_owner.setdefault(owner, set()).add(key)
+		
+		while self.size > self.max_size and self.states:
+			evicted_key, evicted_state = self.states.popitem(last=False)
+			self.size -= evicted_state.size
+			self._forget_owner(evicted_key, evicted_state.owner)
+			self.evicted += 1
+			logger_sdl.debug("Discarded non-persistent SDL state for object %s to stay within the memory limit", evicted_key[0])
+	
+	def remove_owner(self, owner: int) -> int:
+		"""Discard all states that belong to the given avatar.
+		
+		:return: The number of states that were discarded.
+		"""
+		
+		keys = self._keys_by_owner.pop(owner, set())
+		for key in keys:
+			self.size -= self.states.pop(key).size
+		return len(keys)
+	
+	def initial_states(self, exclude_owner: int) -> typing.List[typing.Tuple[structs.Uoid, bytes, bool]]:
+		"""Get the current blobs of all states
+		that don't belong to the avatar ``exclude_owner``,
+		along with their object UOIDs and whether they're avatar states.
+		
+		Writing the states to blobs also updates their sizes to the exact blob size.
+		"""
+		
+		states = []
+		for (uoid, _), volatile_state in self.states.items():
+			if volatile_state.owner != exclude_owner:
+				blob = volatile_state.to_blob()
+				self.size += len(blob) - volatile_state.size
+				volatile_state.size = len(blob)
+				states.append((uoid, blob, volatile_state.is_avatar_state))
+		return states
+
+
+class CloneRegistry(object):
+	"""The currently loaded clones (e. g. avatars and other spawned objects) in an age instance,
+	so that they can be sent to clients that join later.
+	
+	For every clone,
+	only the latest load clone message is kept
+	(already serialized and with the initial state flag set),
+	so the memory use only depends on the number of currently loaded clones.
+	Clones are removed when they are unloaded
+	or when the avatar that loaded them leaves the age instance.
+	"""
+	
+	# Values are the KI number of the avatar that loaded the clone and the serialized load clone message.
+	# Ordered by the time the clones were loaded.
+	clones: typing.Dict[structs.Uoid, typing.Tuple[int, bytes]]
+	
+	def __init__(self) -> None:
+		super().__init__()
+		
+		self.clones = {}
+	
+	def __len__(self) -> int:
+		return len(self.clones)
+	
+	def load(self, sender: int, uoid: structs.Uoid, message: bytes) -> None:
+		"""Remember a clone loaded by the avatar ``sender``.
+		
+		:param message: The load clone message,
+			serialized as a complete propagate buffer message
+			(see :func:`serialize_propagate_buffer`).
+		"""
+		
+		if uoid.clone_ids is not None:
+			_, owner = uoid.clone_ids
+		else:
+			owner = sender
+		
+		# Make sure that a reloaded clone is sent after the clones that were loaded earlier.
+		self.clones.pop(uoid, None)
+		self.clones[uoid] = (owner, message)
+	
+	def unload(self, uoid: structs.Uoid) -> bool:
+		return self.clones.pop(uoid, None) is not None
+	
+	def remove_owner(self, owner: int) -> int:
+		"""Forget all clones loaded by the given avatar.
+		
+		:return: The number of clones that were removed.
+		"""
+		
+		uoids = [uoid for uoid, (clone_owner, _) in self.clones.items() if clone_owner == owner]
+		for uoid in uoids:
+			del self.clones[uoid]
+		return len(uoids)
+	
+	def initial_messages(self, exclude_owner: int) -> typing.List[bytes]:
+		"""Get the load clone messages for all currently loaded clones
+		that weren't loaded by the avatar ``exclude_owner``.
+		"""
+		
+		return [message for owner, message in self.clones.values() if owner != exclude_owner]
+
+
+class SendPriorityStatistics(object):
+	"""Counters for the messages of one :class:`SendPriority` that have left a :class:`MemberSendQueue`."""
+	
+	sent: int
+	# Unreliable messages that waited in the queue for longer than the deadline.
+	dropped: int
+	# Time that the sent messages waited in the queue, in seconds.
+	total_latency: float
+	max_latency: float
+	
+	def __init__(self) -> None:
+		super().__init__()
+		
+		self.sent = 0
+		self.dropped = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+	
+	def add(self, other: "SendPriorityStatistics") -> None:
+		"""Add the counters from ``other`` to this object's counters."""
+		
+		self.sent += other.sent
+		self.dropped += other.dropped
+		self.total_latency += other.total_latency
+		self.max_latency = max(self.max_latency, other.max_latency)
+	
+	def describe(self) -> str:
+		desc = f"{self.sent} sent, {self.dropped} dropped"
+		if self.sent:
+			desc += f", queue latency average {self.total_latency / self.sent * 1000:.1f} ms, max {self.max_latency * 1000:.1f} ms"
+		return desc
+
+
+class MemberSendQueue(object):
+	"""Messages from other clients that are waiting to be sent to a single member of an :class:`AgeInstanceRoom`.
+	
+	Each message is stored as its class index and serialized data.
+	The serialized data is shared between all recipients of the same message ---
+	it's only encrypted separately for each recipient when it's actually sent.
+	
+	Messages are sent in order of their :class:`SendPriority` and then in the order they were queued.
+	Unreliable messages that have been waiting for longer than ``deadline`` seconds
+	(if it's greater than 0)
+	are dropped instead of being sent,
+	so that a client that has fallen behind doesn't receive outdated messages
+	and has a chance to catch up again.
+	
+	Messages that only describe the current state of an object
+	(those with a :meth:`~NetMessage.coalesce_key`)
+	are coalesced:
+	if an older message with the same key is still waiting to be sent,
+	the newer message replaces it in its place in the queue.
+	This way,
+	a client that has fallen behind catches up again
+	instead of receiving more and more outdated state updates,
+	and the queue doesn't grow because of them.
+	"""
+	
+	max_size: int
+	deadline: float
+	# Number of messages that were replaced by a newer message with the same coalesce key.
+	coalesced: int
+	# Indexed by SendPriority.
+	statistics: typing.List[SendPriorityStatistics]
+	# One queue per SendPriority,
+	# each containing the class index, data, coalesce key, and time queued (see time.monotonic) of each message.
+	_queues: typing.List[typing.Deque[typing.Tuple[int, bytes, typing.Optional[CoalesceKey], float]]]
+	_size: int
+	# The newest class index, data, and time queued for each coalesce key that's still in the queue,
+	# which are used instead of those that were originally queued under that key.
+	_latest: typing.Dict[CoalesceKey, typing.Tuple[int, bytes, float]]
+	_waiter: "typing.Optional[asyncio.Future[None]]"
+	
+	def __init__(self, max_size: int, deadline: float) -> None:
+		super().__init__()
+		
+		self.max_size = max_size
+		self.deadline = deadline
+		self.coalesced = 0
+		self.statistics = [SendPriorityStatistics() for _ in SendPriority]
+		self._queues = [collections.deque() for _ in SendPriority]
+		self._size = 0
+		self._latest = {}
+		self._waiter = None
+	
+	def __len__(self) -> int:
+		return self._size
+	
+	def put(self, class_index: int, buffer: bytes, coalesce_key: typing.Optional[CoalesceKey] = None, priority: SendPriority = SendPriority.control) -> bool:
+		"""Add a message to the end of the queue for its ``priority`` without waiting,
+		or replace an older queued message with the same ``coalesce_key``.
+		
+		If the queue is full,
+		unreliable messages that have been waiting for too long are dropped first to make room.
+		
+		:return: ``True`` if the message was queued,
+			or ``False`` if the queue is still full.
+		"""
+		
+		now = time.monotonic()
+		if coalesce_key is not None and coalesce_key in self._latest:
+			self._latest[coalesce_key] = (class_index, buffer, now)
+			self.coalesced += 1
+			return True
+		
+		if self._size >= self.max_size and not self.drop_stale():
+			return False
+		
+		self._queues[priority].append((class_index, buffer, coalesce_key, now))
+		self._size += 1
+		if coalesce_key is not None:
+			self._latest[coalesce_key] = (class_index, buffer, now)
+		if self._waiter is not None and not self._waiter.done():
+			self._waiter.set_result(None)
+		return True
+	
+	def drop_stale(self) -> int:
+		"""Drop all unreliable messages at the front of the queues
+		that have been waiting for longer than the deadline.
+		
+		:return: The number of messages that were dropped.
+		"""
+		
+		if self.deadline <= 0:
+			return 0
+		
+		now = time.monotonic()
+		dropped = 0
+		for priority, queue in enumerate(self._queues):
+			if priority == CONTROL_PRIORITY:
+				continue
+			
+			while queue:
+				_, _, coalesce_key, queued_time = queue[0]
+				if coalesce_key is not None:
+					_, _, queued_time = self._latest[coalesce_key]
+				if now - queued_time <= self.deadline:
+					break
+				
+				queue.popleft()
+				self._size -= 1
+				if coalesce_key is not None:
+					del self._latest[coalesce_key]
+				self.statistics[priority].dropped += 1
+				dropped += 1
+		return dropped
+	
+	async def get(self) -> typing.Tuple[int, bytes]:
+		"""Remove and return the oldest message with the highest priority
+		(or the newest message that replaced it),
+		waiting for one to be queued if necessary.
+		
+		Unreliable messages that have been waiting for too long are dropped along the way.
+		"""
+		
+		while True:
+			while not self._size:
+				self._waiter = asyncio.get_running_loop().create_future()
+				try:
+					await self._waiter
+				finally:
+					self._waiter = None
+			
+			queues = self._queues
+			priority = CONTROL_PRIORITY
+			while not queues[priority]:
+				priority += 1
+			
+			class_index, buffer, coalesce_key, queued_time = queues[priority].popleft()
+			self._size -= 1
+			if coalesce_key is not None:
+				class_index, buffer, queued_time = self._latest.pop(coalesce_key)
+			
+			waited = time.monotonic() - queued_time
+			statistics = self.statistics[priority]
+			if priority != CONTROL_PRIORITY and 0 < self.deadline < waited:
+				statistics.dropped += 1
+			else:
+				statistics.sent += 1
+				statistics.total_latency += waited
+				if waited > statistics.max_latency:
+					statistics.max_latency = waited
+				return class_index, buffer
+	
+	def clear(self) -> None:
+		for queue in self._queues:
+			queue.clear()
+		self._size = 0
+		self._latest.clear()
+
+
+class AgeInstanceRoom(object):
+	"""All game server connections that are currently in the same age instance.
+	
+	Messages that a client sends to other clients are forwarded through the room.
+	Each message is serialized only once
+	and then added to every recipient's :class:`MemberSendQueue`,
+	from where it's sent by a separate task for each recipient.
+	This way,
+	a client that receives data slowly only delays its own messages
+	and not those for everyone else in the age instance.
+	"""
+	
+	server_state: state.ServerState
+	age_node_id: int
+	# The key is the member's KI number.
+	members: typing.Dict[int, "GameConnection"]
+	locks: LockManager
+	sdl_states: SDLStateCache
+	volatile_sdl_states: VolatileSDLStore
+	clones: CloneRegistry
+	_save_task: typing.Optional[asyncio.Task[None]]
+	
+	def __init__(self, server_state: state.ServerState, age_node_id: int) -> None:
+		super().__init__()
+		
+		self.server_state = server_state
+		self.age_node_id = age_node_id
+		self.members = {}
+		self.locks = LockManager(server_state.config.server_game_lock_lease_time)
+		self.sdl_states = SDLStateCache(server_state, age_node_id)
+		self.volatile_sdl_states = VolatileSDLStore(server_state.config.server_game_max_volatile_sdl_size)
+		self.clones = CloneRegistry()
+		
+		if server_state.config.server_game_sdl_save_interval > 0:
+			self._save_task = server_state.loop.create_task(self._save_periodically(server_state.config.server_game_sdl_save_interval))
+			server_state.add_background_task(self._save_task)
+		else:
+			self._save_task = None
+	
+	def __repr__(self) -> str:
+		return f"<{type(self).__qualname__} for age instance {self.age_node_id}: {len(self.members)} members>"
+	
+	def add_member(self, connection: "GameConnection") -> None:
+		ki_number = connection.client_state.ki_number
+		old_connection = self.members.get(ki_number)
+		if old_connection is not None and old_connection is not connection:
+			logger_forward.warning("Avatar %d joined age instance %d again with a new connection - the old connection will no longer receive messages", ki_number, self.age_node_id)
+		
+		self.members[ki_number] = connection
+	
+	def remove_member(self, connection: "GameConnection") -> None:
+		ki_number = connection.client_state.ki_number
+		# Don't remove a newer connection for the same avatar.
+		if self.members.get(ki_number) is connection:
+			del self.members[ki_number]
+			
+			released = self.locks.release_all(ki_number)
+			if released:
+				logger_test_and_set.debug("Released %d locks held by avatar %d, which left age instance %d", released, ki_number, self.age_node_id)
+			
+			discarded = self.volatile_sdl_states.remove_owner(ki_number)
+			if discarded:
+				logger_sdl.debug("Discarded %d non-persistent SDL states of avatar %d, which left age instance %d", discarded, ki_number, self.age_node_id)
+			
+			unloaded = self.clones.remove_owner(ki_number)
+			if unloaded:
+				logger_pl_message.debug("Forgot %d clones loaded by avatar %d, which left age instance %d", unloaded, ki_number, self.age_node_id)
+	
+	async def save_sdl_states(self) -> None:
+		"""Save all changed SDL states for the age instance to the database.
+		
+		Errors are logged and not propagated,
+		so that a failed save doesn't affect the clients.
+		"""
+		
+		try:
+			await self.sdl_states.save()
+		except Exception:
+			logger_sdl.error("Failed to save SDL states for age instance %d", self.age_node_id, exc_info=True)
+	
+	async def _save_periodically(self, interval: float) -> None:
+		while True:
+			await asyncio.sleep(interval)
+			await self.save_sdl_states()
+	
+	async def close_if_empty(self) -> None:
+		"""Save all changed SDL states
+		and then remove the room if nobody has joined it again in the meantime.
+		
+		The room is kept until the states are saved,
+		so that a client joining the same age instance while saving
+		doesn't load outdated states from the database.
+		"""
+		
+		await self.save_sdl_states()
+		
+		if not self.members and self.server_state.age_instance_rooms.get(self.age_node_id) is self:
+			logger_forward.debug("Closing empty age instance %d", self.age_node_id)
+			del self.server_state.age_instance_rooms[self.age_node_id]
+			if self._save_task is not None:
+				self._save_task.cancel()
+				self._save_task = None
+	
+	def send_statistics(self) -> typing.List[SendPriorityStatistics]:
+		"""Add up the send queue statistics of all current members of the room,
+		indexed by :class:`SendPriority`.
+		"""
+		
+		totals = [SendPriorityStatistics() for _ in SendPriority]
+		for member in self.members.values():
+			for total, statistics in zip(totals, member.send_queue.statistics):
+				total.add(statistics)
+		return totals
+	
+	def recipients_for(self, sender: "GameConnection", flags: int) -> typing.List["GameConnection"]:
+		"""Find all other members of the room that should receive a message with the given flags from ``sender``.
+		
+		If the message has the :attr:`~NetMessageFlags.use_relevance_regions` flag set,
+		it's only sent to members that care about at least one of the relevance regions that the sender is in.
+		"""
+		
+		regions = sender.client_state.regions_im_in
+		if flags & USE_RELEVANCE_REGIONS_FLAG and regions is not None:
+			# Members that haven't sent their relevance regions yet receive everything.
+			recipients = []
+			for member in self.members.values():
+				if member is not sender:
+					care = member.client_state.regions_i_care_about
+					if care is None or care & regions:
+						recipients.append(member)
+		else:
+			recipients = [member for member in self.members.values() if member is not sender]
+		return recipients
+	
+	def forward(self, sender: "GameConnection", message: NetMessage) -> int:
+		"""Forward a message from ``sender`` to all other members of the room
+		(filtered by relevance regions, see :meth:`recipients_for`).
+		
+		:return: The number of members that the message was queued for.
+		"""
+		
+		recipients = self.recipients_for(sender, message.flags)
+		queue_for_recipients(recipients, message)
+		logger_forward.debug("Forwarded %s from avatar %d to %d other members of age instance %d", message.class_description, sender.client_state.ki_number, len(recipients), self.age_node_id)
+		return len(recipients)
+
+
+async def save_all_age_instance_states(server_state: state.ServerState) -> None:
+	"""Save all changed SDL states for all age instances with connected clients,
+	e. g. when the server shuts down.
+	"""
+	
+	for room in list(server_state.age_instance_rooms.values()):
+		await room.save_sdl_states()
+
+
+async def make_initial_state_message(service: compression.CompressionService, uoid: structs.Uoid, sdl_blob: bytes, *, persistent: bool = True, is_avatar_state: bool = False, pressure: float = 0.0) -> "NetMessageSDLState":
+	message = NetMessageSDLState()
+	message.uoid = uoid
+	await message.compress_and_set_data_async(sdl_blob, service, pressure=pressure)
+	message.is_initial_state = True
+	message.persist_on_server = persistent
+	message.is_avatar_state = is_avatar_state
+	return message
+
+
+def serialize_propagate_buffer(message: NetMessage) -> bytes:
+	"""Serialize a message as a complete propagate buffer message
+	(including the message type and propagate buffer header),
+	which can be passed to :meth:`~base.BaseMOULConnection.write_chunks` as-is.
+	"""
+	
+	buffer = message.to_bytes_with_class_index()
+	return structs.UINT16.pack(2) + PROPAGATE_BUFFER_HEADER.pack(message.class_index, len(buffer)) + buffer
+
+
+def queue_buffer_for_recipients(recipients: typing.Sequence["GameConnection"], class_index: int, buffer: bytes, coalesce_key: typing.Optional[CoalesceKey] = None, priority: SendPriority = SendPriority.control) -> None:
+	"""Queue an already serialized message to be sent to all of the given connections
+	(see :meth:`MemberSendQueue.put` for ``coalesce_key`` and ``priority``).
+	"""
+	
+	for recipient in recipients:
+		recipient.queue_propagate_buffer(class_index, buffer, coalesce_key, priority)
+
+
+def queue_for_recipients(recipients: typing.Sequence["GameConnection"], message: NetMessage) -> None:
+	"""Serialize a message once
+	(or not at all if it was received from a client and is unchanged)
+	and queue it to be sent to all of the given connections.
+	"""
+	
+	if recipients:
+		queue_buffer_for_recipients(recipients, message.class_index, message.to_bytes_with_class_index(), message.coalesce_key(), message.send_priority())
+
+
+# Classes of all messages that wrap a plMessage
+# and can be sampled for background inspection.
+SAMPLED_CLASS_INDICES = frozenset(
+	clazz.CLASS_INDEX
+	for clazz in [NetMessageGameMessage, NetMessageGameMessageDirected, NetMessageLoadClone]
+)
+
+
+def inspect_sampled_game_message(data: bytes) -> str:
+	"""Fully parse and check a game message that was sampled for background inspection
+	(see :class:`inspection.SampledInspector`).
+	
+	:return: The class of the wrapped plMessage, for the statistics.
+	"""
+	
+	(class_index,) = structs.CLASS_INDEX.unpack_from(data)
+	message = NetMessage.from_class_index(class_index)
+	assert isinstance(message, NetMessageGameMessage)
+	message.read_lazy(data)
+	message.read_rest()
+	
+	pl_message = message.inspect_wrapped_message(None)
+	if pl_message is None:
+		return "(failed to parse)"
+	else:
+		return pl_message.class_description
+
+
+class GameClientState(object):
+	# TODO A lot of this needs to be moved into some kind of shared state when implementing actual multiplayer.
+	mcp_id: int
+	age_node_id: int
+	age_info_node_id: int
+	age_instance_uuid: uuid.UUID
+	age_file_name: str
+	age_sequence_prefix: int
+	account_uuid: uuid.UUID
+	ki_number: int
+	age_sdl_hook_uoid: structs.Uoid
+	# Bit masks from the client's last NetMessageRelevanceRegions,
+	# or None if the client hasn't sent its relevance regions yet.
+	regions_i_care_about: typing.Optional[int]
+	regions_im_in: typing.Optional[int]
+	
+	def __init__(self) -> None:
+		super().__init__()
+		
+		# Other attributes are intentionally left unset at first.
+		# They will be set in the join_age_request handler shortly after the client has connected.
+		self.regions_i_care_about = None
+		self.regions_im_in = None
+	
+	def try_find_age_sequence_prefix(self, location: structs.Location) -> bool:
+		"""Try to derive the client's age sequence prefix from the given location.
+		
+		The client never directly sends the age sequence prefix,
+		but the server needs to know it so it can send the AgeSDLHook in reply to the GameStateRequest.
+		Normally the server would look up the sequence prefix in the corresponding .age file,
+		but I don't want to implement that yet
 		(and also would like to avoid depending on age-specific data files as much as possible).
 		So as a workaround,
 		wait for a message from the client that contains a non-global location
@@ -1677,12 +3164,20 @@ class GameConnection(base.BaseMOULConnection):
 	CONNECTION_TYPE = base.ConnectionType.cli2game
 	
 	client_state: GameClientState
+	# The age instance that the client has joined,
+	# or None before the client has joined an age instance and after it has disconnected.
+	room: typing.Optional[AgeInstanceRoom]
+	send_queue: MemberSendQueue
+	_send_queue_task: "typing.Optional[asyncio.Task[None]]"
 	
-	def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server_state: state.ServerState) -> None:
+	def __init__(self, reader: typing.Optional[asyncio.StreamReader], writer: base.Writer, server_state: state.ServerState) -> None:
 		super().__init__(reader, writer, server_state)
 		
 		self.dh_keys = self.server_state.config.server_game_keys
 		self.client_state = GameClientState()
+		self.room = None
+		self.send_queue = MemberSendQueue(self.server_state.config.server_game_max_queued_messages, self.server_state.config.server_game_unreliable_send_deadline)
+		self._send_queue_task = None
 	
 	async def read_connect_packet_data(self) -> None:
 		data_length, account_uuid, age_instance_uuid = await self.read_unpack(CONNECT_DATA)
@@ -1775,20 +3270,143 @@ class GameConnection(base.BaseMOULConnection):
 		self.client_state.ki_number = ki_number
 		logger_join.info("Account %s, avatar %d joined age instance %d: %r, %r (%d) %r, %s", account_uuid, ki_number, mcp_id, age_file_name, age_info_node_data.string64_4, age_info_node_data.int32_1, age_info_node_data.string64_3, age_instance_uuid)
 		
+		self.join_room()
 		await self.join_age_reply(trans_id, base.NetError.success)
 	
+	async def handle_disconnect(self) -> None:
+		self.leave_room()
+	
+	def join_room(self) -> None:
+		"""Add this connection to the :class:`AgeInstanceRoom` for the age instance that the client has joined,
+		creating the room if necessary,
+		and start sending messages forwarded from other clients.
+		"""
+		
+		try:
+			room = self.server_state.age_instance_rooms[self.client_state.age_node_id]
+		except KeyError:
+			room = AgeInstanceRoom(self.server_state, self.client_state.age_node_id)
+			self.server_state.age_instance_rooms[self.client_state.age_node_id] = room
+		
+		room.add_member(self)
+		self.room = room
+		self.server_state.game_connections_by_ki_number[self.client_state.ki_number] = self
+		
+		self._send_queue_task = self.server_state.loop.create_task(self._send_queued_messages())
+		self.server_state.add_background_task(self._send_queue_task)
+	
+	def leave_room(self) -> None:
+		"""Remove this connection from its :class:`AgeInstanceRoom`
+		and discard any messages that haven't been sent to the client yet.
+		
+		Does nothing if the connection isn't in a room.
+		"""
+		
+		if self._send_queue_task is not None:
+			self._send_queue_task.cancel()
+			self._send_queue_task = None
+		self.send_queue.clear()
+		
+		room = self.room
+		if room is None:
+			return
+		
+		room.remove_member(self)
+		self.room = None
+		# Don't remove a newer connection for the same avatar.
+		if self.server_state.game_connections_by_ki_number.get(self.client_state.ki_number) is self:
+			del self.server_state.game_connections_by_ki_number[self.client_state.ki_number]
+		
+		if not room.members:
+			logger_forward.debug("Last member left age instance %d", room.age_node_id)
+			self.server_state.create_background_task(room.close_if_empty())
+	
+	def forward_propagate_buffer(self, message: NetMessage, receivers: typing.Optional[typing.Iterable[int]] = None, *, inter_age: bool = False) -> int:
+		"""Forward a message received from this client to other clients.
+		
+		If ``receivers`` is ``None``,
+		the message is sent to all other clients in the same age instance
+		(see :meth:`AgeInstanceRoom.forward`).
+		Otherwise,
+		it's only sent to the clients with the given KI numbers.
+		Receivers that aren't connected to the game server are ignored,
+		as are receivers in other age instances unless ``inter_age`` is true.
+		
+		This doesn't wait for the message to actually be sent to the other clients.
+		
+		:return: The number of clients that the message was queued for.
+		"""
+		
+		if self.room is None:
+			logger_forward.warning("Client sent %s before joining an age instance - not forwarding it", message.class_description)
+			return 0
+		
+		if receivers is None:
+			return self.room.forward(self, message)
+		
+		recipients = self.find_receivers(receivers, inter_age=inter_age)
+		queue_for_recipients(recipients, message)
+		logger_forward.debug("Forwarded %s from avatar %d to %d receivers", message.class_description, self.client_state.ki_number, len(recipients))
+		return len(recipients)
+	
+	def find_receivers(self, receivers: typing.Iterable[int], *, inter_age: bool = False) -> typing.List["GameConnection"]:
+		"""Find the connections for the given receiver KI numbers of a message from this client
+		(see :meth:`forward_propagate_buffer`).
+		"""
+		
+		# Indexed by KI number so that duplicate receivers only get the message once.
+		recipients: typing.Dict[int, GameConnection] = {}
+		for ki_number in receivers:
+			recipient = self.server_state.game_connections_by_ki_number.get(ki_number)
+			if recipient is None:
+				logger_forward.debug("Not forwarding message from avatar %d to avatar %d, which isn't connected", self.client_state.ki_number, ki_number)
+			elif recipient.room is not self.room and not inter_age:
+				logger_forward.debug("Not forwarding message from avatar %d to avatar %d, which is in a different age instance", self.client_state.ki_number, ki_number)
+			elif recipient is not self:
+				recipients[ki_number] = recipient
+		return list(recipients.values())
+	
+	def queue_propagate_buffer(self, class_index: int, buffer: bytes, coalesce_key: typing.Optional[CoalesceKey] = None, priority: SendPriority = SendPriority.control) -> None:
+		"""Queue a serialized message from another client to be sent to this client
+		(see :meth:`MemberSendQueue.put` for ``coalesce_key`` and ``priority``).
+		
+		If the client has fallen too far behind with receiving messages,
+		it's disconnected instead,
+		so that the queue doesn't grow without limit.
+		"""
+		
+		if not self.send_queue.put(class_index, buffer, coalesce_key, priority):
+			logger_forward.warning("Avatar %d isn't receiving messages fast enough (%d messages queued) - disconnecting it", self.client_state.ki_number, len(self.send_queue))
+			self.leave_room()
+			self.writer.close()
+	
+	async def _send_queued_messages(self) -> None:
+		try:
+			while True:
+				class_index, buffer = await self.send_queue.get()
+				await self.write_message(2, PROPAGATE_BUFFER_HEADER.pack(class_index, len(buffer)), buffer)
+		except ConnectionError:
+			# The connection is closing - handle_disconnect takes care of cleaning up.
+			pass
+	
 	async def send_propagate_buffer(self, message: NetMessage, *, set_time_sent: bool = True) -> None:
 		if set_time_sent:
+			now = datetime.datetime.now(tz=datetime.timezone.utc)
+			if message.raw_data is not None and NetMessageFlags.has_time_sent in message.flags:
+				# Echoing a message back to its sender -
+				# only the time sent needs to change.
+				message.raw_data = patch_net_message_header(message.raw_data, time_sent=now)
+			else:
+				message.raw_data = None
 			message.flags |= NetMessageFlags.has_time_sent
-			message.time_sent = datetime.datetime.now(tz=datetime.timezone.utc)
-		
-		logger_net_message.debug("Sending propagate buffer: %r", message)
+			message.time_sent = now
 		
-		with io.BytesIO() as stream:
-			message.write_with_class_index(stream)
-			buffer = stream.getvalue()
+		if logger_net_message.isEnabledFor(logging.DEBUG):
+			message.read_rest()
+			logger_net_message.debug("Sending propagate buffer: %r", message)
 		
-		await self.write_message(2, PROPAGATE_BUFFER_HEADER.pack(message.class_index, len(buffer)) + buffer)
+		buffer = message.to_bytes_with_class_index()
+		await self.write_message(2, PROPAGATE_BUFFER_HEADER.pack(message.class_index, len(buffer)), buffer)
 	
 	async def find_age_sdl_node(self) -> int:
 		return await self.server_state.find_unique_vault_node(
@@ -1796,46 +3414,114 @@ class GameConnection(base.BaseMOULConnection):
 			parent_id=self.client_state.age_info_node_id,
 		)
 	
-	async def send_initial_age_sdl(self, age_sdl_blob: bytes) -> None:
-		"""Send the given SDL blob to the client as the initial state for the AgeSDLHook.
+	async def try_forward_raw_propagate_buffer(self, class_index: int, data: bytes) -> bool:
+		"""Forward a plain game message or voice message from this client
+		without parsing it into a :class:`NetMessage` object or serializing it again.
+		
+		Only the flags and the fields needed for routing are read directly from the received data,
+		which is then forwarded as-is.
+		Messages that need closer inspection
+		(because of unusual flags, full plMessage parsing, debug logging, or malformed data)
+		are left for the normal parsing path.
 		
-		Can only be called if the :attr:`GameClientState.age_sequence_prefix` has been initialized.
+		:return: Whether the message was handled.
+			If not,
+			nothing has been done with it yet
+			and it must be parsed and handled normally.
 		"""
 		
-		logger_sdl.debug("Sending initial state for AgeSDLHook %s", self.client_state.age_sdl_hook_uoid)
-		age_sdl_hook_state = NetMessageSDLState()
-		age_sdl_hook_state.uoid = self.client_state.age_sdl_hook_uoid
-		age_sdl_hook_state.compress_and_set_data(age_sdl_blob)
-		age_sdl_hook_state.is_initial_state = True
-		age_sdl_hook_state.persist_on_server = True
-		age_sdl_hook_state.is_avatar_state = False
-		await self.send_propagate_buffer(age_sdl_hook_state)
+		if self.room is None or logger_net_message.isEnabledFor(logging.DEBUG):
+			return False
+		
+		if class_index == NetMessageGameMessage.CLASS_INDEX:
+			if self.server_state.config.server_game_parse_pl_messages != configuration.ParsePlMessages.necessary:
+				return False
+		elif class_index == NetMessageVoice.CLASS_INDEX:
+			if logger_voice.isEnabledFor(logging.DEBUG):
+				return False
+		else:
+			return False
+		
+		receivers: typing.Optional[typing.Sequence[int]]
+		coalesce_key: typing.Optional[CoalesceKey] = None
+		try:
+			(flags,) = structs.UINT32.unpack_from(data, structs.CLASS_INDEX.size)
+			if flags & ~RAW_FORWARDABLE_FLAGS:
+				return False
+			# The echoed message gets a new time sent,
+			# which can only be patched in if there's already one.
+			if flags & ECHO_BACK_TO_SENDER_FLAG and not flags & HAS_TIME_SENT_FLAG:
+				return False
+			
+			offset = structs.CLASS_INDEX.size + net_message_header_size(flags)
+			if class_index == NetMessageGameMessage.CLASS_INDEX:
+				if not flags & NEEDS_RELIABLE_SEND_FLAG:
+					coalesce_key = game_message_coalesce_key(data, offset)
+				offset = skip_game_message_fields(data, offset)
+				receivers = None
+			else:
+				# These flags don't make sense for voice messages and are logged by the normal path.
+				if flags & NOT_FOR_VOICE_FLAGS:
+					return False
+				_, _, voice_data_length = NET_MESSAGE_VOICE_HEADER.unpack_from(data, offset)
+				offset += NET_MESSAGE_VOICE_HEADER.size + voice_data_length
+				receiver_count = data[offset]
+				offset += 1
+				receivers = struct.unpack_from(f"<{receiver_count}I", data, offset)
+				offset += receiver_count * structs.UINT32.size
+		except (EOFError, IndexError, ValueError, struct.error):
+			return False
+		
+		if offset != len(data):
+			return False
+		
+		if receivers is None:
+			recipients = self.room.recipients_for(self, flags)
+		else:
+			recipients = self.find_receivers(receivers)
+		queue_buffer_for_recipients(recipients, class_index, data, coalesce_key, send_priority_for(class_index, flags))
+		logger_forward.debug("Forwarded unparsed message of class 0x%04x from avatar %d to %d other clients", class_index, self.client_state.ki_number, len(recipients))
+		
+		if flags & ECHO_BACK_TO_SENDER_FLAG:
+			buffer = patch_net_message_header(data, time_sent=datetime.datetime.now(tz=datetime.timezone.utc))
+			await self.write_message(2, PROPAGATE_BUFFER_HEADER.pack(class_index, len(buffer)), buffer)
+		
+		return True
 	
 	@base.message_handler(2)
 	async def receive_propagate_buffer(self) -> None:
 		buffer_type, buffer_length = await self.read_unpack(PROPAGATE_BUFFER_HEADER)
+		raw_data = await self.read(buffer_length)
+		(class_index,) = structs.CLASS_INDEX.unpack_from(raw_data)
 		
-		with io.BytesIO(await self.read(buffer_length)) as buffer:
-			(class_index,) = structs.stream_unpack(buffer, structs.CLASS_INDEX)
-			
-			if buffer_type != class_index:
-				raise base.ProtocolError(f"PropagateBuffer type 0x{buffer_type:>04x} doesn't match class index in serialized message: 0x{class_index:>04x}")
-			
-			try:
-				message = NetMessage.from_class_index(class_index)
-			except pl_messages.UnknownClassIndexError:
-				message = UnknownNetMessage()
-				message.class_index = class_index
-			
-			assert message.class_index == class_index
-			
-			message.read(buffer)
-			extra_data = buffer.read()
+		if buffer_type != class_index:
+			raise base.ProtocolError(f"PropagateBuffer type 0x{buffer_type:>04x} doesn't match class index in serialized message: 0x{class_index:>04x}")
 		
-		logger_net_message.debug("Parsed plNetMessage: %r", message)
+		if (
+			class_index in SAMPLED_CLASS_INDICES
+			and self.server_state.config.server_game_parse_pl_messages == configuration.ParsePlMessages.necessary
+		):
+			self.server_state.pl_message_inspector.offer(raw_data, inspect_sampled_game_message)
 		
-		if extra_data:
-			raise base.ProtocolError(f"plNetMessage {message.class_description} wasn't fully parsed - trailing data: {extra_data!r}")
+		if await self.try_forward_raw_propagate_buffer(class_index, raw_data):
+			return
+		
+		try:
+			message = NetMessage.from_class_index(class_index)
+		except pl_messages.UnknownClassIndexError:
+			message = UnknownNetMessage()
+			message.class_index = class_index
+		
+		assert message.class_index == class_index
+		
+		# Only the header is parsed here -
+		# the rest of the message is only checked for now
+		# and parsed once the handler needs it.
+		message.read_lazy(raw_data)
+		message.check_rest()
+		if logger_net_message.isEnabledFor(logging.DEBUG):
+			message.read_rest()
+			logger_net_message.debug("Parsed plNetMessage: %r", message)
 		
 		# Check for unsupported and unexpected flags,
 		# possibly depending on the message class.
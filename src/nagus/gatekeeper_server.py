@@ -21,6 +21,7 @@
 import asyncio
 import logging
 import struct
+import typing
 import uuid
 
 from . import base
@@ -41,7 +42,7 @@ FILE_SERVER_IP_ADDRESS_REQUEST = struct.Struct("<I?")
 class GatekeeperConnection(base.BaseMOULConnection):
 	CONNECTION_TYPE = base.ConnectionType.cli2gatekeeper
 	
-	def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server_state: state.ServerState) -> None:
+	def __init__(self, reader: typing.Optional[asyncio.StreamReader], writer: base.Writer, server_state: state.ServerState) -> None:
 		super().__init__(reader, writer, server_state)
 		
 		self.dh_keys = self.server_state.config.server_gatekeeper_keys
@@ -0,0 +1,179 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Runs the expensive part of connection encryption setup outside of the event loop.
+
+The Diffie-Hellman modular exponentiation done during encryption setup
+takes about a millisecond of pure CPU time per connection.
+That's not much for a single connection,
+but when many clients connect at once
+(e. g. everyone reconnecting after a server restart),
+doing this on the event loop would block all other connections for a noticeable amount of time.
+
+Because this requires running additional processes,
+it's disabled by default
+(see the ``server.handshake_workers`` option)
+and the calculations run directly on the event loop instead.
+"""
+
+
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import logging
+import multiprocessing
+import typing
+
+
+logger = logging.getLogger(__name__)
+
+
+class HandshakeQueueFullError(Exception):
+	"""Raised when a connection's encryption handshake can't be queued because too many others are already waiting."""
+
+
+def _dh_pow(y: int, a: int, n: int) -> int:
+	# Must be a top-level function so that it can be pickled and sent to worker processes.
+	return pow(y, a, n)
+
+
+class HandshakeExecutor(object):
+	"""Process pool that performs the Diffie-Hellman calculations for encryption setup.
+	
+	At most ``workers`` calculations run at the same time.
+	Further handshakes wait in a queue holding at most ``max_pending`` handshakes ---
+	once that queue is full,
+	new handshakes are rejected with :class:`HandshakeQueueFullError`
+	instead of letting the queue grow without limit.
+	
+	If ``workers`` is 0,
+	no processes are started
+	and the calculations run directly on the event loop.
+	
+	If the process pool breaks
+	(e. g. because a worker process was killed),
+	it's replaced with a new one,
+	and the affected calculations are done directly on the event loop instead.
+	"""
+	
+	workers: int
+	max_pending: int
+	
+	pending: int
+	completed: int
+	rejected: int
+	restarts: int
+	
+	_executor: typing.Optional[concurrent.futures.ProcessPoolExecutor]
+	_slots: typing.Optional[asyncio.Semaphore]
+	
+	def __init__(self, workers: int, max_pending: int) -> None:
+		super().__init__()
+		
+		self.workers = workers
+		self.max_pending = max_pending
+		
+		self.pending = 0
+		self.completed = 0
+		self.rejected = 0
+		self.restarts = 0
+		
+		if workers > 0:
+			self._executor = self._create_executor()
+			self._slots = asyncio.Semaphore(workers)
+		else:
+			self._executor = None
+			self._slots = None
+	
+	def _create_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+		# Always use the spawn start method,
+		# even on systems where fork is the default.
+		# Forked worker processes would inherit all of the server's open sockets
+		# (including the listening socket),
+		# which would keep them open even after the server itself has exited.
+		return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+	
+	@contextlib.contextmanager
+	def reserve(self) -> typing.Iterator[None]:
+		"""Reserve a place in the queue for one handshake,
+		for use with :meth:`dh_pow_reserved`.
+		
+		Raises :class:`HandshakeQueueFullError` right away if the queue is already full,
+		so that the caller can reject the connection before doing anything else for it.
+		"""
+		
+		if self._executor is None:
+			yield
+			return
+		
+		if self.pending >= self.max_pending:
+			self.rejected += 1
+			raise HandshakeQueueFullError(f"Too many encryption handshakes in progress ({self.pending})")
+		
+		self.pending += 1
+		try:
+			yield
+		finally:
+			self.pending -= 1
+	
+	async def dh_pow(self, y: int, a: int, n: int) -> int:
+		"""Calculate ``pow(y, a, n)``,
+		without blocking the event loop if possible.
+		"""
+		
+		with self.reserve():
+			return await self.dh_pow_reserved(y, a, n)
+	
+	async def dh_pow_reserved(self, y: int, a: int, n: int) -> int:
+		"""Like :meth:`dh_pow`,
+		but for callers that already hold a place in the queue from :meth:`reserve`.
+		"""
+		
+		executor = self._executor
+		if executor is None or self._slots is None:
+			self.completed += 1
+			return pow(y, a, n)
+		
+		# Only submit as many jobs as there are workers,
+		# so that the waiting handshakes stay countable (and cancellable) on our side
+		# rather than piling up inside the executor.
+		async with self._slots:
+			try:
+				result = await asyncio.get_running_loop().run_in_executor(executor, _dh_pow, y, a, n)
+			except concurrent.futures.process.BrokenProcessPool:
+				self._replace_broken_executor(executor)
+				result = pow(y, a, n)
+		
+		self.completed += 1
+		return result
+	
+	def _replace_broken_executor(self, broken: concurrent.futures.ProcessPoolExecutor) -> None:
+		# Several handshakes may fail because of the same broken pool -
+		# only replace it once.
+		if self._executor is not broken:
+			return
+		
+		logger.error("Handshake worker process pool is broken (a worker process probably died unexpectedly) - starting new worker processes")
+		broken.shutdown(wait=False)
+		self._executor = self._create_executor()
+		self.restarts += 1
+	
+	def shutdown(self) -> None:
+		if self._executor is not None:
+			self._executor.shutdown(wait=False)
+			self._executor = None
@@ -0,0 +1,124 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Inspects a random sample of received messages in the background, for diagnostics.
+
+Fully parsing and checking every message that passes through the server
+(see the ``server.game.parse_pl_messages`` config option)
+is useful for finding problems,
+but too slow to leave enabled on a busy server.
+Inspecting only a small sample of the messages,
+and doing it in a background task after the messages have already been forwarded,
+still shows which kinds of messages are being sent
+and catches most problems that occur regularly.
+"""
+
+
+import asyncio
+import collections
+import logging
+import random
+import typing
+
+
+logger = logging.getLogger(__name__)
+
+
+# Parses and checks the data of a single message
+# and returns a short description of the kind of message (e. g. its class name) for the statistics.
+# Problems with the message should be logged and not raised.
+InspectFunction = typing.Callable[[bytes], str]
+
+
+class SampledInspector(object):
+	"""Queue for a random sample of messages
+	that are inspected one at a time by a background task.
+	
+	A fraction ``sample_rate`` (between 0 and 1) of the messages passed to :meth:`offer` is queued.
+	If ``queue_size`` messages are already waiting to be inspected,
+	further samples are dropped until there's room again,
+	so that the inspection can never use more than a bounded amount of memory
+	or fall further and further behind.
+	"""
+	
+	sample_rate: float
+	
+	sampled: int
+	dropped: int
+	failed: int
+	# Number of inspected messages, by the description returned by the inspect function.
+	counts: "collections.Counter[str]"
+	
+	_queue: "asyncio.Queue[typing.Tuple[bytes, InspectFunction]]"
+	_task: "typing.Optional[asyncio.Task[None]]"
+	
+	def __init__(self, sample_rate: float, queue_size: int) -> None:
+		super().__init__()
+		
+		self.sample_rate = sample_rate
+		
+		self.sampled = 0
+		self.dropped = 0
+		self.failed = 0
+		self.counts = collections.Counter()
+		
+		self._queue = asyncio.Queue(queue_size)
+		self._task = None
+	
+	def describe(self) -> str:
+		return f"sampling {self.sample_rate:.1%}, {self.sampled} sampled, {self._queue.qsize()} waiting, {self.dropped} dropped because the queue was full, {self.failed} failed"
+	
+	def offer(self, data: bytes, inspect: InspectFunction) -> None:
+		"""Queue ``data`` to be inspected later using ``inspect``,
+		if it's randomly chosen as a sample
+		and the queue isn't full.
+		
+		``data`` must not be modified afterwards.
+		"""
+		
+		if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+			return
+		
+		try:
+			self._queue.put_nowait((data, inspect))
+		except asyncio.QueueFull:
+			self.dropped += 1
+			return
+		
+		self.sampled += 1
+		if self._task is None:
+			self._task = asyncio.get_running_loop().create_task(self._run())
+	
+	async def _run(self) -> None:
+		while True:
+			data, inspect = await self._queue.get()
+			try:
+				description = inspect(data)
+			except Exception:
+				self.failed += 1
+				logger.error("Failed to inspect sampled message", exc_info=True)
+			else:
+				self.counts[description] += 1
+			
+			# Let the rest of the server run between samples,
+			# even if more samples are queued already.
+			await asyncio.sleep(0)
+	
+	def shutdown(self) -> None:
+		if self._task is not None:
+			self._task.cancel()
+			self._task = None
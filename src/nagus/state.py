@@ -22,21 +22,29 @@ import asyncio
 import collections
 import concurrent.futures
 import datetime
+import hmac
 import io
 import logging
 import sqlite3
 import struct
+import time
 import types
 import typing
 import uuid
 
+from . import cache
+from . import compression
 from . import configuration
+from . import crypto
+from . import handshake
+from . import inspection
 from . import structs
 
 
 if typing.TYPE_CHECKING:
 	# Avoid circular import
 	from . import auth_server
+	from . import game_server
 
 
 logger = logging.getLogger(__name__)
@@ -45,6 +53,7 @@ logger_states = logger.getChild("states")
 logger_vault = logger.getChild("vault")
 
 _T = typing.TypeVar("_T")
+_K = typing.TypeVar("_K")
 
 # This is the instance UUID for the public Ae'gura from DIRTSAND's default static_ages.ini.
 # It seems that nothing actually depends on this specific UUID,
@@ -893,6 +902,110 @@ class AvatarInfo(object):
 		self.explorer = explorer
 
 
+def account_name_key(account_name: str) -> str:
+	"""Normalize an account name for case-insensitive comparison.
+	
+	Only ASCII letters are converted to lowercase,
+	to match SQLite's ``collate nocase``
+	and the client's SHA-0 password hashing.
+	"""
+	
+	return account_name.encode("utf-8", "surrogatepass").lower().decode("utf-8", "surrogatepass")
+
+
+class AccountInfo(object):
+	account_uuid: uuid.UUID
+	name: str
+	password_hash_sha_1: bytes
+	password_hash_sha_0: bytes
+	flags: int
+	billing_type: int
+	
+	def __init__(self, account_uuid: uuid.UUID, name: str, password_hash_sha_1: bytes, password_hash_sha_0: bytes, flags: int, billing_type: int) -> None:
+		super().__init__()
+		
+		self.account_uuid = account_uuid
+		self.name = name
+		self.password_hash_sha_1 = password_hash_sha_1
+		self.password_hash_sha_0 = password_hash_sha_0
+		self.flags = flags
+		self.billing_type = billing_type
+	
+	def check_challenge_hash(self, account_name: str, client_challenge: int, server_challenge: int, challenge_hash: bytes) -> bool:
+		"""Check whether the challenge hash sent by the client matches this account's password.
+		
+		Both the "SHA-1" and "SHA-0" password hashes are accepted,
+		because some clients try both.
+		"""
+		
+		is_email = crypto.account_name_is_email(account_name)
+		ok = False
+		for password_hash in (self.password_hash_sha_1, self.password_hash_sha_0):
+			if is_email:
+				expected = crypto.challenge_hash(client_challenge, server_challenge, password_hash)
+			else:
+				expected = password_hash
+			# Don't stop early,
+			# so that the time taken doesn't reveal which hash matched.
+			ok |= hmac.compare_digest(expected, challenge_hash)
+		return ok
+
+
+class FailedLoginThrottle(typing.Generic[_K]):
+	"""Counts recent failed login attempts per key (e. g. account name or client address).
+	
+	A key is throttled once it has ``max_failures`` failed attempts within the last ``window`` seconds.
+	Only the most recently failing ``max_tracked`` keys are remembered,
+	so that a flood of attempts with different keys can't use up unlimited memory.
+	"""
+	
+	max_failures: int
+	window: float
+	max_tracked: int
+	_failures: "collections.OrderedDict[_K, typing.Deque[float]]"
+	
+	def __init__(self, max_failures: int, window: float, max_tracked: int = 100000) -> None:
+		super().__init__()
+		
+		self.max_failures = max_failures
+		self.window = window
+		self.max_tracked = max_tracked
+		self._failures = collections.OrderedDict()
+	
+	def _recent_failures(self, key: _K, now: float) -> typing.Optional[typing.Deque[float]]:
+		failures = self._failures.get(key)
+		if failures is None:
+			return None
+		
+		while failures and failures[0] <= now - self.window:
+			failures.popleft()
+		
+		if not failures:
+			del self._failures[key]
+			return None
+		
+		return failures
+	
+	def is_throttled(self, key: _K) -> bool:
+		if self.max_failures <= 0:
+			return False
+		failures = self._recent_failures(key, time.monotonic())
+		return failures is not None and len(failures) >= self.max_failures
+	
+	def record_failure(self, key: _K) -> None:
+		now = time.monotonic()
+		failures = self._recent_failures(key, now)
+		if failures is None:
+			failures = self._failures[key] = collections.deque(maxlen=max(1, self.max_failures))
+		failures.append(now)
+		self._failures.move_to_end(key)
+		while len(self._failures) > self.max_tracked:
+			self._failures.popitem(last=False)
+	
+	def clear(self, key: _K) -> None:
+		self._failures.pop(key, None)
+
+
 class Cursor(typing.AsyncContextManager["Cursor"], typing.AsyncIterable[sqlite3.Row]):
 	"""Basic async wrapper around the synchronous :class:`sqlite3.Cursor` API."""
 	
@@ -1026,6 +1139,14 @@ class ObjectStateNotFound(Exception):
 	pass
 
 
+class AccountNotFound(Exception):
+	pass
+
+
+class AccountAlreadyExists(Exception):
+	pass
+
+
 class ServerState(object):
 	config: configuration.Configuration
 	loop: asyncio.AbstractEventLoop
@@ -1042,6 +1163,19 @@ class ServerState(object):
 	# The subset of auth server connections that are currently active as an avatar.
 	# The key is the active avatar's KI number.
 	auth_connections_by_ki_number: typing.Dict[int, "auth_server.AuthConnection"]
+	# All age instances that currently have at least one client connected to the game server.
+	# The key is the age instance's Age vault node ID.
+	age_instance_rooms: typing.Dict[int, "game_server.AgeInstanceRoom"]
+	# All game server connections that have joined an age instance, regardless of which one.
+	# The key is the avatar's KI number.
+	game_connections_by_ki_number: typing.Dict[int, "game_server.GameConnection"]
+	handshake_executor: handshake.HandshakeExecutor
+	compression: compression.CompressionService
+	pl_message_inspector: inspection.SampledInspector
+	# Recently used accounts, by normalized account name (see account_name_key).
+	account_cache: cache.LruCache[str, AccountInfo]
+	failed_logins_by_account: FailedLoginThrottle[str]
+	failed_logins_by_address: FailedLoginThrottle[str]
 	
 	# The following attributes are only initialized in setup_database,
 	# because they are sometimes derived from the database and not just the configs.
@@ -1059,6 +1193,14 @@ class ServerState(object):
 		self.status_message = config.server_status_message
 		self.auth_connections = {}
 		self.auth_connections_by_ki_number = {}
+		self.age_instance_rooms = {}
+		self.game_connections_by_ki_number = {}
+		self.handshake_executor = handshake.HandshakeExecutor(config.server_handshake_workers, config.server_handshake_max_pending)
+		self.compression = compression.CompressionService(config.server_game_compression_workers, config.server_game_compression_offload_threshold, config.server_game_compression_cache_size)
+		self.pl_message_inspector = inspection.SampledInspector(config.server_game_pl_message_sample_rate, config.server_game_pl_message_sample_queue_size)
+		self.account_cache = cache.LruCache(config.server_auth_account_cache_size)
+		self.failed_logins_by_account = FailedLoginThrottle(config.server_auth_max_failed_logins_per_account, config.server_auth_failed_login_window)
+		self.failed_logins_by_address = FailedLoginThrottle(config.server_auth_max_failed_logins_per_address, config.server_auth_failed_login_window)
 	
 	def add_background_task(self, task: asyncio.Task[typing.Any]) -> None:
 		"""Keep a reference to a background task while it's running.
@@ -1148,6 +1290,15 @@ class ServerState(object):
 				primary key (AgeVaultNodeId, Uoid, StateDescName),
 				foreign key (AgeVaultNodeId) references VaultNodes(NodeId)
 			);
+			
+			create table if not exists Accounts (
+				AccountUuid blob primary key not null,
+				Name text unique not null collate nocase,
+				PasswordHashSha1 blob not null,
+				PasswordHashSha0 blob not null,
+				Flags integer not null,
+				BillingType integer not null
+			);
 			""")
 		
 		try:
@@ -1649,6 +1800,83 @@ class ServerState(object):
 					current_population=0, # TODO Get population from corresponding game server (if any)
 				)
 	
+	async def fetch_account(self, account_name: str) -> AccountInfo:
+		"""Look up an account by name (case-insensitively).
+		
+		Recently used accounts are cached,
+		so that repeated logins don't need to query the database.
+		"""
+		
+		key = account_name_key(account_name)
+		account = self.account_cache.get(key)
+		if account is not None:
+			return account
+		
+		async with self.db, await self.db.cursor() as cursor:
+			await cursor.execute(
+				"""
+				select AccountUuid, Name, PasswordHashSha1, PasswordHashSha0, Flags, BillingType
+				from Accounts
+				where Name = ?
+				""",
+				(account_name,),
+			)
+			
+			row = await cursor.fetchone()
+			if row is None:
+				raise AccountNotFound(account_name)
+		
+		account_uuid, name, password_hash_sha_1, password_hash_sha_0, flags, billing_type = row
+		account = AccountInfo(uuid.UUID(bytes_le=account_uuid), name, password_hash_sha_1, password_hash_sha_0, flags, billing_type)
+		self.account_cache.put(key, account)
+		return account
+	
+	async def create_account(self, name: str, password: str, flags: int, billing_type: int, account_uuid: typing.Optional[uuid.UUID] = None) -> uuid.UUID:
+		if account_uuid is None:
+			account_uuid = uuid.uuid4()
+		
+		truncated_name, _ = crypto.truncate_credentials(name, password)
+		if truncated_name != name:
+			raise ValueError(f"Account name is too long: {name!r}")
+		
+		try:
+			async with self.db, await self.db.cursor() as cursor:
+				await cursor.execute(
+					"""
+					insert into Accounts (AccountUuid, Name, PasswordHashSha1, PasswordHashSha0, Flags, BillingType)
+					values (?, ?, ?, ?, ?, ?)
+					""",
+					(
+						account_uuid.bytes_le,
+						name,
+						crypto.password_hash_sha_1(password),
+						crypto.password_hash_sha_0(name, password),
+						flags,
+						billing_type,
+					),
+				)
+		except sqlite3.IntegrityError:
+			raise AccountAlreadyExists(name)
+		
+		self.account_cache.discard(account_name_key(name))
+		return account_uuid
+	
+	async def set_account_password(self, name: str, password: str) -> None:
+		async with self.db, await self.db.cursor() as cursor:
+			await cursor.execute(
+				"""
+				update Accounts
+				set PasswordHashSha1 = ?, PasswordHashSha0 = ?
+				where Name = ?
+				""",
+				(crypto.password_hash_sha_1(password), crypto.password_hash_sha_0(name, password), name),
+			)
+			
+			if cursor.rowcount == 0:
+				raise AccountNotFound(name)
+		
+		self.account_cache.discard(account_name_key(name))
+	
 	async def find_avatars(self, account_id: uuid.UUID) -> typing.AsyncIterable[AvatarInfo]:
 		async for player_id in self.find_vault_nodes(VaultNodeData(node_type=VaultNodeType.player, uuid_1=account_id)):
 			player_node = await self.fetch_vault_node(player_id)
@@ -1877,17 +2105,29 @@ class ServerState(object):
 				
 				yield uoid, state_desc_name.encode("ascii"), sdl_blob
 	
-	async def save_object_sdl_state(self, age_vault_node_id: int, uoid: structs.Uoid, state_desc_name: bytes, sdl_blob: bytes) -> None:
-		with io.BytesIO() as stream:
-			uoid.write(stream)
-			uoid_data = stream.getvalue()
+	async def save_object_sdl_states(self, age_vault_node_id: int, states: typing.Iterable[typing.Tuple[structs.Uoid, bytes, bytes]]) -> None:
+		"""Save multiple object SDL states for an age instance in a single transaction.
+		
+		:param states: Tuples of (uoid, state_desc_name, sdl_blob).
+		"""
+		
+		rows = []
+		for uoid, state_desc_name, sdl_blob in states:
+			with io.BytesIO() as stream:
+				uoid.write(stream)
+				uoid_data = stream.getvalue()
+			
+			rows.append((age_vault_node_id, uoid_data, state_desc_name.decode("ascii"), sdl_blob, sdl_blob))
 		
 		async with self.db, await self.db.cursor() as cursor:
-			await cursor.execute(
+			await cursor.executemany(
 				"""
 				insert into AgeInstanceObjectStates (AgeVaultNodeId, Uoid, StateDescName, SdlBlob)
 				values (?, ?, ?, ?)
 				on conflict do update set SdlBlob = ?
 				""",
-				(age_vault_node_id, uoid_data, state_desc_name.decode("ascii"), sdl_blob, sdl_blob),
+				rows,
 			)
+	
+	async def save_object_sdl_state(self, age_vault_node_id: int, uoid: structs.Uoid, state_desc_name: bytes, sdl_blob: bytes) -> None:
+		await self.save_object_sdl_states(age_vault_node_id, [(uoid, state_desc_name, sdl_blob)])
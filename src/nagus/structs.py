@@ -214,17 +214,24 @@ def bit_numbers_from_int(bits: int) -> typing.Iterable[int]:
 		i += 1
 
 
-def unpack_unified_time(data: bytes) -> datetime.datetime:
-	timestamp, micros = UNIFIED_TIME.unpack(data)
+def unified_time_from_parts(timestamp: int, micros: int) -> datetime.datetime:
 	return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc) + datetime.timedelta(microseconds=micros)
 
 
+def unified_time_to_parts(dt: datetime.datetime) -> typing.Tuple[int, int]:
+	return int(dt.timestamp()), dt.microsecond
+
+
+def unpack_unified_time(data: bytes) -> datetime.datetime:
+	return unified_time_from_parts(*UNIFIED_TIME.unpack(data))
+
+
 def read_unified_time(stream: typing.BinaryIO) -> datetime.datetime:
 	return unpack_unified_time(read_exact(stream, UNIFIED_TIME.size))
 
 
 def pack_unified_time(dt: datetime.datetime) -> bytes:
-	return UNIFIED_TIME.pack(int(dt.timestamp()), dt.microsecond)
+	return UNIFIED_TIME.pack(*unified_time_to_parts(dt))
 
 
 def write_unified_time(stream: typing.BinaryIO, dt: datetime.datetime) -> None:
@@ -0,0 +1,315 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import struct
+import typing
+import unittest
+
+from nagus import base
+from nagus import crypto
+from nagus import state
+from nagus import structs
+
+
+TEST_KEY = bytes.fromhex("0123456789abcd")
+TEST_STRUCT = struct.Struct("<HI")
+
+
+class ReceiveBufferTest(unittest.TestCase):
+	def test_take_and_unpack(self) -> None:
+		buffer = base.ReceiveBuffer()
+		self.assertEqual(len(buffer), 0)
+		buffer.feed(TEST_STRUCT.pack(1, 2) + b"abc", None)
+		self.assertEqual(len(buffer), 9)
+		self.assertEqual(buffer.unpack(TEST_STRUCT), (1, 2))
+		view = buffer.take(2)
+		buffer.feed(b"def", None)
+		# Views must stay valid after feeding more data.
+		self.assertEqual(bytes(view), b"ab")
+		self.assertEqual(bytes(buffer.take_all()), b"cdef")
+		self.assertEqual(len(buffer), 0)
+	
+	def test_feed_in_place(self) -> None:
+		buffer = base.ReceiveBuffer()
+		for i in range(1000):
+			buffer.feed(bytes([i & 0xff]) * 10, None)
+			self.assertEqual(buffer.unpack(struct.Struct("<B")), ((i // 10) & 0xff,))
+		self.assertEqual(len(buffer), 9000)
+		data = buffer.take_all()
+		self.assertEqual(bytes(data[:10]), bytes([100]) * 10)
+		self.assertEqual(bytes(data[-9:]), bytes([999 & 0xff]) * 9)
+	
+	def test_not_enough_data(self) -> None:
+		buffer = base.ReceiveBuffer()
+		buffer.feed(b"abc", None)
+		with self.assertRaises(ValueError):
+			buffer.take(4)
+		with self.assertRaises(ValueError):
+			buffer.unpack(TEST_STRUCT)
+		self.assertEqual(bytes(buffer.take(3)), b"abc")
+	
+	def test_decrypt(self) -> None:
+		data = b"The quick brown fox jumps over the lazy dog"
+		encrypted = crypto.Rc4State(TEST_KEY).crypt(data)
+		
+		buffer = base.ReceiveBuffer()
+		decryption_state = crypto.Rc4State(TEST_KEY)
+		buffer.feed(encrypted[:10], decryption_state)
+		buffer.feed(encrypted[10:], decryption_state)
+		self.assertEqual(bytes(buffer.take_all()), data)
+	
+	def test_decrypt_pending(self) -> None:
+		encrypted = crypto.Rc4State(TEST_KEY).crypt(b"secret")
+		
+		buffer = base.ReceiveBuffer()
+		buffer.feed(b"plain" + encrypted, None)
+		self.assertEqual(bytes(buffer.take(5)), b"plain")
+		buffer.decrypt_pending(crypto.Rc4State(TEST_KEY))
+		self.assertEqual(bytes(buffer.take_all()), b"secret")
+
+
+class DebugConnection(base.BaseMOULConnection):
+	CONNECTION_TYPE = base.ConnectionType.debug
+	
+	async def read_connect_packet_data(self) -> None:
+		pass
+
+
+class FakeWriterTransport(object):
+	# Number of bytes that the transport pretends to still have in its buffer.
+	buffer_size: int
+	
+	def __init__(self) -> None:
+		super().__init__()
+		
+		self.buffer_size = 0
+	
+	def get_write_buffer_size(self) -> int:
+		return self.buffer_size
+
+
+class FakeWriter(object):
+	writes: typing.List[bytes]
+	transport: FakeWriterTransport
+	
+	def __init__(self) -> None:
+		super().__init__()
+		
+		self.writes = []
+		self.transport = FakeWriterTransport()
+	
+	def writelines(self, data: typing.Iterable[bytes]) -> None:
+		self.writes.append(b"".join(data))
+	
+	async def drain(self) -> None:
+		pass
+
+
+class FakeTransport(asyncio.Transport):
+	reading: bool
+	writes: typing.List[bytes]
+	
+	def __init__(self) -> None:
+		super().__init__()
+		
+		self.reading = True
+		self.writes = []
+	
+	def is_reading(self) -> bool:
+		return self.reading
+	
+	def pause_reading(self) -> None:
+		self.reading = False
+	
+	def resume_reading(self) -> None:
+		self.reading = True
+	
+	def writelines(self, list_of_data: typing.Iterable[typing.Any]) -> None:
+		self.writes.append(b"".join(list_of_data))
+	
+	def get_write_buffer_size(self) -> int:
+		return 0
+
+
+def make_connection(data: bytes, segment_size: int) -> DebugConnection:
+	reader = asyncio.StreamReader()
+	for i in range(0, len(data), segment_size):
+		reader.feed_data(data[i:i + segment_size])
+	reader.feed_eof()
+	return DebugConnection(reader, typing.cast(asyncio.StreamWriter, None), typing.cast(state.ServerState, None))
+
+
+class ConnectionReadTest(unittest.TestCase):
+	def test_read_fields(self) -> None:
+		string = "Hello, Uru!"
+		data = TEST_STRUCT.pack(0x1234, 0xdeadbeef) + base.pack_string_field(string) + bytes(range(256)) * 1024
+		
+		for segment_size in (1, 7, 1460, len(data)):
+			for encrypted in (False, True):
+				with self.subTest(segment_size=segment_size, encrypted=encrypted):
+					async def _test() -> None:
+						conn = make_connection(crypto.Rc4State(TEST_KEY).crypt(data) if encrypted else data, segment_size)
+						if encrypted:
+							conn.encryption_state_read = crypto.Rc4State(TEST_KEY)
+						
+						self.assertEqual(await conn.read_unpack(TEST_STRUCT), (0x1234, 0xdeadbeef))
+						self.assertEqual(await conn.read_string_field(), string)
+						self.assertEqual(await conn.read(256 * 1024), bytes(range(256)) * 1024)
+						
+						with self.assertRaises(asyncio.IncompleteReadError):
+							await conn.read(1)
+					
+					asyncio.run(_test())
+	
+	def test_incomplete(self) -> None:
+		async def _test() -> None:
+			conn = make_connection(b"abc", 2)
+			with self.assertRaises(asyncio.IncompleteReadError) as cm:
+				await conn.read(4)
+			self.assertEqual(cm.exception.partial, b"abc")
+		
+		asyncio.run(_test())
+	
+	def test_data_received(self) -> None:
+		data = TEST_STRUCT.pack(0x1234, 0xdeadbeef) + bytes(range(256)) * 1024
+		
+		async def _test() -> None:
+			transport = FakeTransport()
+			conn = DebugConnection(None, base.ProtocolWriter(transport), typing.cast(state.ServerState, None))
+			conn.encryption_state_read = crypto.Rc4State(TEST_KEY)
+			encrypted = crypto.Rc4State(TEST_KEY).crypt(data)
+			
+			# Deliver part of the first field right away and the rest once the connection is waiting for it,
+			# like an asyncio.Protocol would.
+			conn.data_received(encrypted[:3])
+			asyncio.get_running_loop().call_soon(conn.data_received, encrypted[3:1460])
+			self.assertEqual(await asyncio.wait_for(conn.read_unpack(TEST_STRUCT), 5), (0x1234, 0xdeadbeef))
+			
+			# Nobody is waiting for data now,
+			# so reading is paused once enough data is buffered.
+			half = len(encrypted) // 2
+			for i in range(1460, half, 1460):
+				conn.data_received(encrypted[i:min(i + 1460, half)])
+			self.assertFalse(transport.reading)
+			
+			# Reading is resumed once the connection needs more data than is buffered.
+			read_task = asyncio.create_task(conn.read(256 * 1024))
+			await asyncio.sleep(0)
+			self.assertTrue(transport.reading)
+			conn.data_received(encrypted[half:])
+			conn.eof_received()
+			# Bounded, so that the test fails instead of hanging if something goes wrong.
+			self.assertEqual(await asyncio.wait_for(read_task, 5), bytes(range(256)) * 1024)
+			
+			with self.assertRaises(asyncio.IncompleteReadError):
+				await conn.read(1)
+		
+		asyncio.run(_test())
+
+
+class ProtocolWriterTest(unittest.TestCase):
+	def test_drain(self) -> None:
+		async def _test() -> None:
+			writer = base.ProtocolWriter(FakeTransport())
+			await writer.drain()
+			
+			writer.pause_writing()
+			drain_task = asyncio.create_task(writer.drain())
+			await asyncio.sleep(0)
+			self.assertFalse(drain_task.done())
+			writer.resume_writing()
+			await drain_task
+			
+			writer.pause_writing()
+			drain_task = asyncio.create_task(writer.drain())
+			await asyncio.sleep(0)
+			writer.connection_lost()
+			with self.assertRaises(ConnectionResetError):
+				await drain_task
+			with self.assertRaises(ConnectionResetError):
+				await writer.drain()
+			await writer.wait_closed()
+		
+		asyncio.run(_test())
+
+
+class ConnectionWriteTest(unittest.TestCase):
+	def test_coalesce(self) -> None:
+		async def _test() -> None:
+			writer = FakeWriter()
+			conn = DebugConnection(asyncio.StreamReader(), typing.cast(asyncio.StreamWriter, writer), typing.cast(state.ServerState, None))
+			conn.encryption_state_write = crypto.Rc4State(TEST_KEY)
+			
+			await conn.write_message(1, b"abc")
+			await conn.write_message(2, b"def", bytearray(b"ghi"))
+			await conn.write(b"jkl")
+			self.assertEqual(writer.writes, [])
+			
+			# Let the event loop run the scheduled flush.
+			await asyncio.sleep(0)
+			self.assertEqual(len(writer.writes), 1)
+			expected = structs.UINT16.pack(1) + b"abc" + structs.UINT16.pack(2) + b"defghi" + b"jkl"
+			self.assertEqual(crypto.Rc4State(TEST_KEY).crypt(writer.writes[0]), expected)
+			
+			await conn.write(b"mno")
+			conn.flush_send_queue()
+			await asyncio.sleep(0)
+			self.assertEqual(len(writer.writes), 2)
+		
+		asyncio.run(_test())
+	
+	def test_high_water(self) -> None:
+		async def _test() -> None:
+			writer = FakeWriter()
+			conn = DebugConnection(asyncio.StreamReader(), typing.cast(asyncio.StreamWriter, writer), typing.cast(state.ServerState, None))
+			
+			chunk = bytes(base.SEND_HIGH_WATER // 4)
+			for _ in range(4):
+				await conn.write(chunk)
+			# Reaching the high water mark flushes the queue immediately.
+			self.assertEqual(writer.writes, [chunk * 4])
+			
+			await conn.write(b"abc")
+			await asyncio.sleep(0)
+			self.assertEqual(writer.writes, [chunk * 4, b"abc"])
+		
+		asyncio.run(_test())
+	
+	def test_high_water_counts_transport_buffer(self) -> None:
+		async def _test() -> None:
+			writer = FakeWriter()
+			conn = DebugConnection(asyncio.StreamReader(), typing.cast(asyncio.StreamWriter, writer), typing.cast(state.ServerState, None))
+			
+			writer.transport.buffer_size = base.SEND_HIGH_WATER - 5
+			await conn.write(b"abcde")
+			self.assertEqual(writer.writes, [])
+			# The queued data would take the transport past the high water mark,
+			# so it's passed on before waiting for the transport to drain.
+			await conn.write(b"fghij")
+			self.assertEqual(writer.writes, [b"abcde"])
+			
+			writer.transport.buffer_size = 0
+			await conn.write(b"klm")
+			await asyncio.sleep(0)
+			self.assertEqual(writer.writes, [b"abcde", b"fghijklm"])
+		
+		asyncio.run(_test())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,69 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from nagus import cache
+
+
+class LruCacheTest(unittest.TestCase):
+	def test_eviction_order(self) -> None:
+		lru: cache.LruCache[str, int] = cache.LruCache(2)
+		lru.put("a", 1)
+		lru.put("b", 2)
+		self.assertEqual(lru.get("a"), 1)
+		lru.put("c", 3)
+		# "b" was least recently used, because "a" was just accessed.
+		self.assertIsNone(lru.get("b"))
+		self.assertEqual(lru.get("a"), 1)
+		self.assertEqual(lru.get("c"), 3)
+		self.assertEqual(len(lru), 2)
+	
+	def test_zero_size(self) -> None:
+		lru: cache.LruCache[str, int] = cache.LruCache(0)
+		lru.put("a", 1)
+		self.assertIsNone(lru.get("a"))
+		self.assertEqual(len(lru), 0)
+	
+	def test_discard(self) -> None:
+		lru: cache.LruCache[str, int] = cache.LruCache(2)
+		lru.put("a", 1)
+		lru.discard("a")
+		lru.discard("nonexistent")
+		self.assertIsNone(lru.get("a"))
+	
+	def test_size_of(self) -> None:
+		lru: cache.LruCache[str, bytes] = cache.LruCache(10, len)
+		lru.put("a", b"1234")
+		lru.put("b", b"5678")
+		self.assertEqual(lru.total_size, 8)
+		lru.put("a", b"12")
+		self.assertEqual(lru.total_size, 6)
+		lru.put("c", b"abcde")
+		# "b" was least recently used and had to go to make room.
+		self.assertIsNone(lru.get("b"))
+		self.assertEqual(lru.get("a"), b"12")
+		self.assertEqual(lru.total_size, 7)
+		
+		# Values that are too large on their own aren't kept at all.
+		lru.put("d", b"x" * 11)
+		self.assertEqual(len(lru), 0)
+		self.assertEqual(lru.total_size, 0)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,95 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+import zlib
+
+from nagus import compression
+from nagus import game_server
+
+
+TEST_DATA = bytes(range(256)) * 256
+
+
+class CompressionLevelTest(unittest.TestCase):
+	def test_levels(self) -> None:
+		self.assertEqual(compression.compression_level(100), 9)
+		self.assertEqual(compression.compression_level(10000), 6)
+		self.assertEqual(compression.compression_level(100000), 1)
+		# Clients that are falling behind get smaller data.
+		self.assertEqual(compression.compression_level(100000, 0.9), 9)
+
+
+class CompressionServiceTest(unittest.TestCase):
+	def test_roundtrip(self) -> None:
+		for workers in (0, 2):
+			with self.subTest(workers=workers):
+				async def _test() -> None:
+					service = compression.CompressionService(workers, 1024, 16)
+					try:
+						compressed = await service.compress(TEST_DATA)
+						self.assertEqual(zlib.decompress(compressed), TEST_DATA)
+						self.assertEqual(await service.decompress(compressed), TEST_DATA)
+						self.assertEqual(await service.compress(b"small"), zlib.compress(b"small", 9))
+						# The compressed data is small enough to be decompressed directly.
+						self.assertEqual(service.offloaded, 1 if workers else 0)
+					finally:
+						service.shutdown()
+				
+				asyncio.run(_test())
+	
+	def test_cache(self) -> None:
+		async def _test() -> None:
+			first = zlib.compress(TEST_DATA, compression.compression_level(len(TEST_DATA)))
+			service = compression.CompressionService(0, 1024, len(first))
+			self.assertEqual(await service.compress(TEST_DATA), first)
+			self.assertIs(await service.compress(bytes(TEST_DATA)), await service.compress(TEST_DATA))
+			self.assertEqual((service.cache_hits, service.cache_misses), (2, 1))
+			
+			# A different compression level must not reuse the cached output.
+			other_level = await service.compress(TEST_DATA, 1.0)
+			self.assertEqual(zlib.decompress(other_level), TEST_DATA)
+			self.assertEqual((service.cache_hits, service.cache_misses), (2, 2))
+			
+			# The cache only has room for one output.
+			await service.compress(TEST_DATA)
+			self.assertEqual((service.cache_hits, service.cache_misses), (2, 3))
+		
+		asyncio.run(_test())
+	
+	def test_stream_message(self) -> None:
+		async def _test() -> None:
+			service = compression.CompressionService(1, 1024, 16)
+			try:
+				message = game_server.NetMessageStream()
+				await message.compress_and_set_data_async(TEST_DATA, service)
+				self.assertEqual(message.compression_type, game_server.CompressionType.zlib)
+				self.assertEqual(message.decompress_data(), TEST_DATA)
+				self.assertEqual(await message.decompress_data_async(service), TEST_DATA)
+				
+				await message.compress_and_set_data_async(b"tiny", service)
+				self.assertEqual(message.compression_type, game_server.CompressionType.none)
+				self.assertEqual(await message.decompress_data_async(service), b"tiny")
+			finally:
+				service.shutdown()
+		
+		asyncio.run(_test())
+
+
+if __name__ == "__main__":
+	unittest.main()
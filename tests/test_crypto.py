@@ -16,6 +16,8 @@
 
 
 import hashlib
+import random
+import typing
 import unittest
 
 from nagus import crypto
@@ -86,6 +88,23 @@ CHALLENGE_TEST_HASHES = [
 	(0xb30d7f53, 0xdeadbeef, "469f82acd0b514293cfd31c19f7703000b36eca2", "d9930d4f26a2e58da91df760243a94a101950d30"),
 ]
 
+EMAIL_ACCOUNT_NAMES = [
+	"noreply@example.net",
+	"noreply@example.co.uk",
+	"noreply@gametap.co.uk",
+]
+NON_EMAIL_ACCOUNT_NAMES = [
+	"account",
+	"@example",
+	"@example.com",
+	"noreply@example",
+	"noreply@example.",
+	"noreply@.com",
+	"noreply@gametap.com",
+	"noreply@gametap.net",
+	"noreply@spam.gametap.net",
+]
+
 RC4_TEST_DATA = [
 	# Stolen from Wikipedia:
 	# https://en.wikipedia.org/wiki/RC4#Test_vectors
@@ -117,6 +136,29 @@ class ShaTest(unittest.TestCase):
 			bytes.fromhex("bd18f2e7736c8e6de8b5abdfdeab948f5171210c"),
 		)
 	
+	def test_fast_sha_0(self) -> None:
+		for data, hex_hash in SHA_0_TEST_HASHES:
+			with self.subTest(data=data, hash=hex_hash):
+				self.assertEqual(crypto._fast_sha_0_1(data, sha_1=False), bytes.fromhex(hex_hash))
+				self.assertEqual(crypto.sha_0(data), bytes.fromhex(hex_hash))
+	
+	def test_fast_sha_0_long(self) -> None:
+		# Stolen from the H'uru Plasma tests.
+		self.assertEqual(
+			crypto.sha_0(b"a" * 1000000),
+			bytes.fromhex("3232affa48628a26653b5aaa44541fd90d690603"),
+		)
+	
+	def test_fast_sha_matches_slow(self) -> None:
+		# Cover all lengths around the padding boundaries (55/56/63/64 bytes).
+		rand = random.Random(0x5a0)
+		for length in range(0, 200):
+			data = bytes(rand.getrandbits(8) for _ in range(length))
+			with self.subTest(length=length):
+				self.assertEqual(crypto._fast_sha_0_1(data, sha_1=False), crypto._slow_sha_0_1(data, sha_1=False))
+				self.assertEqual(crypto._fast_sha_0_1(data, sha_1=True), crypto._slow_sha_0_1(data, sha_1=True))
+				self.assertEqual(crypto._fast_sha_0_1(data, sha_1=True), hashlib.sha1(data).digest())
+	
 	def test_sha_1(self) -> None:
 		for data, hex_hash in SHA_1_TEST_HASHES:
 			with self.subTest(data=data, hash=hex_hash):
@@ -155,29 +197,112 @@ class ShaTest(unittest.TestCase):
 			with self.subTest(account_name=account_name, password=password, hash=hex_hash):
 				self.assertEqual(crypto.password_hash_sha_0(account_name, password), bytes.fromhex(hex_hash))
 	
+	def test_account_name_is_email(self) -> None:
+		for account_name in EMAIL_ACCOUNT_NAMES:
+			with self.subTest(account_name=account_name):
+				self.assertTrue(crypto.account_name_is_email(account_name))
+		for account_name in NON_EMAIL_ACCOUNT_NAMES:
+			with self.subTest(account_name=account_name):
+				self.assertFalse(crypto.account_name_is_email(account_name))
+	
 	def test_challenge(self) -> None:
 		for client_challenge, server_challenge, password_hash, hex_hash in CHALLENGE_TEST_HASHES:
 			with self.subTest(client_challenge=client_challenge, server_challenge=server_challenge, password_hash=password_hash, hash=hex_hash):
 				self.assertEqual(crypto.challenge_hash(client_challenge, server_challenge, bytes.fromhex(password_hash)), bytes.fromhex(hex_hash))
 
 
+RC4_CLASSES: typing.List[typing.Callable[[bytes], typing.Any]] = [
+	crypto.SlowRc4State,
+	lambda key: crypto.Rc4State(key, allow_accelerated=False),
+]
+# Without PyCryptodome,
+# this would just test the pure Python implementation a second time.
+if crypto.Rc4State(b"Key").is_accelerated:
+	RC4_CLASSES.append(crypto.Rc4State)
+
+
 class Rc4Test(unittest.TestCase):
 	def test_rc4_batch(self) -> None:
-		for key, plaintext, ciphertext in RC4_TEST_DATA:
-			with self.subTest(key=key, plaintext=plaintext):
-				state_encrypt = crypto.Rc4State(key)
-				state_decrypt = crypto.Rc4State(key)
-				self.assertEqual(state_encrypt.crypt(plaintext), ciphertext)
-				self.assertEqual(state_decrypt.crypt(ciphertext), plaintext)
+		for make_state in RC4_CLASSES:
+			for key, plaintext, ciphertext in RC4_TEST_DATA:
+				with self.subTest(make_state=make_state, key=key, plaintext=plaintext):
+					state_encrypt = make_state(key)
+					state_decrypt = make_state(key)
+					self.assertEqual(state_encrypt.crypt(plaintext), ciphertext)
+					self.assertEqual(state_decrypt.crypt(ciphertext), plaintext)
 	
 	def test_rc4_bytewise(self) -> None:
-		for key, plaintext, ciphertext in RC4_TEST_DATA:
-			with self.subTest(key=key, plaintext=plaintext):
-				state_encrypt = crypto.Rc4State(key)
-				state_decrypt = crypto.Rc4State(key)
-				for p, c in zip(plaintext, ciphertext):
-					self.assertEqual(state_encrypt.crypt(bytes([p])), bytes([c]))
-					self.assertEqual(state_decrypt.crypt(bytes([c])), bytes([p]))
+		for make_state in RC4_CLASSES:
+			for key, plaintext, ciphertext in RC4_TEST_DATA:
+				with self.subTest(make_state=make_state, key=key, plaintext=plaintext):
+					state_encrypt = make_state(key)
+					state_decrypt = make_state(key)
+					for p, c in zip(plaintext, ciphertext):
+						self.assertEqual(state_encrypt.crypt(bytes([p])), bytes([c]))
+						self.assertEqual(state_decrypt.crypt(bytes([c])), bytes([p]))
+	
+	def test_rc4_matches_slow(self) -> None:
+		rand = random.Random(0x5eed)
+		for make_state in RC4_CLASSES[1:]:
+			for _ in range(20):
+				key = bytes(rand.getrandbits(8) for _ in range(7))
+				with self.subTest(make_state=make_state, key=key):
+					slow = crypto.SlowRc4State(key)
+					fast = make_state(key)
+					# Mix of chunk sizes, including empty chunks and ones that wrap the state index multiple times.
+					for length in [0, 1, 2, 3, 255, 256, 257, 1000, 0, 4096, 13]:
+						data = bytes(rand.getrandbits(8) for _ in range(length))
+						self.assertEqual(fast.crypt(data), slow.crypt(data))
+	
+	def test_rc4_crypt_into(self) -> None:
+		for make_state in RC4_CLASSES[1:]:
+			for key, plaintext, ciphertext in RC4_TEST_DATA:
+				with self.subTest(make_state=make_state, key=key, plaintext=plaintext):
+					state_encrypt = make_state(key)
+					out = bytearray(len(plaintext) + 4)
+					state_encrypt.crypt_into(plaintext, memoryview(out)[2:-2])
+					self.assertEqual(out, bytes(2) + ciphertext + bytes(2))
+					
+					state_decrypt = make_state(key)
+					buffer = bytearray(ciphertext)
+					state_decrypt.crypt_inplace(buffer)
+					self.assertEqual(buffer, plaintext)
+	
+	def test_rc4_crypt_into_chunked(self) -> None:
+		for make_state in RC4_CLASSES[1:]:
+			for key, plaintext, ciphertext in RC4_TEST_DATA:
+				with self.subTest(make_state=make_state, key=key, plaintext=plaintext):
+					state = make_state(key)
+					buffer = bytearray(plaintext)
+					view = memoryview(buffer)
+					half = len(buffer) // 2
+					state.crypt_inplace(view[:half])
+					state.crypt_inplace(view[half:])
+					self.assertEqual(buffer, ciphertext)
+	
+	def test_rc4_crypt_into_length_mismatch(self) -> None:
+		for make_state in RC4_CLASSES[1:]:
+			with self.subTest(make_state=make_state):
+				with self.assertRaises(ValueError):
+					make_state(b"Key").crypt_into(b"Plaintext", bytearray(8))
+	
+	@unittest.skipUnless(crypto.Rc4State(b"Key").is_accelerated, "PyCryptodome is not installed")
+	def test_rc4_accelerated(self) -> None:
+		state_encrypt = crypto.Rc4State(b"Key")
+		state_decrypt = crypto.Rc4State(b"Key")
+		out = bytearray(9)
+		state_encrypt.crypt_into(b"Plaintext", memoryview(out))
+		self.assertEqual(out, bytes.fromhex("bbf316e8d940af0ad3"))
+		state_decrypt.crypt_inplace(memoryview(out))
+		self.assertEqual(out, b"Plaintext")
+	
+	def test_rc4_result_type(self) -> None:
+		for make_state in RC4_CLASSES:
+			with self.subTest(make_state=make_state):
+				state = make_state(b"Key")
+				self.assertIs(type(state.crypt(b"")), bytes)
+				self.assertIs(type(state.crypt(b"Plaintext")), bytes)
+				self.assertIs(type(state.crypt(bytearray(b"Plaintext"))), bytes)
 
 
 if __name__ == "__main__":
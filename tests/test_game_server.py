@@ -0,0 +1,1119 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import datetime
+import io
+import itertools
+import time
+import typing
+import unittest
+import unittest.mock
+import uuid
+
+from nagus import base
+from nagus import configuration
+from nagus import game_server
+from nagus import pl_messages
+from nagus import sdl
+from nagus import state
+from nagus import structs
+
+from .test_base import FakeWriterTransport
+from .test_sdl import CITY_V43_HEADER, CLEFT_V24_DEFAULT_DATA, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_HEADER
+
+
+AGE_NODE_ID = 1234
+LOCATION_1 = structs.Location(structs.make_sequence_number(100, 1), structs.Location.Flags(0))
+LOCATION_2 = structs.Location(structs.make_sequence_number(100, 2), structs.Location.Flags(0))
+UOID_1 = structs.Uoid(LOCATION_1, 0x0002, 1, b"Clickable01")
+UOID_2 = structs.Uoid(LOCATION_1, 0x0002, 2, b"Clickable02")
+UOID_3 = structs.Uoid(LOCATION_2, 0x0002, 3, b"Clickable03")
+
+
+class FakeWriter(object):
+	writes: typing.List[bytes]
+	closed: bool
+	# Cleared to simulate a client that isn't receiving any data.
+	resumed: asyncio.Event
+	transport: FakeWriterTransport
+	
+	def __init__(self) -> None:
+		super().__init__()
+		
+		self.writes = []
+		self.transport = FakeWriterTransport()
+		self.closed = False
+		self.resumed = asyncio.Event()
+		self.resumed.set()
+	
+	def writelines(self, data: typing.Iterable[bytes]) -> None:
+		self.writes.append(b"".join(data))
+	
+	async def drain(self) -> None:
+		await self.resumed.wait()
+		if self.closed:
+			raise ConnectionResetError("Connection lost")
+	
+	def close(self) -> None:
+		self.closed = True
+
+
+def make_server_state(db: typing.Optional[state.Database] = None, **options: str) -> state.ServerState:
+	config = configuration.Configuration()
+	config.set_option(("server", "handshake_workers"), "0")
+	for name, value in options.items():
+		config.set_option(tuple(name.split("__")), value)
+	config.set_defaults()
+	return state.ServerState(config, asyncio.get_running_loop(), typing.cast(state.Database, db))
+
+
+async def make_database_server_state(**options: str) -> typing.Tuple[state.ServerState, int]:
+	"""Create a server state with an in-memory database
+	containing a single age vault node,
+	whose ID is returned as well.
+	"""
+	
+	server_state = make_server_state(
+		await state.Database.connect(":memory:"),
+		ages__public_aegura_instance="none",
+		ages__default_neighborhood_instance="none",
+		**options,
+	)
+	server_state.config.ages_static_ages_config = []
+	await server_state.setup_database()
+	age_node_id = await server_state.create_vault_node(state.VaultNodeData(
+		creator_account_uuid=structs.ZERO_UUID,
+		creator_id=0,
+		node_type=state.VaultNodeType.age,
+	))
+	return server_state, age_node_id
+
+
+def make_member(server_state: state.ServerState, ki_number: int, age_node_id: int = AGE_NODE_ID) -> typing.Tuple[game_server.GameConnection, FakeWriter]:
+	writer = FakeWriter()
+	conn = game_server.GameConnection(asyncio.StreamReader(), typing.cast(asyncio.StreamWriter, writer), server_state)
+	conn.client_state.age_node_id = age_node_id
+	conn.client_state.ki_number = ki_number
+	conn.join_room()
+	return conn, writer
+
+
+def make_game_message(data: bytes) -> game_server.NetMessageGameMessage:
+	message = game_server.NetMessageGameMessage()
+	message.delivery_time = structs.ZERO_DATETIME
+	message.compress_and_set_data(data)
+	return message
+
+
+def serialize(message: game_server.NetMessage) -> bytes:
+	with io.BytesIO() as stream:
+		message.write_with_class_index(stream)
+		buffer = stream.getvalue()
+	
+	return structs.UINT16.pack(2) + game_server.PROPAGATE_BUFFER_HEADER.pack(message.class_index, len(buffer)) + buffer
+
+
+async def run_event_loop() -> None:
+	# Give the send tasks and the scheduled send queue flushes a chance to run.
+	for _ in range(5):
+		await asyncio.sleep(0)
+
+
+class AgeInstanceRoomTest(unittest.TestCase):
+	def test_broadcast(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, sender_writer = make_member(server_state, 1)
+			_, writer_2 = make_member(server_state, 2)
+			_, writer_3 = make_member(server_state, 3)
+			_, other_age_writer = make_member(server_state, 4, AGE_NODE_ID + 1)
+			self.assertEqual(len(server_state.age_instance_rooms), 2)
+			
+			message = make_game_message(b"hello")
+			sender.forward_propagate_buffer(message)
+			await run_event_loop()
+			
+			self.assertEqual(writer_2.writes, [serialize(message)])
+			self.assertEqual(writer_3.writes, [serialize(message)])
+			self.assertEqual(sender_writer.writes, [])
+			self.assertEqual(other_age_writer.writes, [])
+		
+		asyncio.run(_test())
+	
+	def test_receivers(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, _ = make_member(server_state, 1)
+			_, writer_2 = make_member(server_state, 2)
+			_, writer_3 = make_member(server_state, 3)
+			
+			message = make_game_message(b"psst")
+			# Receivers that aren't connected are ignored,
+			# and duplicate receivers only get the message once.
+			self.assertEqual(sender.forward_propagate_buffer(message, [3, 99, 3]), 1)
+			await run_event_loop()
+			
+			self.assertEqual(writer_2.writes, [])
+			self.assertEqual(writer_3.writes, [serialize(message)])
+		
+		asyncio.run(_test())
+	
+	def test_directed_inter_age(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, _ = make_member(server_state, 1)
+			_, same_age_writer = make_member(server_state, 2)
+			_, other_age_writer = make_member(server_state, 3, AGE_NODE_ID + 1)
+			
+			local = game_server.NetMessageGameMessageDirected()
+			local.delivery_time = structs.ZERO_DATETIME
+			local.compress_and_set_data(b"local")
+			local.receivers = [2, 3]
+			local.forward(sender)
+			
+			inter_age = game_server.NetMessageGameMessageDirected()
+			inter_age.flags |= game_server.NetMessageFlags.inter_age_routing
+			inter_age.delivery_time = structs.ZERO_DATETIME
+			inter_age.compress_and_set_data(b"inter-age")
+			inter_age.receivers = [3]
+			inter_age.forward(sender)
+			await run_event_loop()
+			
+			self.assertEqual(same_age_writer.writes, [serialize(local)])
+			self.assertEqual(other_age_writer.writes, [serialize(inter_age)])
+		
+		asyncio.run(_test())
+	
+	def test_relevance_regions(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, _ = make_member(server_state, 1)
+			sender.client_state.regions_i_care_about = 0b111
+			sender.client_state.regions_im_in = 0b010
+			caring, caring_writer = make_member(server_state, 2)
+			caring.client_state.regions_i_care_about = 0b011
+			caring.client_state.regions_im_in = 0b001
+			not_caring, not_caring_writer = make_member(server_state, 3)
+			not_caring.client_state.regions_i_care_about = 0b101
+			not_caring.client_state.regions_im_in = 0b100
+			# Hasn't sent any relevance regions yet.
+			_, unknown_writer = make_member(server_state, 4)
+			
+			relevant = make_game_message(b"nearby")
+			relevant.flags |= game_server.NetMessageFlags.use_relevance_regions
+			sender.forward_propagate_buffer(relevant)
+			unfiltered = make_game_message(b"everywhere")
+			sender.forward_propagate_buffer(unfiltered)
+			await run_event_loop()
+			
+			self.assertEqual(caring_writer.writes, [serialize(relevant) + serialize(unfiltered)])
+			self.assertEqual(not_caring_writer.writes, [serialize(unfiltered)])
+			self.assertEqual(unknown_writer.writes, [serialize(relevant) + serialize(unfiltered)])
+		
+		asyncio.run(_test())
+	
+	def test_leave(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			conn_1, _ = make_member(server_state, 1)
+			conn_2, _ = make_member(server_state, 2)
+			
+			self.assertEqual(server_state.game_connections_by_ki_number, {1: conn_1, 2: conn_2})
+			
+			conn_1.leave_room()
+			self.assertIsNone(conn_1.room)
+			self.assertEqual(list(server_state.age_instance_rooms[AGE_NODE_ID].members), [2])
+			self.assertEqual(server_state.game_connections_by_ki_number, {2: conn_2})
+			
+			await conn_2.handle_disconnect()
+			# The room is closed once its SDL states are saved.
+			self.assertEqual(list(server_state.age_instance_rooms), [AGE_NODE_ID])
+			await run_event_loop()
+			self.assertEqual(server_state.age_instance_rooms, {})
+			self.assertEqual(server_state.game_connections_by_ki_number, {})
+		
+		asyncio.run(_test())
+	
+	def test_slow_member_disconnected(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state(server__game__max_queued_messages="3")
+			sender, _ = make_member(server_state, 1)
+			slow, slow_writer = make_member(server_state, 2)
+			_, fast_writer = make_member(server_state, 3)
+			slow_writer.resumed.clear()
+			
+			messages = [make_game_message(bytes([i])) for i in range(5)]
+			for message in messages:
+				sender.forward_propagate_buffer(message)
+				await run_event_loop()
+			
+			# The slow client's send task is stuck on the first message,
+			# and the next three fill up its queue.
+			self.assertTrue(slow_writer.closed)
+			self.assertIsNone(slow.room)
+			self.assertEqual(len(slow.send_queue), 0)
+			self.assertEqual(slow_writer.writes, [])
+			
+			# The other client isn't affected at all.
+			self.assertFalse(fast_writer.closed)
+			self.assertEqual(b"".join(fast_writer.writes), b"".join(serialize(message) for message in messages))
+		
+		asyncio.run(_test())
+
+
+TIME_SENT = datetime.datetime(2023, 1, 2, 3, 4, 5, 678901, tzinfo=datetime.timezone.utc)
+
+
+def receive(conn: game_server.GameConnection, message: game_server.NetMessage) -> typing.Awaitable[None]:
+	"""Let ``conn`` receive ``message`` as if it had been sent by the client."""
+	
+	# The message type has already been read when the handler is called.
+	assert conn.reader is not None
+	conn.reader.feed_data(serialize(message)[structs.UINT16.size:])
+	return conn.receive_propagate_buffer()
+
+
+class NetMessageClassesTest(unittest.TestCase):
+	def test_from_class_index(self) -> None:
+		for class_index, clazz in game_server.NET_MESSAGE_CLASSES_BY_INDEX.items():
+			with self.subTest(clazz=clazz):
+				message = game_server.NetMessage.from_class_index(class_index)
+				self.assertIs(type(message), clazz)
+				self.assertEqual(message.class_index, class_index)
+		
+		# Abstract base classes aren't registered.
+		assert game_server.NetMessageStream.CLASS_INDEX is not None
+		with self.assertRaises(pl_messages.UnknownClassIndexError):
+			game_server.NetMessage.from_class_index(game_server.NetMessageStream.CLASS_INDEX)
+	
+	def test_duplicate_class_index(self) -> None:
+		with self.assertRaises(ValueError):
+			class Duplicate(game_server.NetMessage):
+				CLASS_INDEX = game_server.NetMessageGameMessage.CLASS_INDEX
+		
+		self.assertIs(game_server.NET_MESSAGE_CLASSES_BY_INDEX[game_server.NetMessageGameMessage.CLASS_INDEX], game_server.NetMessageGameMessage)
+	
+	def test_header_layouts(self) -> None:
+		values = {
+			"protocol_version": (12, 6),
+			"time_sent": TIME_SENT,
+			"context": 1,
+			"trans_id": 2,
+			"ki_number": 3,
+			"account_uuid": uuid.UUID("01234567-89ab-cdef-0123-456789abcdef"),
+		}
+		
+		fields = game_server.NET_MESSAGE_HEADER_FIELDS
+		for present in itertools.product([False, True], repeat=len(fields)):
+			message = game_server.NetMessageMembersListRequest()
+			for field, is_present in zip(fields, present):
+				if is_present:
+					message.flags |= field.flag
+					setattr(message, field.name, values[field.name])
+			
+			with self.subTest(flags=message.flags):
+				data = message.to_bytes_with_class_index()
+				self.assertEqual(len(data), structs.CLASS_INDEX.size + game_server.net_message_header_size(message.flags))
+				with io.BytesIO(data) as stream:
+					parsed = game_server.NetMessage.from_stream_with_class_index(stream)
+				self.assertEqual(parsed.flags, message.flags)
+				for field, is_present in zip(fields, present):
+					self.assertEqual(getattr(parsed, field.name), values[field.name] if is_present else None)
+
+
+class RawForwardTest(unittest.TestCase):
+	def test_patch_header(self) -> None:
+		message = make_game_message(b"hello")
+		message.flags |= game_server.NetMessageFlags.has_version | game_server.NetMessageFlags.has_time_sent
+		message.protocol_version = (12, 6)
+		message.time_sent = structs.ZERO_DATETIME
+		data = message.to_bytes_with_class_index()
+		
+		patched = game_server.patch_net_message_header(data, flags=message.flags | game_server.NetMessageFlags.echo_back_to_sender, time_sent=TIME_SENT)
+		with io.BytesIO(patched) as stream:
+			parsed = game_server.NetMessage.from_stream_with_class_index(stream)
+		assert isinstance(parsed, game_server.NetMessageGameMessage)
+		self.assertEqual(parsed.flags, message.flags | game_server.NetMessageFlags.echo_back_to_sender)
+		self.assertEqual(parsed.protocol_version, (12, 6))
+		self.assertEqual(parsed.time_sent, TIME_SENT)
+		self.assertEqual(parsed.stream_data, b"hello")
+		
+		with self.assertRaises(ValueError):
+			game_server.patch_net_message_header(data, flags=message.flags | game_server.NetMessageFlags.has_player_id)
+		message.flags &= ~game_server.NetMessageFlags.has_time_sent
+		message.time_sent = None
+		with self.assertRaises(ValueError):
+			game_server.patch_net_message_header(message.to_bytes_with_class_index(), time_sent=TIME_SENT)
+	
+	def test_game_message(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, sender_writer = make_member(server_state, 1)
+			_, writer_2 = make_member(server_state, 2)
+			
+			message = make_game_message(b"hello")
+			message.flags |= game_server.NetMessageFlags.has_time_sent | game_server.NetMessageFlags.echo_back_to_sender
+			message.time_sent = TIME_SENT
+			with unittest.mock.patch.object(game_server.NetMessage, "from_class_index") as from_class_index:
+				await receive(sender, message)
+			from_class_index.assert_not_called()
+			await run_event_loop()
+			
+			self.assertEqual(writer_2.writes, [serialize(message)])
+			# Only the time sent is changed in the echoed message.
+			self.assertEqual(len(sender_writer.writes), 1)
+			echoed = sender_writer.writes[0]
+			self.assertEqual(len(echoed), len(serialize(message)))
+			self.assertNotEqual(echoed, serialize(message))
+			message.time_sent = structs.unpack_unified_time(echoed[16:24])
+			self.assertEqual(echoed, serialize(message))
+		
+		asyncio.run(_test())
+	
+	def test_voice(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, _ = make_member(server_state, 1)
+			_, writer_2 = make_member(server_state, 2)
+			_, writer_3 = make_member(server_state, 3)
+			
+			message = game_server.NetMessageVoice()
+			message.voice_flags = game_server.NetMessageVoice.Flags.encoded_opus
+			message.frame_count = 2
+			message.voice_data = b"blah blah"
+			message.receivers = [3]
+			with unittest.mock.patch.object(game_server.NetMessage, "from_class_index") as from_class_index:
+				await receive(sender, message)
+			from_class_index.assert_not_called()
+			await run_event_loop()
+			
+			self.assertEqual(writer_2.writes, [])
+			self.assertEqual(writer_3.writes, [serialize(message)])
+		
+		asyncio.run(_test())
+	
+	def test_unusual_flags_parsed(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, _ = make_member(server_state, 1)
+			_, writer_2 = make_member(server_state, 2)
+			
+			message = make_game_message(b"hello")
+			message.flags |= game_server.NetMessageFlags.route_to_all_players
+			receiving = receive(sender, message)
+			with unittest.mock.patch.object(game_server.NetMessage, "from_class_index", wraps=game_server.NetMessage.from_class_index) as from_class_index:
+				with unittest.mock.patch.object(game_server.NetMessageGameMessage, "write") as write:
+					with self.assertLogs(game_server.logger_pl_message, "WARNING"):
+						await receiving
+			from_class_index.assert_called_once_with(game_server.NetMessageGameMessage.CLASS_INDEX)
+			# Forwarded unchanged, without serializing it again.
+			write.assert_not_called()
+			await run_event_loop()
+			self.assertEqual(writer_2.writes, [serialize(message)])
+		
+		asyncio.run(_test())
+
+
+class LazyReadTest(unittest.TestCase):
+	def make_load_clone(self) -> game_server.NetMessageLoadClone:
+		message = game_server.NetMessageLoadClone()
+		message.flags |= game_server.NetMessageFlags.has_player_id
+		message.ki_number = 1
+		message.delivery_time = structs.ZERO_DATETIME
+		message.compress_and_set_data(b"clone")
+		message.uoid = UOID_1
+		message.is_player = True
+		message.is_loading = True
+		message.is_initial_state = False
+		return message
+	
+	def test_read_explicitly(self) -> None:
+		original = self.make_load_clone()
+		data = original.to_bytes_with_class_index()
+		
+		message = game_server.NetMessageLoadClone()
+		with unittest.mock.patch.object(game_server.NetMessageLoadClone, "read", wraps=message.read) as read:
+			message.read_lazy(data)
+			self.assertEqual(message.flags, original.flags)
+			self.assertEqual(message.ki_number, 1)
+			read.assert_not_called()
+			
+			# Body fields are simply missing until they are read explicitly.
+			self.assertFalse(hasattr(message, "uoid"))
+			read.assert_not_called()
+			
+			message.read_rest()
+			read.assert_called_once()
+			self.assertEqual(message.uoid, UOID_1)
+			self.assertEqual(message.stream_data, b"clone")
+			self.assertTrue(message.is_player)
+			message.read_rest()
+			read.assert_called_once()
+		
+		self.assertEqual(message.to_bytes_with_class_index(), data)
+	
+	def test_header_changes_kept(self) -> None:
+		data = self.make_load_clone().to_bytes_with_class_index()
+		message = game_server.NetMessageLoadClone()
+		message.read_lazy(data)
+		message.flags |= game_server.NetMessageFlags.echo_back_to_sender
+		message.read_rest()
+		self.assertTrue(game_server.NetMessageFlags.echo_back_to_sender in message.flags)
+		self.assertEqual(message.uoid, UOID_1)
+	
+	def test_trailing_data(self) -> None:
+		message = game_server.NetMessageLoadClone()
+		message.read_lazy(self.make_load_clone().to_bytes_with_class_index() + b"junk")
+		self.assertFalse(hasattr(message, "uoid"))
+		with self.assertRaises(base.ProtocolError):
+			message.check_rest()
+	
+	def test_check_game_message(self) -> None:
+		data = make_game_message(b"hello").to_bytes_with_class_index()
+		
+		message = game_server.NetMessageGameMessage()
+		with unittest.mock.patch.object(game_server.NetMessageGameMessage, "read", wraps=message.read) as read:
+			message.read_lazy(data)
+			message.check_rest()
+			read.assert_not_called()
+		
+		message = game_server.NetMessageGameMessage()
+		message.read_lazy(data + b"junk")
+		with self.assertRaises(base.ProtocolError):
+			message.check_rest()
+		
+		message = game_server.NetMessageGameMessage()
+		message.read_lazy(data[:-3])
+		with self.assertRaises(EOFError):
+			message.check_rest()
+	
+	def test_truncated_not_forwarded(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, _ = make_member(server_state, 1)
+			_, writer_2 = make_member(server_state, 2)
+			
+			# Not eligible for raw forwarding,
+			# so the message has to be rejected by the lazy parsing path.
+			message = make_game_message(b"hello")
+			message.flags |= game_server.NetMessageFlags.route_to_all_players
+			data = message.to_bytes_with_class_index()[:-3]
+			assert sender.reader is not None
+			sender.reader.feed_data(game_server.PROPAGATE_BUFFER_HEADER.pack(message.class_index, len(data)) + data)
+			with self.assertRaises(EOFError):
+				await sender.receive_propagate_buffer()
+			await run_event_loop()
+			self.assertEqual(writer_2.writes, [])
+		
+		asyncio.run(_test())
+	
+	def test_body_not_read_for_forwarding(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, _ = make_member(server_state, 1)
+			_, writer_2 = make_member(server_state, 2)
+			
+			# Not eligible for raw forwarding,
+			# but the handler still doesn't need anything from the message body.
+			message = make_game_message(b"hello")
+			message.flags |= game_server.NetMessageFlags.route_to_all_players
+			receiving = receive(sender, message)
+			with unittest.mock.patch.object(game_server.NetMessageGameMessage, "read") as read:
+				with self.assertLogs(game_server.logger_pl_message, "WARNING"):
+					await receiving
+			read.assert_not_called()
+			await run_event_loop()
+			self.assertEqual(writer_2.writes, [serialize(message)])
+		
+		asyncio.run(_test())
+
+
+class LockManagerTest(unittest.TestCase):
+	def test_contention(self) -> None:
+		locks = game_server.LockManager(0)
+		self.assertIsNone(locks.acquire(UOID_1, 1))
+		self.assertEqual(locks.acquire(UOID_1, 2), 1)
+		# Acquiring again as the owner renews the lock.
+		self.assertIsNone(locks.acquire(UOID_1, 1))
+		# Only the owner can release the lock.
+		self.assertEqual(locks.release(UOID_1, 2), 1)
+		self.assertEqual(len(locks), 1)
+		self.assertEqual(locks.release(UOID_1, 1), 1)
+		self.assertIsNone(locks.release(UOID_1, 1))
+		self.assertIsNone(locks.acquire(UOID_1, 2))
+		
+		self.assertEqual(locks.acquired, 2)
+		self.assertEqual(locks.denied, 1)
+		self.assertEqual(locks.released, 1)
+	
+	def test_lease_expiry(self) -> None:
+		locks = game_server.LockManager(10)
+		with unittest.mock.patch("time.monotonic", return_value=1000.0):
+			self.assertIsNone(locks.acquire(UOID_1, 1))
+		with unittest.mock.patch("time.monotonic", return_value=1009.0):
+			self.assertEqual(locks.acquire(UOID_1, 2), 1)
+		with unittest.mock.patch("time.monotonic", return_value=1010.0):
+			self.assertIsNone(locks.acquire(UOID_1, 2))
+		
+		self.assertEqual(locks.expired, 1)
+		self.assertEqual(locks.max_hold_time, 10.0)
+		# The previous owner's late release doesn't affect the new owner.
+		self.assertEqual(locks.release(UOID_1, 1), 2)
+		self.assertEqual(len(locks), 1)
+	
+	def test_release_all(self) -> None:
+		locks = game_server.LockManager(0)
+		for uoid in [UOID_1, UOID_2, UOID_3]:
+			self.assertIsNone(locks.acquire(uoid, 1))
+		self.assertIsNone(locks.acquire(structs.Uoid(LOCATION_2, 0x0002, 4, b"Other"), 2))
+		
+		self.assertEqual(locks.release_all(1, {LOCATION_2}), 1)
+		self.assertIsNone(locks.acquire(UOID_3, 2))
+		self.assertEqual(locks.release_all(1), 2)
+		self.assertEqual(locks.release_all(1), 0)
+		self.assertEqual(len(locks), 2)
+	
+	def test_released_on_leave(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			conn_1, _ = make_member(server_state, 1)
+			conn_2, _ = make_member(server_state, 2)
+			room = conn_1.room
+			assert room is not None
+			
+			self.assertIsNone(room.locks.acquire(UOID_1, 1))
+			self.assertEqual(room.locks.acquire(UOID_1, 2), 1)
+			conn_1.leave_room()
+			self.assertIsNone(room.locks.acquire(UOID_1, 2))
+		
+		asyncio.run(_test())
+
+
+class SDLStateCacheTest(unittest.TestCase):
+	def test_deferred_save(self) -> None:
+		async def _test() -> None:
+			server_state, age_node_id = await make_database_server_state()
+			try:
+				cache = game_server.SDLStateCache(server_state, age_node_id)
+				await cache.apply_object_change(UOID_1, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, True)
+				await cache.apply_object_change(UOID_1, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, False)
+				self.assertEqual(cache.dirty_count, 1)
+				with self.assertRaises(state.ObjectStateNotFound):
+					await server_state.fetch_object_sdl_state(age_node_id, UOID_1, CLEFT_V24_HEADER.descriptor_name)
+				
+				await cache.save()
+				self.assertEqual(cache.dirty_count, 0)
+				self.assertEqual(await server_state.fetch_object_sdl_state(age_node_id, UOID_1, CLEFT_V24_HEADER.descriptor_name), CLEFT_V24_DEFAULT_DATA)
+				
+				# A new cache loads the saved state from the database.
+				cache = game_server.SDLStateCache(server_state, age_node_id)
+				await cache.apply_object_change(UOID_1, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, False)
+				self.assertEqual(cache.object_states[UOID_1, CLEFT_V24_HEADER.descriptor_name].to_blob(), CLEFT_V24_DEFAULT_DATA)
+			finally:
+				await server_state.db.close()
+		
+		asyncio.run(_test())
+	
+	def test_save_immediately(self) -> None:
+		async def _test() -> None:
+			server_state, age_node_id = await make_database_server_state(server__game__sdl_save_interval="0")
+			try:
+				cache = game_server.SDLStateCache(server_state, age_node_id)
+				await cache.apply_object_change(UOID_1, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, True)
+				self.assertEqual(cache.dirty_count, 0)
+				self.assertEqual(await server_state.fetch_object_sdl_state(age_node_id, UOID_1, CLEFT_V24_HEADER.descriptor_name), CLEFT_V24_DEFAULT_DATA)
+			finally:
+				await server_state.db.close()
+		
+		asyncio.run(_test())
+	
+	def test_mismatched_change_ignored(self) -> None:
+		async def _test() -> None:
+			server_state, age_node_id = await make_database_server_state()
+			try:
+				cache = game_server.SDLStateCache(server_state, age_node_id)
+				await cache.apply_object_change(UOID_1, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, True)
+				cached = cache.object_states[UOID_1, CLEFT_V24_HEADER.descriptor_name]
+				with self.assertRaises(ValueError):
+					cached.apply_change(sdl.SDLStreamHeader(CLEFT_V24_HEADER.descriptor_name, 25), CLEFT_V24_DEFAULT_RECORD)
+				self.assertEqual(cached.to_blob(), CLEFT_V24_DEFAULT_DATA)
+			finally:
+				await server_state.db.close()
+		
+		asyncio.run(_test())
+	
+	def test_initial_state_messages(self) -> None:
+		async def _test() -> None:
+			server_state, age_node_id = await make_database_server_state()
+			try:
+				conn, _ = make_member(server_state, 1, age_node_id)
+				conn.client_state.age_info_node_id = age_node_id
+				assert conn.room is not None
+				cache = conn.room.sdl_states
+				await server_state.save_object_sdl_state(age_node_id, UOID_1, CLEFT_V24_HEADER.descriptor_name, CLEFT_V24_DEFAULT_DATA)
+				await cache.apply_object_change(UOID_2, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, True)
+				
+				messages = await cache.initial_state_messages(conn)
+				self.assertEqual(messages, [
+					game_server.serialize_propagate_buffer(await game_server.make_initial_state_message(server_state.compression, UOID_1, CLEFT_V24_DEFAULT_DATA)),
+					game_server.serialize_propagate_buffer(await game_server.make_initial_state_message(server_state.compression, UOID_2, CLEFT_V24_DEFAULT_DATA)),
+				])
+				
+				# Unchanged states are neither loaded from the database nor serialized again.
+				with unittest.mock.patch.object(server_state, "find_object_sdl_states", side_effect=AssertionError):
+					self.assertEqual(await cache.initial_state_messages(conn), messages)
+					
+					await cache.apply_object_change(UOID_2, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, False)
+					changed_messages = await cache.initial_state_messages(conn)
+					self.assertIs(changed_messages[0], messages[0])
+					self.assertIsNot(changed_messages[1], messages[1])
+					self.assertEqual(changed_messages[1], messages[1])
+			finally:
+				await server_state.db.close()
+		
+		asyncio.run(_test())
+
+
+class VolatileSDLStoreTest(unittest.TestCase):
+	def test_merge_and_owner(self) -> None:
+		store = game_server.VolatileSDLStore(1024 * 1024)
+		store.apply_change(1, UOID_1, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, False)
+		store.apply_change(2, UOID_1, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, False)
+		# Clone states belong to the cloning avatar and not the sender.
+		clone_uoid = structs.Uoid(LOCATION_1, 0x0002, 4, b"Clone", (1, 3))
+		store.apply_change(2, clone_uoid, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, True)
+		
+		self.assertEqual(len(store), 2)
+		self.assertEqual(store.size, 2 * len(CLEFT_V24_DEFAULT_DATA))
+		self.assertEqual(store.states[UOID_1, CLEFT_V24_HEADER.descriptor_name].owner, 2)
+		self.assertEqual(store.states[UOID_1, CLEFT_V24_HEADER.descriptor_name].to_blob(), CLEFT_V24_DEFAULT_DATA)
+		self.assertEqual(store.states[clone_uoid, CLEFT_V24_HEADER.descriptor_name].owner, 3)
+		
+		self.assertEqual(store.remove_owner(3), 1)
+		# The state of UOID_1 now belongs to avatar 2.
+		self.assertEqual(store.remove_owner(1), 0)
+		self.assertEqual(list(store.states), [(UOID_1, CLEFT_V24_HEADER.descriptor_name)])
+		self.assertEqual(store.size, len(CLEFT_V24_DEFAULT_DATA))
+		
+		self.assertEqual(store.remove_owner(2), 1)
+		self.assertEqual(len(store), 0)
+		self.assertEqual(store.size, 0)
+	
+	def test_initial_states(self) -> None:
+		store = game_server.VolatileSDLStore(1024 * 1024)
+		store.apply_change(1, UOID_1, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, True)
+		store.apply_change(2, UOID_2, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, False)
+		volatile_state = store.states[UOID_2, CLEFT_V24_HEADER.descriptor_name]
+		# Pretend that a larger change was received earlier.
+		volatile_state.size += 100
+		store.size += 100
+		
+		self.assertEqual(store.initial_states(1), [(UOID_2, CLEFT_V24_DEFAULT_DATA, False)])
+		self.assertEqual(volatile_state.size, len(CLEFT_V24_DEFAULT_DATA))
+		self.assertEqual(store.size, 2 * len(CLEFT_V24_DEFAULT_DATA))
+	
+	def test_memory_limit(self) -> None:
+		store = game_server.VolatileSDLStore(2 * len(CLEFT_V24_DEFAULT_DATA))
+		for uoid in [UOID_1, UOID_2, UOID_3]:
+			store.apply_change(1, uoid, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, False)
+		# Changing a state makes it the most recently changed one.
+		store.apply_change(1, UOID_2, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, False)
+		store.apply_change(1, UOID_1, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, False)
+		
+		self.assertEqual([uoid for uoid, _ in store.states], [UOID_2, UOID_1])
+		self.assertEqual(store.evicted, 2)
+	
+	def test_discarded_on_leave(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			conn_1, _ = make_member(server_state, 1)
+			conn_2, _ = make_member(server_state, 2)
+			room = conn_1.room
+			assert room is not None
+			
+			room.volatile_sdl_states.apply_change(1, UOID_1, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, True)
+			room.volatile_sdl_states.apply_change(2, UOID_2, CLEFT_V24_HEADER, CLEFT_V24_DEFAULT_RECORD, CLEFT_V24_DEFAULT_DATA, True)
+			conn_1.leave_room()
+			self.assertEqual([uoid for uoid, _ in room.volatile_sdl_states.states], [UOID_2])
+		
+		asyncio.run(_test())
+
+
+class CloneRegistryTest(unittest.TestCase):
+	def test_load_unload(self) -> None:
+		clones = game_server.CloneRegistry()
+		avatar_uoid = structs.Uoid(LOCATION_1, 0x0001, 5, b"Avatar", (1, 2))
+		clones.load(2, UOID_1, b"first")
+		clones.load(2, avatar_uoid, b"avatar")
+		# Clones belong to the cloning avatar and not the sender.
+		clones.load(3, structs.Uoid(LOCATION_1, 0x0001, 6, b"Spawned", (1, 2)), b"spawned")
+		clones.load(3, UOID_2, b"second")
+		# Reloading a clone replaces the old message and moves it to the end.
+		clones.load(2, UOID_1, b"first again")
+		
+		self.assertEqual(clones.initial_messages(4), [b"avatar", b"spawned", b"second", b"first again"])
+		self.assertEqual(clones.initial_messages(3), [b"avatar", b"spawned", b"first again"])
+		self.assertTrue(clones.unload(avatar_uoid))
+		self.assertFalse(clones.unload(avatar_uoid))
+		self.assertEqual(clones.remove_owner(2), 2)
+		self.assertEqual(clones.initial_messages(4), [b"second"])
+	
+	def test_load_clone_message(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			conn_1, _ = make_member(server_state, 1)
+			_, writer_2 = make_member(server_state, 2)
+			room = conn_1.room
+			assert room is not None
+			
+			load = game_server.NetMessageLoadClone()
+			load.delivery_time = structs.ZERO_DATETIME
+			load.compress_and_set_data(b"spawn")
+			load.uoid = structs.Uoid(LOCATION_1, 0x0001, 5, b"Spawned", (1, 1))
+			load.is_player = False
+			load.is_loading = True
+			load.is_initial_state = False
+			await load.handle(conn_1)
+			await run_event_loop()
+			
+			# Other clients receive the message as sent,
+			# clients joining later receive it as an initial state.
+			self.assertEqual(len(writer_2.writes), 1)
+			self.assertFalse(writer_2.writes[0].endswith(game_server.NET_MESSAGE_LOAD_CLONE_BOOLS.pack(False, True, True)))
+			self.assertEqual(room.clones.initial_messages(2), [serialize(load)])
+			self.assertTrue(serialize(load).endswith(game_server.NET_MESSAGE_LOAD_CLONE_BOOLS.pack(False, True, True)))
+			
+			load.is_loading = False
+			load.is_initial_state = False
+			await load.handle(conn_1)
+			self.assertEqual(len(room.clones), 0)
+			
+			load.is_loading = True
+			await load.handle(conn_1)
+			conn_1.leave_room()
+			self.assertEqual(len(room.clones), 0)
+		
+		asyncio.run(_test())
+
+
+def make_default_record(indices: typing.Iterable[int]) -> sdl.GuessedSDLRecord:
+	"""Make an SDL change record that sets only the variables with the given indices to their defaults."""
+	
+	simple_values = {}
+	for i in indices:
+		simple_values[i] = sdl.GuessedSimpleVariableValue(hint=b"", flags=sdl.SimpleVariableValueBase.Flags.same_as_default, data=b"")
+	return sdl.GuessedSDLRecord(simple_values_indices=True, simple_values=simple_values, nested_sdl_values_indices=True, nested_sdl_values={})
+
+
+def make_avatar_input_state_message(sender: structs.Uoid, state: int) -> game_server.NetMessageGameMessage:
+	pl_message = pl_messages.AvatarInputStateMessage()
+	pl_message.sender = sender
+	pl_message.state = pl_messages.AvatarInputStateMessage.State(state)
+	with io.BytesIO() as stream:
+		pl_messages.Message.creatable_to_stream(pl_message, stream)
+		message = make_game_message(stream.getvalue())
+	
+	message.flags &= ~game_server.NetMessageFlags.needs_reliable_send
+	return message
+
+
+class CoalesceTest(unittest.TestCase):
+	def test_send_queue(self) -> None:
+		async def _test() -> None:
+			key_1 = (pl_messages.AvatarInputStateMessage.CLASS_INDEX, UOID_1)
+			key_2 = (pl_messages.AvatarInputStateMessage.CLASS_INDEX, UOID_2)
+			queue = game_server.MemberSendQueue(3, 0.0)
+			self.assertTrue(queue.put(1, b"old 1", key_1))
+			self.assertTrue(queue.put(2, b"other", None))
+			self.assertTrue(queue.put(1, b"old 2", key_2))
+			self.assertFalse(queue.put(2, b"too much", None))
+			# Replacing a queued message works even if the queue is full.
+			self.assertTrue(queue.put(1, b"new 1", key_1))
+			self.assertTrue(queue.put(3, b"newer 1", key_1))
+			self.assertEqual(len(queue), 3)
+			self.assertEqual(queue.coalesced, 2)
+			
+			# The newest message takes the place of the oldest one with the same key.
+			self.assertEqual(await queue.get(), (3, b"newer 1"))
+			# Once sent, a key can be queued again.
+			self.assertTrue(queue.put(1, b"newest 1", key_1))
+			self.assertEqual(await queue.get(), (2, b"other"))
+			self.assertEqual(await queue.get(), (1, b"old 2"))
+			self.assertEqual(await queue.get(), (1, b"newest 1"))
+			self.assertEqual(len(queue), 0)
+		
+		asyncio.run(_test())
+	
+	def test_coalesce_keys(self) -> None:
+		reliable = make_avatar_input_state_message(UOID_1, 1)
+		reliable.flags |= game_server.NetMessageFlags.needs_reliable_send
+		self.assertIsNone(reliable.coalesce_key())
+		self.assertIsNone(make_game_message(b"not a plMessage").coalesce_key())
+		
+		message = make_avatar_input_state_message(UOID_1, 1)
+		key = (pl_messages.AvatarInputStateMessage.CLASS_INDEX, UOID_1)
+		self.assertEqual(message.coalesce_key(), key)
+		
+		# Lazily read messages are only read as far as necessary.
+		lazy = game_server.NetMessageGameMessage()
+		lazy.read_lazy(message.to_bytes_with_class_index())
+		with unittest.mock.patch.object(game_server.NetMessageGameMessage, "read") as read:
+			self.assertEqual(lazy.coalesce_key(), key)
+		read.assert_not_called()
+		
+		sdl_broadcast = game_server.NetMessageSDLStateBroadcast()
+		sdl_broadcast.flags &= ~game_server.NetMessageFlags.needs_reliable_send
+		sdl_broadcast.uoid = UOID_2
+		self.assertIsNone(sdl_broadcast.coalesce_key())
+	
+	def test_slow_member(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, _ = make_member(server_state, 1)
+			_, slow_writer = make_member(server_state, 2)
+			_, fast_writer = make_member(server_state, 3)
+			slow_writer.resumed.clear()
+			
+			first = make_game_message(b"first")
+			await receive(sender, first)
+			await run_event_loop()
+			
+			# The slow client's send task is stuck on the first message,
+			# so everything else stays in its queue.
+			messages = [
+				make_avatar_input_state_message(UOID_1, 1),
+				make_avatar_input_state_message(UOID_2, 1),
+				make_game_message(b"reliable"),
+				make_avatar_input_state_message(UOID_1, 2),
+				make_avatar_input_state_message(UOID_1, 3),
+			]
+			for message in messages:
+				await receive(sender, message)
+				await run_event_loop()
+			
+			slow_writer.resumed.set()
+			await run_event_loop()
+			
+			# The reliable message is sent ahead of the unreliable ones (see SendPriorityTest).
+			self.assertEqual(b"".join(slow_writer.writes), b"".join(serialize(message) for message in [first, messages[2], messages[4], messages[1]]))
+			self.assertEqual(server_state.age_instance_rooms[AGE_NODE_ID].members[2].send_queue.coalesced, 2)
+			
+			# Clients that keep up receive every message.
+			self.assertEqual(b"".join(fast_writer.writes), b"".join(serialize(message) for message in [first, *messages]))
+		
+		asyncio.run(_test())
+	
+	def test_sdl_changes_not_coalesced(self) -> None:
+		def make_sdl_broadcast(header: sdl.SDLStreamHeader, record: sdl.GuessedSDLRecord) -> game_server.NetMessageSDLStateBroadcast:
+			with io.BytesIO() as stream:
+				header.write(stream)
+				record.write(stream)
+				blob = stream.getvalue()
+			
+			message = game_server.NetMessageSDLStateBroadcast()
+			message.flags &= ~game_server.NetMessageFlags.needs_reliable_send
+			message.uoid = UOID_1
+			message.compress_and_set_data(blob)
+			message.is_initial_state = False
+			message.persist_on_server = False
+			message.is_avatar_state = False
+			return message
+		
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, _ = make_member(server_state, 1)
+			_, slow_writer = make_member(server_state, 2)
+			slow_writer.resumed.clear()
+			
+			first = make_game_message(b"first")
+			await receive(sender, first)
+			await run_event_loop()
+			
+			# Two partial changes to the same state,
+			# and a change to another state of the same object.
+			messages = [
+				make_sdl_broadcast(CLEFT_V24_HEADER, make_default_record([0, 1])),
+				make_sdl_broadcast(CLEFT_V24_HEADER, make_default_record([2, 3])),
+				make_sdl_broadcast(CITY_V43_HEADER, make_default_record([0])),
+			]
+			for message in messages:
+				await receive(sender, message)
+				await run_event_loop()
+			
+			slow_writer.resumed.set()
+			await run_event_loop()
+			
+			self.assertEqual(b"".join(slow_writer.writes), b"".join(serialize(message) for message in [first, *messages]))
+			self.assertEqual(server_state.age_instance_rooms[AGE_NODE_ID].members[2].send_queue.coalesced, 0)
+		
+		asyncio.run(_test())
+
+
+class SendPriorityTest(unittest.TestCase):
+	def test_order(self) -> None:
+		async def _test() -> None:
+			queue = game_server.MemberSendQueue(10, 0.0)
+			queue.put(1, b"voice", priority=game_server.SendPriority.voice)
+			queue.put(2, b"game 1", priority=game_server.SendPriority.game)
+			queue.put(3, b"sdl", priority=game_server.SendPriority.sdl)
+			queue.put(2, b"game 2", priority=game_server.SendPriority.game)
+			queue.put(4, b"reliable", priority=game_server.SendPriority.control)
+			self.assertEqual(len(queue), 5)
+			
+			received = [await queue.get() for _ in range(5)]
+			self.assertEqual(received, [(4, b"reliable"), (3, b"sdl"), (2, b"game 1"), (2, b"game 2"), (1, b"voice")])
+			self.assertEqual([statistics.sent for statistics in queue.statistics], [1, 1, 2, 1])
+			self.assertEqual([statistics.dropped for statistics in queue.statistics], [0, 0, 0, 0])
+		
+		asyncio.run(_test())
+	
+	def test_priority_for(self) -> None:
+		self.assertEqual(make_game_message(b"reliable").send_priority(), game_server.SendPriority.control)
+		self.assertEqual(make_avatar_input_state_message(UOID_1, 1).send_priority(), game_server.SendPriority.game)
+		
+		voice = game_server.NetMessageVoice()
+		self.assertEqual(voice.send_priority(), game_server.SendPriority.control)
+		voice.flags = game_server.NetMessageFlags(0)
+		self.assertEqual(voice.send_priority(), game_server.SendPriority.voice)
+		
+		sdl_broadcast = game_server.NetMessageSDLStateBroadcast()
+		sdl_broadcast.flags = game_server.NetMessageFlags(0)
+		self.assertEqual(sdl_broadcast.send_priority(), game_server.SendPriority.sdl)
+		
+		# Clone messages are never dropped.
+		load_clone = game_server.NetMessageLoadClone()
+		load_clone.flags = game_server.NetMessageFlags(0)
+		self.assertEqual(load_clone.send_priority(), game_server.SendPriority.control)
+	
+	def test_deadline(self) -> None:
+		async def _test() -> None:
+			queue = game_server.MemberSendQueue(3, 0.05)
+			queue.put(1, b"reliable", priority=game_server.SendPriority.control)
+			queue.put(2, b"stale", priority=game_server.SendPriority.game)
+			queue.put(3, b"stale voice", priority=game_server.SendPriority.voice)
+			time.sleep(0.1)
+			
+			# The queue is full, but the stale messages make room.
+			self.assertTrue(queue.put(2, b"fresh", priority=game_server.SendPriority.game))
+			self.assertEqual(len(queue), 2)
+			self.assertEqual(queue.statistics[game_server.SendPriority.game].dropped, 1)
+			self.assertEqual(queue.statistics[game_server.SendPriority.voice].dropped, 1)
+			
+			queue.put(3, b"stale again", priority=game_server.SendPriority.voice)
+			time.sleep(0.1)
+			queue.put(3, b"fresh voice", priority=game_server.SendPriority.voice)
+			self.assertEqual(await queue.get(), (1, b"reliable"))
+			# The game message became stale too while waiting.
+			self.assertEqual(await queue.get(), (3, b"fresh voice"))
+			self.assertEqual(len(queue), 0)
+			
+			statistics = queue.statistics
+			self.assertEqual(statistics[game_server.SendPriority.control].sent, 1)
+			self.assertGreaterEqual(statistics[game_server.SendPriority.control].max_latency, 0.2)
+			self.assertEqual(statistics[game_server.SendPriority.game].dropped, 2)
+			self.assertEqual(statistics[game_server.SendPriority.voice].dropped, 2)
+			self.assertEqual(statistics[game_server.SendPriority.voice].sent, 1)
+			
+			# Without a deadline, nothing is dropped.
+			queue = game_server.MemberSendQueue(3, 0.0)
+			queue.put(2, b"old", priority=game_server.SendPriority.game)
+			time.sleep(0.1)
+			self.assertEqual(await queue.get(), (2, b"old"))
+		
+		asyncio.run(_test())
+	
+	def test_coalesced_not_stale(self) -> None:
+		async def _test() -> None:
+			key = (pl_messages.AvatarInputStateMessage.CLASS_INDEX, UOID_1)
+			queue = game_server.MemberSendQueue(3, 0.05)
+			queue.put(2, b"old", key, game_server.SendPriority.game)
+			time.sleep(0.1)
+			# The replacement is new, so it's not dropped.
+			queue.put(2, b"new", key, game_server.SendPriority.game)
+			self.assertEqual(queue.drop_stale(), 0)
+			self.assertEqual(await queue.get(), (2, b"new"))
+		
+		asyncio.run(_test())
+	
+	def test_room_statistics(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state()
+			sender, _ = make_member(server_state, 1)
+			make_member(server_state, 2)
+			make_member(server_state, 3)
+			
+			await receive(sender, make_avatar_input_state_message(UOID_1, 1))
+			await receive(sender, make_game_message(b"reliable"))
+			await run_event_loop()
+			
+			statistics = server_state.age_instance_rooms[AGE_NODE_ID].send_statistics()
+			self.assertEqual([s.sent for s in statistics], [2, 0, 2, 0])
+			self.assertEqual([s.dropped for s in statistics], [0, 0, 0, 0])
+		
+		asyncio.run(_test())
+
+
+class SampledInspectionTest(unittest.TestCase):
+	def make_pl_message_data(self) -> bytes:
+		pl_message = pl_messages.UnknownMessage()
+		pl_message.class_index = 0x0999
+		pl_message.data = b"unknown"
+		with io.BytesIO() as stream:
+			pl_messages.Message.creatable_to_stream(pl_message, stream)
+			return stream.getvalue()
+	
+	def test_sampled(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state(server__game__pl_message_sample_rate="1")
+			sender, _ = make_member(server_state, 1)
+			_, writer_2 = make_member(server_state, 2)
+			
+			message = make_game_message(self.make_pl_message_data())
+			await receive(sender, message)
+			await receive(sender, make_game_message(b"garbage"))
+			with self.assertLogs(game_server.logger_pl_message, "ERROR"):
+				await run_event_loop()
+			server_state.pl_message_inspector.shutdown()
+			
+			# Forwarding isn't affected by the inspection.
+			self.assertEqual(b"".join(writer_2.writes), serialize(message) + serialize(make_game_message(b"garbage")))
+			inspector = server_state.pl_message_inspector
+			self.assertEqual(inspector.sampled, 2)
+			self.assertEqual(inspector.failed, 0)
+			self.assertEqual(inspector.counts, {"UnknownMessage (0x0999)": 1, "(failed to parse)": 1})
+		
+		asyncio.run(_test())
+	
+	def test_not_sampled_when_parsing_everything(self) -> None:
+		async def _test() -> None:
+			server_state = make_server_state(
+				server__game__parse_pl_messages="known",
+				server__game__pl_message_sample_rate="1",
+			)
+			sender, _ = make_member(server_state, 1)
+			make_member(server_state, 2)
+			
+			await receive(sender, make_game_message(self.make_pl_message_data()))
+			await run_event_loop()
+			self.assertEqual(server_state.pl_message_inspector.sampled, 0)
+		
+		asyncio.run(_test())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,108 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+from nagus import handshake
+
+
+class HandshakeExecutorTest(unittest.TestCase):
+	def test_inline(self) -> None:
+		async def _test() -> None:
+			executor = handshake.HandshakeExecutor(0, 1)
+			try:
+				results = await asyncio.gather(*[executor.dh_pow(y, 65537, 1000003) for y in range(10)])
+			finally:
+				executor.shutdown()
+			
+			self.assertEqual(results, [pow(y, 65537, 1000003) for y in range(10)])
+			self.assertEqual(executor.completed, 10)
+		
+		asyncio.run(_test())
+	
+	def test_worker_processes(self) -> None:
+		async def _test() -> None:
+			executor = handshake.HandshakeExecutor(2, 100)
+			try:
+				results = await asyncio.gather(*[executor.dh_pow(y, 65537, 1000003) for y in range(10)])
+			finally:
+				executor.shutdown()
+			
+			self.assertEqual(results, [pow(y, 65537, 1000003) for y in range(10)])
+			self.assertEqual(executor.completed, 10)
+			self.assertEqual(executor.pending, 0)
+		
+		asyncio.run(_test())
+	
+	def test_queue_full(self) -> None:
+		async def _test() -> None:
+			executor = handshake.HandshakeExecutor(1, 3)
+			try:
+				results = await asyncio.gather(*[executor.dh_pow(y, 65537, 1000003) for y in range(5)], return_exceptions=True)
+			finally:
+				executor.shutdown()
+			
+			self.assertEqual(results[:3], [pow(y, 65537, 1000003) for y in range(3)])
+			for result in results[3:]:
+				self.assertIsInstance(result, handshake.HandshakeQueueFullError)
+			self.assertEqual(executor.rejected, 2)
+		
+		asyncio.run(_test())
+	
+	def test_reserve(self) -> None:
+		async def _test() -> None:
+			executor = handshake.HandshakeExecutor(1, 2)
+			try:
+				with executor.reserve(), executor.reserve():
+					self.assertEqual(executor.pending, 2)
+					with self.assertRaises(handshake.HandshakeQueueFullError):
+						with executor.reserve():
+							pass
+					self.assertEqual(await executor.dh_pow_reserved(3, 65537, 1000003), pow(3, 65537, 1000003))
+				self.assertEqual(executor.pending, 0)
+				self.assertEqual(executor.rejected, 1)
+			finally:
+				executor.shutdown()
+		
+		asyncio.run(_test())
+	
+	def test_broken_pool(self) -> None:
+		async def _test() -> None:
+			executor = handshake.HandshakeExecutor(1, 10)
+			try:
+				self.assertEqual(await executor.dh_pow(2, 65537, 1000003), pow(2, 65537, 1000003))
+				
+				# Simulate a worker process being killed (e. g. by the OOM killer).
+				assert executor._executor is not None
+				for process in list(executor._executor._processes.values()):
+					process.kill()
+				
+				results = await asyncio.gather(*[executor.dh_pow(y, 65537, 1000003) for y in range(5)])
+				self.assertEqual(results, [pow(y, 65537, 1000003) for y in range(5)])
+				self.assertEqual(executor.restarts, 1)
+				
+				# The replacement pool works normally.
+				self.assertEqual(await executor.dh_pow(7, 65537, 1000003), pow(7, 65537, 1000003))
+			finally:
+				executor.shutdown()
+		
+		asyncio.run(_test())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,103 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+from nagus import inspection
+
+
+def describe_length(data: bytes) -> str:
+	return f"{len(data)} bytes"
+
+
+async def wait_for_inspection(inspector: inspection.SampledInspector) -> None:
+	for _ in range(100):
+		await asyncio.sleep(0)
+
+
+class SampledInspectorTest(unittest.TestCase):
+	def test_sample_all(self) -> None:
+		async def _test() -> None:
+			inspector = inspection.SampledInspector(1.0, 100)
+			for data in [b"a", b"bb", b"cc", b"ddd", b"e"]:
+				inspector.offer(data, describe_length)
+			await wait_for_inspection(inspector)
+			inspector.shutdown()
+			
+			self.assertEqual(inspector.sampled, 5)
+			self.assertEqual(inspector.dropped, 0)
+			self.assertEqual(inspector.failed, 0)
+			self.assertEqual(inspector.counts, {"1 bytes": 2, "2 bytes": 2, "3 bytes": 1})
+		
+		asyncio.run(_test())
+	
+	def test_sample_none(self) -> None:
+		async def _test() -> None:
+			inspector = inspection.SampledInspector(0.0, 100)
+			for _ in range(100):
+				inspector.offer(b"data", describe_length)
+			await wait_for_inspection(inspector)
+			inspector.shutdown()
+			
+			self.assertEqual(inspector.sampled, 0)
+			self.assertEqual(inspector.dropped, 0)
+			self.assertFalse(inspector.counts)
+		
+		asyncio.run(_test())
+	
+	def test_queue_full(self) -> None:
+		async def _test() -> None:
+			inspector = inspection.SampledInspector(1.0, 3)
+			# The background task can't run in between,
+			# so only the first few samples fit into the queue.
+			for _ in range(10):
+				inspector.offer(b"data", describe_length)
+			self.assertEqual(inspector.sampled, 3)
+			self.assertEqual(inspector.dropped, 7)
+			
+			await wait_for_inspection(inspector)
+			self.assertEqual(inspector.counts, {"4 bytes": 3})
+			
+			# Once the queue has been worked off, new samples are accepted again.
+			inspector.offer(b"data", describe_length)
+			await wait_for_inspection(inspector)
+			inspector.shutdown()
+			self.assertEqual(inspector.sampled, 4)
+			self.assertEqual(inspector.counts, {"4 bytes": 4})
+		
+		asyncio.run(_test())
+	
+	def test_failed(self) -> None:
+		def inspect(data: bytes) -> str:
+			if not data:
+				raise ValueError("No data")
+			return describe_length(data)
+		
+		async def _test() -> None:
+			inspector = inspection.SampledInspector(1.0, 100)
+			with self.assertLogs(inspection.logger, "ERROR"):
+				for data in [b"a", b"", b"b"]:
+					inspector.offer(data, inspect)
+				await wait_for_inspection(inspector)
+			inspector.shutdown()
+			
+			self.assertEqual(inspector.sampled, 3)
+			self.assertEqual(inspector.failed, 1)
+			self.assertEqual(inspector.counts, {"1 bytes": 2})
+		
+		asyncio.run(_test())
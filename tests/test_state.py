@@ -0,0 +1,93 @@
+# This file is part of NAGUS, an Uru Live server that is not very good.
+# Copyright (C) 2022 dgelessus
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+import unittest.mock
+import uuid
+
+from nagus import crypto
+from nagus import state
+
+
+class FailedLoginThrottleTest(unittest.TestCase):
+	def test_throttle_and_expire(self) -> None:
+		throttle: state.FailedLoginThrottle[str] = state.FailedLoginThrottle(3, 60)
+		with unittest.mock.patch("time.monotonic", return_value=1000.0):
+			for _ in range(2):
+				throttle.record_failure("a")
+			self.assertFalse(throttle.is_throttled("a"))
+			throttle.record_failure("a")
+			self.assertTrue(throttle.is_throttled("a"))
+			self.assertFalse(throttle.is_throttled("b"))
+		
+		with unittest.mock.patch("time.monotonic", return_value=1061.0):
+			self.assertFalse(throttle.is_throttled("a"))
+	
+	def test_clear(self) -> None:
+		throttle: state.FailedLoginThrottle[str] = state.FailedLoginThrottle(1, 60)
+		throttle.record_failure("a")
+		self.assertTrue(throttle.is_throttled("a"))
+		throttle.clear("a")
+		self.assertFalse(throttle.is_throttled("a"))
+	
+	def test_disabled(self) -> None:
+		throttle: state.FailedLoginThrottle[str] = state.FailedLoginThrottle(0, 60)
+		for _ in range(10):
+			throttle.record_failure("a")
+		self.assertFalse(throttle.is_throttled("a"))
+	
+	def test_max_tracked(self) -> None:
+		throttle: state.FailedLoginThrottle[int] = state.FailedLoginThrottle(1, 60, max_tracked=10)
+		for key in range(100):
+			throttle.record_failure(key)
+		self.assertFalse(throttle.is_throttled(0))
+		self.assertTrue(throttle.is_throttled(99))
+
+
+class AccountInfoTest(unittest.TestCase):
+	def _make_account(self, name: str, password: str) -> state.AccountInfo:
+		return state.AccountInfo(
+			uuid.uuid4(), name,
+			crypto.password_hash_sha_1(password), crypto.password_hash_sha_0(name, password),
+			0, 0,
+		)
+	
+	def test_email_account(self) -> None:
+		account = self._make_account("AzureDiamond@example.com", "hunter2")
+		for password_hash in (account.password_hash_sha_1, account.password_hash_sha_0):
+			with self.subTest(password_hash=password_hash):
+				challenge_hash = crypto.challenge_hash(0x12345678, 0xdeadbeef, password_hash)
+				self.assertTrue(account.check_challenge_hash("azurediamond@example.com", 0x12345678, 0xdeadbeef, challenge_hash))
+				self.assertFalse(account.check_challenge_hash("azurediamond@example.com", 0x12345678, 0xcafebabe, challenge_hash))
+		
+		wrong = crypto.challenge_hash(0x12345678, 0xdeadbeef, crypto.password_hash_sha_1("hunter3"))
+		self.assertFalse(account.check_challenge_hash("azurediamond@example.com", 0x12345678, 0xdeadbeef, wrong))
+	
+	def test_plain_account(self) -> None:
+		account = self._make_account("AzureDiamond", "hunter2")
+		self.assertTrue(account.check_challenge_hash("AzureDiamond", 0, 0xdeadbeef, crypto.password_hash_sha_1("hunter2")))
+		self.assertTrue(account.check_challenge_hash("AzureDiamond", 0, 0xdeadbeef, crypto.password_hash_sha_0("AzureDiamond", "hunter2")))
+		self.assertFalse(account.check_challenge_hash("AzureDiamond", 0, 0xdeadbeef, crypto.password_hash_sha_1("hunter3")))
+	
+	def test_account_name_key(self) -> None:
+		self.assertEqual(state.account_name_key("AzureDiamond@Example.COM"), "azurediamond@example.com")
+		# Only ASCII letters are case-folded, like SQLite's nocase collation.
+		self.assertEqual(state.account_name_key("ÜNICÖDE"), "ÜnicÖde")
+
+
+if __name__ == "__main__":
+	unittest.main()